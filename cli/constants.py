@@ -2,6 +2,47 @@ import os
 
 DEFAULT_BM25_K1 = 1.5
 DEFAULT_BM25_B = 0.75
+BM25_BLOCK_SIZE = 64
+INDEX_BUILD_BATCH_SIZE = 1000
+EMBEDDING_BUILD_BATCH_SIZE = 256
+EMBEDDING_BUILD_BATCHES_PER_WORKER = 4
+WRITE_SEGMENT_MAX_DOCS = 1000
+SEGMENT_MERGE_FACTOR = 4
+SEGMENT_MAX_DELETED_RATIO = 0.3
+DOCUMENT_LOG_MAX_BYTES = 4 * 1024 * 1024
+ANALYZER_CACHE_SIZE = 200000
+ANALYZER_VOCABULARY_SIZE = 1000000
+RESULT_CACHE_SIZE = 1024
+DOCUMENT_CACHE_SIZE = 256
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+QUERY_EMBEDDING_DISK_CACHE_SIZE = 16384
+DEFAULT_SHARD_COUNT = 4
+SPELL_MAX_EDIT_DISTANCE = 2
+SPELL_PREFIX_LENGTH = 7
+SPELL_CONFIDENCE_THRESHOLD = 0.6
+QUERY_EXPANSION_NEIGHBOURS = 10
+QUERY_EXPANSION_FAN_OUT = 3
+QUERY_EXPANSION_WEIGHT = 0.5
+QUERY_EXPANSION_MIN_SIMILARITY = 0.5
+QUERY_EXPANSION_MIN_DOCUMENT_FREQUENCY = 2
+QUERY_EXPANSION_COOCCURRENCE_WEIGHT = 0.2
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_PRECOMPUTED_PREFIX_LENGTH = 3
+AUTOCOMPLETE_PRECOMPUTED_COUNT = 40
+DEDUP_SHINGLE_SIZE = 3
+DEDUP_PERMUTATIONS = 128
+DEDUP_BANDS = 16
+DEDUP_THRESHOLD = 0.8
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+HNSW_EXACT_FRACTION = 0.1
+CHUNK_CANDIDATES_PER_RESULT = 3
+QUANTIZATION_RESCORE_FACTOR = 4
+PQ_SUBSPACES = 48
+PQ_TRAINING_ITERATIONS = 20
+PQ_TRAINING_SAMPLE = 20000
+BATCH_SCORE_MATRIX_SIZE = 1 << 22
 
 DEFAULT_SEARCH_LIMIT = 5
 DEFAULT_CHUNK_SIZE = 5
@@ -10,9 +51,24 @@ DEFAULT_SEMANTIC_CHUNK_SIZE = 4
 DEFAULT_ALPHA = 0.5
 DEFAULT_RRF_K = 60
 
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-TinyBERT-L2-v2"
+# torch, onnx or onnx-int8; the ONNX backends use the exports in EXPORTED_MODELS_DIR, see export_models
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+BACKEND_PARITY_MIN_COSINE = 0.99
+BACKEND_PARITY_SAMPLE = 256
+
 PROJECT_ROOT = os.path.dirname(os.path.dirname(__file__))
 DATA_PATH = os.path.join(PROJECT_ROOT, "data", "movies.json")
 STOPWORDS_PATH = os.path.join(PROJECT_ROOT, "data", "stopwords.txt")
 GOLDEN_DATASET_PATH = os.path.join(PROJECT_ROOT, "data", "golden_dataset.json")
 
-CACHE_DIR = os.path.join(PROJECT_ROOT, "cache")
\ No newline at end of file
+CACHE_DIR = os.path.join(PROJECT_ROOT, "cache")
+DOCUMENTS_PATH = os.path.join(CACHE_DIR, "documents.bin")
+INDEX_DIR = os.path.join(CACHE_DIR, "index")
+NEIGHBOURS_PATH = os.path.join(INDEX_DIR, "neighbours.bin")
+COMPLETIONS_PATH = os.path.join(INDEX_DIR, "completions.bin")
+SHARDS_DIR = os.path.join(CACHE_DIR, "shards")
+MODELS_DIR = os.path.join(PROJECT_ROOT, "models")
+EXPORTED_MODELS_DIR = os.path.join(CACHE_DIR, "models")
+QUERY_EMBEDDINGS_DIR = os.path.join(CACHE_DIR, "query_embeddings")
\ No newline at end of file
@@ -1,7 +1,8 @@
 import argparse
 
 from lib.hybrid_search import HybridSearch
-from utility import load_json, load_movies
+from utility import load_json
+from lib.document_store import load_document_store
 from constants import GOLDEN_DATASET_PATH, DEFAULT_RRF_K
 
 def main():
@@ -18,13 +19,16 @@ def main():
 
     golden_dataset = load_json(GOLDEN_DATASET_PATH)
 
-    movies = load_movies()
+    movies = load_document_store()
 
-    hybrid_search = HybridSearch(movies['movies'])
+    hybrid_search = HybridSearch(movies)
 
-    for test_case in golden_dataset['test_cases']:
+    # All queries are searched in one batch
+    test_cases = golden_dataset['test_cases']
+    all_results = hybrid_search.batch_rrf_search([test_case['query'] for test_case in test_cases], DEFAULT_RRF_K, limit)
+
+    for test_case, results in zip(test_cases, all_results):
         relevant_titles = test_case['relevant_docs']
-        results = hybrid_search.rrf_search(test_case['query'], DEFAULT_RRF_K, limit)
 
         found_titles = []
         found_relevant = 0
@@ -46,5 +50,8 @@ def main():
         print(f"  - Retrieved: {', '.join(found_titles)}")
         print(f"  - Relevant: {', '.join(relevant_titles)}\n")
 
+    stats = hybrid_search.semantic_search.query_embeddings.stats()
+    print(f"Query embedding cache: {stats['hit_rate'] * 100:.1f}% hits ({stats['memory_hits']} memory, {stats['disk_hits']} disk, {stats['misses']} encoded)")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import argparse
 from lib.hybrid_search import normalize_command, weighted_search_command, rrf_search_command
-from constants import DEFAULT_SEARCH_LIMIT, DEFAULT_ALPHA, DEFAULT_RRF_K
+from lib.sharded_search import build_shards_command
+from constants import DEFAULT_SEARCH_LIMIT, DEFAULT_ALPHA, DEFAULT_RRF_K, DEFAULT_SHARD_COUNT
 
 
 def main() -> None:
@@ -14,6 +15,7 @@ def main() -> None:
     weighted_search_parser.add_argument("query", type=str, help="Search-Query")
     weighted_search_parser.add_argument("--alpha", type=float, nargs='?', default=DEFAULT_ALPHA, help="Alpha-constant to weight search")
     weighted_search_parser.add_argument("--limit", type=int, nargs='?', default=DEFAULT_SEARCH_LIMIT, help="Number of returned search results")
+    weighted_search_parser.add_argument("--shards", type=int, nargs='?', help="Search the shards built with build-shards, served by one worker process each")
 
     rrf_search_parser = subparsers.add_parser("rrf-search", help="Reciprocal Rank Fusion Search")
     rrf_search_parser.add_argument("query", type=str, help="Search-Query")
@@ -22,6 +24,10 @@ def main() -> None:
     rrf_search_parser.add_argument("--enhance", type=str, nargs='?', choices=["spell", "rewrite", "expand"], help="Query enhancement method")
     rrf_search_parser.add_argument("--rerank-method", type=str, nargs='?', choices=["individual", "batch", "cross_encoder"], help="Result reranking method")
     rrf_search_parser.add_argument("--evaluate", help="Evaluate the search results", action="store_true")
+    rrf_search_parser.add_argument("--shards", type=int, nargs='?', help="Search the shards built with build-shards, served by one worker process each")
+
+    build_shards_parser = subparsers.add_parser("build-shards", help="Partition the keyword index into shards by document id")
+    build_shards_parser.add_argument("--shards", type=int, nargs='?', default=DEFAULT_SHARD_COUNT, help="Number of shards")
     
     args = parser.parse_args()
 
@@ -29,9 +35,11 @@ def main() -> None:
         case "normalize":
             normalize_command(args.scores)
         case "weighted-search":
-            weighted_search_command(args.query, args.alpha, args.limit)
+            weighted_search_command(args.query, args.alpha, args.limit, args.shards)
         case "rrf-search":
-            rrf_search_command(args.query, args.k, args.limit, args.enhance, args.rerank_method, args.evaluate)
+            rrf_search_command(args.query, args.k, args.limit, args.enhance, args.rerank_method, args.evaluate, args.shards)
+        case "build-shards":
+            build_shards_command(args.shards)
         case _:
             parser.print_help()
 
@@ -1,165 +1,839 @@
 import os
-import pickle
-from utility import load_movies, load_stopwords, tokenize
-from constants import DEFAULT_BM25_K1, DEFAULT_BM25_B, CACHE_DIR
+import glob
+import json
+import threading
+from utility import load_movies, load_stopwords
+from constants import DEFAULT_BM25_K1, DEFAULT_BM25_B, INDEX_DIR, WRITE_SEGMENT_MAX_DOCS, DOCUMENT_LOG_MAX_BYTES, QUERY_EXPANSION_WEIGHT, AUTOCOMPLETE_LIMIT, BATCH_SCORE_MATRIX_SIZE
+from lib.analyzer import Analyzer
+from lib.document_store import DocumentStore, append_document_updates, read_document_updates, read_fingerprint, write_documents
+from lib.block_max_wand import PostingCursor, block_max_wand
+from lib.index_format import MappedIndex, encode_index
+from lib.index_builder import build_postings, token_positions
+from lib.result_cache import ResultCache
+from lib.query_expansion import load_term_neighbours
+from lib.query_executor import QueryParser, execute
+from lib.spell_corrector import count_document_words, write_spell_index
+from lib.title_completion import TitleCompletions, write_title_completions
+from lib.near_duplicates import find_near_duplicates
+from lib.segments import Segment, find_merges, merge_segment_postings, read_manifest, write_manifest
 import collections
 import math
+import numpy as np
+
+def file_stamp(path: str) -> tuple[int, int, int] | None:
+    # Files are replaced atomically, so a rewrite changes the inode even within the timestamp granularity
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def saved_index_generation(index_dir: str) -> tuple:
+    """The saved_generation of an InvertedIndex loaded from index_dir: the manifest generation, which
+    every segment write bumps, the tombstone count of every segment, the fingerprint of the stored
+    documents and the size of their update log. All of them were stored when the index was saved,
+    nothing is hashed here."""
+    manifest = read_manifest(os.path.join(index_dir, "segments.json"))
+    fingerprint = read_fingerprint(os.path.join(index_dir, "documents.bin"))
+    return (manifest['generation'], tuple(len(entry['deleted']) for entry in manifest['segments']), fingerprint,
+            manifest.get('document_log_size', 0))
+
+def near_duplicate_clusters(movies: list[dict]) -> dict[int, list[int]]:
+    """Near-duplicate clusters of movies as representative doc_id -> member doc_ids, see find_near_duplicates()."""
+    duplicates = {}
+    for cluster in find_near_duplicates(movies):
+        duplicates[movies[cluster[0]]['id']] = [movies[position]['id'] for position in cluster[1:]]
+    if duplicates:
+        skipped = sum(len(members) for members in duplicates.values())
+        print(f"Near-duplicates: {skipped + len(duplicates)} of {len(movies)} documents in {len(duplicates)} clusters, "
+              f"indexing {len(movies) - skipped} documents ({skipped * 100 / len(movies):.1f}% fewer)")
+    return duplicates
 
 class InvertedIndex:
 
-    def __init__(self) -> None:
-        self.index = {}
-        self.docmap = {}
-        self.term_frequencies = {}
-        self.doc_lengths = {}
-        self.stopwords = load_stopwords()   
-        self.index_path = os.path.join(CACHE_DIR, "index.pkl")
-
-    def __add_document(self, doc_id: int, text: str) -> None:
-        
-        tokens = tokenize(text, self.stopwords)
-        self.doc_lengths[doc_id] = len(tokens)        
-        self.term_frequencies[doc_id] = collections.Counter()
-        for token in tokens:            
-            if token in self.index:
-                if doc_id not in self.index[token]:
-                    self.index[token].append(doc_id)
-            else:
-                self.index[token] = [doc_id]
-            self.term_frequencies[doc_id][token] += 1        
-        for entry in self.index:
-            self.index[entry] = sorted(self.index[entry])
-
-    def __get_avg_doc_length(self) -> float:
-        if len(self.doc_lengths) > 0:
-            total_token_count = 0
-            for entry in self.doc_lengths:
-                total_token_count += self.doc_lengths[entry]
-            return total_token_count / len(self.doc_lengths)
-        else:
-            return 0.0
+    def __init__(self, positional: bool = True, index_dir: str = INDEX_DIR) -> None:
+        # Movie records of the index: documents.bin, the changes saved to the update log since it was
+        # written and the changes since the last save(), both doc_id -> movie, or None if deleted.
+        # The log is folded into documents.bin when segments are merged.
+        self.documents = DocumentStore.from_documents([])
+        self.saved_updates = {}
+        self.document_updates = {}
+        self.documents_saved = True
+        self.document_log_size = 0
+        # Store token positions in new segments, needed for phrase and proximity queries
+        self.positional = positional
+        # Immutable segments, oldest first. Segments whose name is None have not been saved yet.
+        self.segments = []
+        self.generation = 0
+        # In-memory write segment: doc_id -> (doc length, token positions)
+        self.pending_documents = {}
+        self.pending_segment = None
+        self.lock = threading.RLock()
+        # Bumped on every change that can alter search results, it is the generation of result_cache while
+        # there are unsaved changes. Otherwise that is saved_generation, which other processes share.
+        self.revision = 0
+        self.saved_generation = None
+        self.manifest_stamp = None
+        self.result_cache = ResultCache()
+        self.merge_thread = None
+        self.stopwords = load_stopwords()
+        self.analyzer = Analyzer(self.stopwords)
+        # A shard of a sharded index lives in its own directory
+        self.index_dir = index_dir
+        self.index_path = os.path.join(index_dir, "segments.json")
+        self.documents_path = os.path.join(index_dir, "documents.bin")
+        self.document_log_path = os.path.join(index_dir, "document_updates.jsonl")
+        self.spelling_path = os.path.join(index_dir, "spelling.bin")
+        self.completions_path = os.path.join(index_dir, "completions.bin")
+        # Title prefix index of documents.bin, rebuilt with it
+        self.completions = TitleCompletions.from_documents([])
+        # Near-duplicate clusters found by build(): only the representative is indexed and its
+        # members are added back to its results. representative doc_id -> member doc_ids and back
+        self.duplicates = {}
+        self.duplicate_of = {}
+        self.duplicates_path = os.path.join(index_dir, "duplicates.json")
+        self.result_cache_path = os.path.join(index_dir, "result_cache.json")
+        # Opened on the first expanded query; shards share the neighbours of the whole vocabulary
+        self.term_neighbours = None
+        self.term_neighbours_loaded = False
+
+    def __get_single_token(self, term: str) -> str:
+        tokens = self.analyzer.analyze(term)
+        if len(tokens) != 1:
+            raise ValueError("term must be a single token")
+        return tokens[0]
 
+    def __encode_pending(self) -> bytes:
+        doc_lengths = {}
+        postings = {}
+        for doc_id in sorted(self.pending_documents):
+            doc_length, positions = self.pending_documents[doc_id]
+            doc_lengths[doc_id] = doc_length
+            for token, token_positions in positions.items():
+                if token in postings:
+                    postings[token].append((doc_id, len(token_positions), token_positions))
+                else:
+                    postings[token] = [(doc_id, len(token_positions), token_positions)]
+        return encode_index(doc_lengths, sorted(postings.items()), self.positional)
+
+    def __searchable_segments(self) -> list[Segment]:
+        with self.lock:
+            if not self.pending_documents:
+                return list(self.segments)
+            # The write segment is encoded on demand and reused until the next modification
+            if self.pending_segment is None:
+                self.pending_segment = Segment(MappedIndex(self.__encode_pending()))
+            return self.segments + [self.pending_segment]
+
+    def __collection_statistics(self, segments: list[Segment]) -> tuple[int, float]:
+        doc_count, total_length = self.__collection_totals(segments)
+        return doc_count, total_length / doc_count if doc_count > 0 else 0.0
+
+    def __collection_totals(self, segments: list[Segment]) -> tuple[int, int]:
+        # Statistics span every segment and, as in most segmented engines, keep counting deleted
+        # documents until a merge expunges them
+        doc_count = sum(segment.reader.doc_count for segment in segments)
+        total_length = sum(round(segment.reader.avg_doc_length * segment.reader.doc_count) for segment in segments)
+        return doc_count, total_length
+
+    def __document_frequency(self, segments: list[Segment], token: str) -> int:
+        term_doc_count = 0
+        for segment in segments:
+            term_id = segment.reader.term_id(token)
+            if term_id is not None:
+                term_doc_count += segment.reader.doc_frequencies[term_id]
+        return term_doc_count
+
+    def __locate(self, doc_id: int) -> tuple[Segment, int] | None:
+        for segment in self.__searchable_segments():
+            ordinal = segment.contains(doc_id)
+            if ordinal is not None:
+                return segment, ordinal
+        return None
 
     def get_documents(self, term: str) -> list[int]:
-        if term in self.index:
-            return self.index[term]
-        else:
-            return []
-        
+        doc_ids = []
+        for segment in self.__searchable_segments():
+            term_id = segment.reader.term_id(term)
+            if term_id is not None:
+                doc_ids.extend(segment.reader.doc_ids[ordinal] for ordinal in segment.reader.term_ordinals(term_id) if ordinal not in segment.deleted)
+        return sorted(doc_ids)
+
     def get_tf(self, doc_id: int, term: str) -> int:
-        if doc_id in self.term_frequencies:
-            tokens = tokenize(term, self.stopwords)
-            if len(tokens) != 1:
-                raise Exception("Error: Must supply exactly one search term")
-            else:                
-                return self.term_frequencies[doc_id][tokens[0]] if tokens[0] in self.term_frequencies[doc_id] else 0
+        location = self.__locate(doc_id)
+        if location is not None:
+            segment, ordinal = location
+            term_id = segment.reader.term_id(self.__get_single_token(term))
+            position = segment.reader.posting_position(term_id, ordinal) if term_id is not None else None
+            return segment.reader.frequencies[position] if position is not None else 0
         else:
             return 0
 
-    def get_idf(self, term: str) -> float:        
-        tokens = tokenize(term, self.stopwords)
-        if len(tokens) != 1:
-            raise Exception("Error: Must supply exactly one serch term")
-        else:
-            term_match_doc_count = 0
-            total_doc_count = 0
-            for entry in self.docmap:
-                if self.get_tf(entry, term) > 0:
-                    term_match_doc_count += 1
-                total_doc_count += 1
-            
-            return math.log((total_doc_count + 1) / (term_match_doc_count + 1))
+    def get_idf(self, term: str) -> float:
+        token = self.__get_single_token(term)
+        segments = self.__searchable_segments()
+        doc_count, _ = self.__collection_statistics(segments)
+        term_match_doc_count = self.__document_frequency(segments, token)
+        return math.log((doc_count + 1) / (term_match_doc_count + 1))
 
     def get_tfidf(self, doc_id: int, term: str) -> float:
-        tokens = tokenize(term, self.stopwords)
-        if len(tokens) != 1:
-            raise Exception("Error: Must supply exactly one search term")
-        else:
-            try:
-                return self.get_tf(doc_id, term) * self.get_idf(term)
-            except Exception as e:
-                print("Error: TFIDF could not be calculated")
+        self.__get_single_token(term)
+        try:
+            return self.get_tf(doc_id, term) * self.get_idf(term)
+        except Exception as e:
+            print("Error: TFIDF could not be calculated")
 
     def get_bm25_idf(self, term: str) -> float:
-        tokens = tokenize(term, self.stopwords)
-        if len(tokens) != 1:
-            raise ValueError("term must be a single token")
-        token = tokens[0]
-        doc_count = len(self.docmap)
-        if token in self.index:
-            term_doc_count = len(self.index[token])
-        else:
-            term_doc_count = 0
+        token = self.__get_single_token(term)
+        segments = self.__searchable_segments()
+        doc_count, _ = self.__collection_statistics(segments)
+        term_doc_count = self.__document_frequency(segments, token)
         return math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
 
     def get_bm25_tf(self, doc_id: int, term: str, k1: float = DEFAULT_BM25_K1, b: float = DEFAULT_BM25_B) -> float:
-        if doc_id in self.doc_lengths:
-            doc_length = self.doc_lengths[doc_id]
+        location = self.__locate(doc_id)
+        if location is not None:
+            segment, ordinal = location
+            doc_length = segment.reader.doc_lengths[ordinal]
         else:
             doc_length = 0
-        
-        # Length normalization factor        
-        length_norm = 1 - b + b * (doc_length / self.__get_avg_doc_length())        
+
+        # Length normalization factor
+        _, avg_doc_length = self.__collection_statistics(self.__searchable_segments())
+        # An empty collection, or one whose documents were all deleted, has no average length to normalize by
+        length_norm = 1 - b + b * (doc_length / avg_doc_length) if avg_doc_length > 0 else 1.0
         tf = self.get_tf(doc_id, term)
-                         
+
         # Apply to term frequency
         tf_component = (tf * (k1 + 1)) / (tf + k1 * length_norm)
         return tf_component
 
     def bm25(self, doc_id: int, term: str) -> float:
-        bm25_idf = self.get_bm25_idf(term)
-        bm25_tf = self.get_bm25_tf(doc_id, term)        
-        return bm25_idf * bm25_tf
-    
-    def bm25_search(self, query: str, limit: int = 5) -> list[dict]:
-        tokens = tokenize(query, self.stopwords)
+        return self.get_bm25_idf(term) * self.get_bm25_tf(doc_id, term)
+
+    def get_document(self, doc_id: int) -> dict | None:
+        if doc_id in self.document_updates:
+            return self.document_updates[doc_id]
+        if doc_id in self.saved_updates:
+            return self.saved_updates[doc_id]
+        return self.documents.get(doc_id)
+
+    def has_document(self, doc_id: int) -> bool:
+        if doc_id in self.document_updates:
+            return self.document_updates[doc_id] is not None
+        if doc_id in self.saved_updates:
+            return self.saved_updates[doc_id] is not None
+        return self.documents.contains(doc_id)
+
+    def vocabulary(self, min_document_frequency: int = 1) -> dict[str, int]:
+        """Return {token: document frequency} of every indexed token in at least min_document_frequency documents."""
+        frequencies = collections.Counter()
+        for segment in self.__searchable_segments():
+            reader = segment.reader
+            for term_id in range(reader.term_count):
+                frequencies[reader.term(term_id)] += reader.doc_frequencies[term_id]
+        return {token: frequency for token, frequency in frequencies.items() if frequency >= min_document_frequency}
+
+    def expand_query(self, query: str, expansion: int = 0, expansion_weight: float = QUERY_EXPANSION_WEIGHT) -> dict[str, float]:
+        """Return the BM25 weight of every token of query, plus up to `expansion` precomputed
+        neighbour terms per token, each weighted by expansion_weight times its similarity."""
+        tokens = self.analyzer.analyze(query)
+        if expansion > 0 and not self.term_neighbours_loaded:
+            self.term_neighbours = load_term_neighbours()
+            self.term_neighbours_loaded = True
+        if expansion <= 0 or self.term_neighbours is None:
+            return {token: float(count) for token, count in collections.Counter(tokens).items()}
+        return self.term_neighbours.expand(tokens, expansion, expansion_weight)
+
+    def complete(self, prefix: str, limit: int = AUTOCOMPLETE_LIMIT) -> list[dict]:
+        """Return the top `limit` title completions of prefix as {'id', 'title'} dicts.
+
+        Documents added since the last merge are not completed until the update log is folded into
+        the store; deleted and retitled ones are skipped.
+        """
+        candidate_count = limit
+        while True:
+            results = self.completions.complete(prefix, candidate_count)
+            current = [result for result in results if self.__is_current_title(result)]
+            if len(current) >= limit or len(results) < candidate_count:
+                return current[:limit]
+            candidate_count *= 2
+
+    def __is_current_title(self, result: dict) -> bool:
+        with self.lock:
+            if result['id'] not in self.document_updates and result['id'] not in self.saved_updates:
+                return True
+            document = self.get_document(result['id'])
+        return document is not None and document['title'] == result['title']
+
+    def term_statistics(self, query: str, expansion: int = 0, expansion_weight: float = QUERY_EXPANSION_WEIGHT) -> tuple[int, int, dict[str, int]]:
+        """Return (doc_count, total doc length, {token: document frequency}) for the tokens of
+        query, including its expansion terms.
+
+        Summed over the shards of a sharded index these give the statistics of the whole corpus.
+        """
+        segments = self.__searchable_segments()
+        doc_count, total_length = self.__collection_totals(segments)
+        return doc_count, total_length, {token: self.__document_frequency(segments, token) for token in self.expand_query(query, expansion, expansion_weight)}
+
+    def batch_term_statistics(self, queries: list[str], expansion: int = 0, expansion_weight: float = QUERY_EXPANSION_WEIGHT) -> tuple[int, int, dict[str, int]]:
+        """term_statistics() of all tokens of a batch of queries in one tuple."""
+        segments = self.__searchable_segments()
+        doc_count, total_length = self.__collection_totals(segments)
+        tokens = {token for query in queries for token in self.expand_query(query, expansion, expansion_weight)}
+        return doc_count, total_length, {token: self.__document_frequency(segments, token) for token in tokens}
+
+    def has_unsaved_changes(self) -> bool:
+        with self.lock:
+            return bool(self.pending_documents or self.document_updates) or not self.documents_saved or \
+                any(segment.name is None for segment in self.segments)
+
+    def cache_generation(self):
+        """Generation of the result cache: saved_generation, the state of the index on disk, unless
+        there are unsaved changes. An index another process saved since is loaded first."""
+        with self.lock:
+            if self.has_unsaved_changes():
+                return ("unsaved", self.revision)
+            if self.saved_generation is not None:
+                stamp = file_stamp(self.index_path)
+                if stamp is not None and stamp != self.manifest_stamp:
+                    self.manifest_stamp = stamp
+                    self.load()
+            return self.saved_generation
+
+    def __record_saved_state(self) -> None:
+        # Called with the lock held, right after this process read or wrote the manifest. The documents
+        # fingerprint comes from the header of documents.bin, written with it.
+        self.saved_generation = (self.generation, tuple(len(segment.deleted) for segment in self.segments if segment.name is not None),
+                                 self.documents.fingerprint(), self.document_log_size)
+        self.manifest_stamp = file_stamp(self.index_path)
+
+    def save_result_cache(self) -> None:
+        """Write the cached results to disk for other processes, unless they are results of unsaved changes."""
+        try:
+            with self.lock:
+                if self.saved_generation is not None and self.result_cache.generation == self.saved_generation:
+                    self.result_cache.save(self.result_cache_path)
+        except Exception as e:
+            print(f"Error: {e}")
+
+    def bm25_search(self, query: str, limit: int = 5, exhaustive: bool = False, k1: float = DEFAULT_BM25_K1, b: float = DEFAULT_BM25_B, with_documents: bool = True, statistics: tuple[int, int, dict[str, int]] | None = None, expansion: int = 0, expansion_weight: float = QUERY_EXPANSION_WEIGHT) -> list[dict]:
+        """Return the top `limit` movies by BM25 score.
+
+        statistics, as returned by term_statistics() and summed over all shards, replaces the
+        collection statistics of this index, so the scores of a shard match an unsharded index.
+        With expansion > 0 the query is expanded by that many neighbour terms per token, see
+        expand_query().
+        """
+        tokens = self.analyzer.analyze(query)
+        token_weights = self.expand_query(query, expansion, expansion_weight) if expansion > 0 else None
+        with self.lock:
+            generation = self.cache_generation()
+            segments = self.__searchable_segments()
+
+        key = (tuple(tokens), limit, exhaustive, k1, b)
+        if token_weights is not None:
+            key += (tuple(sorted(token_weights.items())),)
+        if statistics is not None:
+            key += (statistics[0], statistics[1], tuple(sorted(statistics[2].items())))
+        sorted_scores = self.result_cache.get(key, generation)
+        if sorted_scores is None:
+            if statistics is not None or token_weights is not None:
+                # Fractional weights of expansion terms are not covered by the stored impacts
+                sorted_scores = self.__vectorized_top_k(segments, token_weights or collections.Counter(tokens), limit, k1, b, statistics)
+            else:
+                sorted_scores = self.__rank(segments, tokens, limit, exhaustive, k1, b)
+            sorted_scores = self.__expand_duplicates(sorted_scores, limit)
+            self.result_cache.put(key, generation, sorted_scores)
+
+        # Movie records are only fetched for the ranked results, and not at all if the caller fuses them first
         scores = []
+        for doc_id, score in sorted_scores:
+            if with_documents:
+                scores.append({'doc_id': doc_id, 'score': score, 'movie': self.get_document(doc_id)})
+            else:
+                scores.append({'doc_id': doc_id, 'score': score})
+        return scores
 
-        for doc_id in self.docmap:            
-            score = 0
+    def batch_bm25_search(self, queries: list[str], limit: int = 5, k1: float = DEFAULT_BM25_K1, b: float = DEFAULT_BM25_B, with_documents: bool = True,
+                          statistics: tuple[int, int, dict[str, int]] | None = None, expansion: int = 0, expansion_weight: float = QUERY_EXPANSION_WEIGHT) -> list[list[dict]]:
+        """Return the bm25_search() results of every query.
+
+        The queries are scored together, as the sparse product of their query-term matrix with the
+        term-document matrix of the terms they contain, so the postings of a term that several
+        queries share are decoded and normalized once. statistics, as returned by
+        batch_term_statistics() and summed over all shards, covers the tokens of all queries.
+        """
+        token_weights = [self.expand_query(query, expansion, expansion_weight) for query in queries]
+        with self.lock:
+            generation = self.cache_generation()
+            segments = self.__searchable_segments()
+
+        keys = []
+        for query, weights in zip(queries, token_weights):
+            key = ("batch", tuple(self.analyzer.analyze(query)), limit, k1, b)
+            if expansion > 0:
+                key += (tuple(sorted(weights.items())),)
+            if statistics is not None:
+                key += (statistics[0], statistics[1], tuple(sorted((token, statistics[2].get(token, 0)) for token in weights)))
+            keys.append(key)
+
+        all_scores = [self.result_cache.get(key, generation) for key in keys]
+        missing = [i for i, sorted_scores in enumerate(all_scores) if sorted_scores is None]
+        if missing:
+            ranked = self.__batch_top_k(segments, [token_weights[i] for i in missing], limit, k1, b, statistics)
+            for i, sorted_scores in zip(missing, ranked):
+                all_scores[i] = self.__expand_duplicates(sorted_scores, limit)
+                self.result_cache.put(keys[i], generation, all_scores[i])
+
+        results = []
+        for sorted_scores in all_scores:
+            if with_documents:
+                results.append([{'doc_id': doc_id, 'score': score, 'movie': self.get_document(doc_id)} for doc_id, score in sorted_scores])
+            else:
+                results.append([{'doc_id': doc_id, 'score': score} for doc_id, score in sorted_scores])
+        return results
+
+    def __batch_top_k(self, segments: list[Segment], token_weights: list[dict[str, float]], limit: int, k1: float, b: float,
+                      statistics: tuple[int, int, dict[str, int]] | None = None) -> list[list[tuple[int, float]]]:
+        tokens = {token for weights in token_weights for token in weights}
+        if statistics is None:
+            doc_count, avg_doc_length = self.__collection_statistics(segments)
+        else:
+            doc_count, total_length, document_frequencies = statistics
+            avg_doc_length = total_length / doc_count if doc_count > 0 else 0.0
+        idfs = {}
+        for token in tokens:
+            term_doc_count = self.__document_frequency(segments, token) if statistics is None else document_frequencies.get(token, 0)
+            idfs[token] = math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+
+        doc_id_rows = [[] for _ in token_weights]
+        score_rows = [[] for _ in token_weights]
+        for segment in segments:
+            reader = segment.reader
+            # Term-document matrix rows of the batch's terms: the saturated term frequency of every posting
+            term_rows = {}
             for token in tokens:
-                score += self.bm25(doc_id, token)
-                    
-            scores.append({'doc_id': doc_id, 'score': score, 'movie': self.docmap[doc_id]})
-            
-        sorted_scores = sorted(scores, key=lambda d: d['score'], reverse=True)
-        return sorted_scores[0:min(len(scores), limit)]          
-
-    def build(self) -> None:
-        movies = load_movies()
-        self.index.clear()
-        self.docmap.clear()
-        count = 0
-        for movie in movies['movies']:
-            count += 1
-            self.docmap[movie['id']] = movie
-            self.__add_document(movie['id'], f"{movie['title']} {movie['description']}")            
-            if count % 100 == 0:
-                print(f"{(count * 100)/len(movies['movies'])}%")
+                term_id = reader.term_id(token)
+                if term_id is None:
+                    continue
+                ordinals, frequencies = reader.term_row(term_id)
+                tf = frequencies.astype(np.float64)
+                length_norms = 1 - b + b * (reader.doc_lengths_array[ordinals] / avg_doc_length) if avg_doc_length > 0 else np.ones(len(ordinals))
+                term_rows[token] = (ordinals, tf * (k1 + 1) / (tf + k1 * length_norms))
+            if not term_rows:
+                continue
+
+            # Queries are accumulated in blocks whose dense score matrix stays below BATCH_SCORE_MATRIX_SIZE entries
+            doc_total = reader.doc_count
+            block_size = max(1, BATCH_SCORE_MATRIX_SIZE // max(doc_total, 1))
+            deleted = segment.deleted_ordinals_array() if segment.deleted else None
+            for start in range(0, len(token_weights), block_size):
+                cell_rows = []
+                impact_rows = []
+                block = token_weights[start:start + block_size]
+                for row, weights in enumerate(block):
+                    for token, weight in weights.items():
+                        if token in term_rows:
+                            ordinals, saturated = term_rows[token]
+                            cell_rows.append(row * doc_total + ordinals)
+                            impact_rows.append(weight * idfs[token] * saturated)
+                if not cell_rows:
+                    continue
+                scores = np.bincount(np.concatenate(cell_rows), weights=np.concatenate(impact_rows), minlength=len(block) * doc_total).reshape(len(block), doc_total)
+                if deleted is not None:
+                    scores[:, deleted] = 0
+                for row, query_scores in enumerate(scores):
+                    # Every matching document scores above zero
+                    candidates = np.flatnonzero(query_scores)
+                    doc_id_rows[start + row].append(reader.doc_ids_array[candidates].astype(np.int64))
+                    score_rows[start + row].append(query_scores[candidates])
+
+        results = []
+        for doc_id_row, score_row in zip(doc_id_rows, score_rows):
+            if not doc_id_row:
+                results.append([])
+                continue
+            doc_ids = np.concatenate(doc_id_row)
+            scores = np.concatenate(score_row)
+            ranking = np.lexsort((doc_ids, -scores))[:limit]
+            results.append([(int(doc_ids[i]), float(scores[i])) for i in ranking])
+        return results
+
+    def __rank(self, segments: list[Segment], tokens: list[str], limit: int, exhaustive: bool, k1: float, b: float) -> list[tuple[int, float]]:
+        if len(segments) == 1 and k1 == segments[0].reader.k1 and b == segments[0].reader.b:
+            # With a single segment the stored impacts were computed from the collection statistics
+            segment = segments[0]
+            if exhaustive:
+                ranked = self.__exhaustive_top_k(segment, tokens, limit)
+            else:
+                ranked = self.__block_max_wand_top_k(segment, tokens, limit)
+            return [(segment.reader.doc_ids[ordinal], score) for ordinal, score in ranked]
+        else:
+            return self.__vectorized_top_k(segments, collections.Counter(tokens), limit, k1, b)
+
+    def boolean_search(self, query: str, limit: int = 5) -> list[dict]:
+        """Return the movies matching a boolean/phrase/proximity query, in doc_id order with
+        near-duplicates directly after their representative."""
+        doc_ids = execute(QueryParser(self.analyzer).parse(query), self.__searchable_segments(), limit)
+        return [self.get_document(doc_id) for doc_id, _ in self.__expand_duplicates([(doc_id, None) for doc_id in doc_ids], limit)]
+
+    def __expand_duplicates(self, results: list[tuple[int, float]], limit: int) -> list[tuple[int, float]]:
+        # Members share the representative's score, so the expanded list stays sorted
+        if not self.duplicates:
+            return results
+        expanded = []
+        for doc_id, score in results:
+            expanded.append((doc_id, score))
+            expanded.extend((member, score) for member in self.duplicates.get(doc_id, ()))
+        return expanded[:limit]
+
+    def __exhaustive_top_k(self, segment: Segment, tokens: list[str], limit: int) -> list[tuple[int, float]]:
+        reader = segment.reader
+        accumulators = {}
+
+        # Term-at-a-time: only documents on the posting lists of the query terms are ever touched
+        for token in tokens:
+            term_id = reader.term_id(token)
+            if term_id is None:
+                continue
+            impacts = reader.impacts[reader.posting_starts[term_id]:reader.posting_starts[term_id + 1]]
+            for ordinal, impact in zip(reader.term_ordinals(term_id), impacts):
+                accumulators[ordinal] = accumulators.get(ordinal, 0.0) + impact
+
+        for ordinal in segment.deleted:
+            accumulators.pop(ordinal, None)
+
+        return sorted(accumulators.items(), key=lambda d: (-d[1], d[0]))[0:limit]
+
+    def __vectorized_top_k(self, segments: list[Segment], token_weights: dict[str, float], limit: int, k1: float, b: float, statistics: tuple[int, int, dict[str, int]] | None = None) -> list[tuple[int, float]]:
+        if statistics is None:
+            doc_count, avg_doc_length = self.__collection_statistics(segments)
+        else:
+            doc_count, total_length, document_frequencies = statistics
+            avg_doc_length = total_length / doc_count if doc_count > 0 else 0.0
+        idfs = {}
+        for token in token_weights:
+            term_doc_count = self.__document_frequency(segments, token) if statistics is None else document_frequencies.get(token, 0)
+            idfs[token] = math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+
+        doc_id_rows = []
+        score_rows = []
+        for segment in segments:
+            reader = segment.reader
+            ordinal_rows = []
+            weight_rows = []
+            frequency_rows = []
+
+            # Gather the matrix rows of the query terms, everything after that is array arithmetic
+            for token, weight in token_weights.items():
+                term_id = reader.term_id(token)
+                if term_id is None:
+                    continue
+                ordinals, frequencies = reader.term_row(term_id)
+                ordinal_rows.append(ordinals)
+                frequency_rows.append(frequencies)
+                weight_rows.append(np.full(len(ordinals), weight * idfs[token]))
+
+            if not ordinal_rows:
+                continue
+
+            ordinals = np.concatenate(ordinal_rows)
+            tf = np.concatenate(frequency_rows).astype(np.float64)
+            length_norms = 1 - b + b * (reader.doc_lengths_array[ordinals] / avg_doc_length) if avg_doc_length > 0 else np.ones(len(ordinals))
+            impacts = np.concatenate(weight_rows) * (tf * (k1 + 1)) / (tf + k1 * length_norms)
+
+            candidates, candidate_index = np.unique(ordinals, return_inverse=True)
+            scores = np.bincount(candidate_index, weights=impacts)
+            if segment.deleted:
+                live = ~np.isin(candidates, segment.deleted_ordinals_array())
+                candidates, scores = candidates[live], scores[live]
+
+            doc_id_rows.append(reader.doc_ids_array[candidates].astype(np.int64))
+            score_rows.append(scores)
+
+        if not doc_id_rows:
+            return []
+
+        doc_ids = np.concatenate(doc_id_rows)
+        scores = np.concatenate(score_rows)
+        ranking = np.lexsort((doc_ids, -scores))[:limit]
+        return [(int(doc_ids[i]), float(scores[i])) for i in ranking]
+
+    def __block_max_wand_top_k(self, segment: Segment, tokens: list[str], limit: int) -> list[tuple[int, float]]:
+        cursors = {}
+        for token, weight in collections.Counter(tokens).items():
+            term_id = segment.reader.term_id(token)
+            if term_id is not None:
+                cursors[token] = PostingCursor(segment.reader, term_id, weight)
+
+        return block_max_wand(cursors, tokens, limit, segment.deleted)
+
+    def add_document(self, movie: dict) -> None:
+        """Index a movie, replacing the indexed version of any movie with the same id."""
+        with self.lock:
+            self.__detach_duplicates(movie['id'])
+            self.__delete_live_document(movie['id'])
+            self.__index_document(movie)
+            self.document_updates[movie['id']] = movie
+            self.revision += 1
+
+    def __index_document(self, movie: dict) -> None:
+        tokens = self.analyzer.analyze(f"{movie['title']} {movie['description']}")
+        self.pending_documents[movie['id']] = (len(tokens), token_positions(tokens))
+        self.pending_segment = None
+        if len(self.pending_documents) >= WRITE_SEGMENT_MAX_DOCS:
+            self.flush()
+
+    def __detach_duplicates(self, doc_id: int) -> bool:
+        # A changed or deleted movie leaves its near-duplicate cluster. If it was the representative,
+        # the members are no longer covered by it and get indexed on their own.
+        representative = self.duplicate_of.pop(doc_id, None)
+        if representative is not None:
+            self.duplicates[representative].remove(doc_id)
+            if not self.duplicates[representative]:
+                del self.duplicates[representative]
+            return True
+        for member in self.duplicates.pop(doc_id, ()):
+            del self.duplicate_of[member]
+            self.__index_document(self.get_document(member))
+        return False
+
+    def delete_document(self, doc_id: int) -> bool:
+        with self.lock:
+            if self.has_document(doc_id):
+                self.document_updates[doc_id] = None
+            self.revision += 1
+            # A cluster member is not in the postings, only in the cluster
+            detached = self.__detach_duplicates(doc_id)
+            return self.__delete_live_document(doc_id) or detached
+
+    def __delete_live_document(self, doc_id: int) -> bool:
+        if doc_id in self.pending_documents:
+            del self.pending_documents[doc_id]
+            self.pending_segment = None
+            return True
+        for segment in self.segments:
+            if segment.delete(doc_id):
+                return True
+        return False
+
+    def flush(self) -> None:
+        """Seal the write segment into an immutable segment; it is written to disk by the next save()."""
+        with self.lock:
+            if self.pending_documents:
+                self.segments.append(Segment(MappedIndex(self.__encode_pending())))
+                self.pending_documents = {}
+                self.pending_segment = None
+
+    def __write_segment(self, buffer) -> str:
+        self.generation += 1
+        name = f"segment_{self.generation:06d}.bin"
+        path = os.path.join(self.index_dir, name)
+        with open(f"{path}.tmp", "wb") as segment_file:
+            segment_file.write(buffer)
+        os.replace(f"{path}.tmp", path)
+        return name
+
+    def __remove_unreferenced_segments(self) -> None:
+        # Processes that still have a removed segment mapped keep reading it until they reload
+        referenced = {segment.name for segment in self.segments}
+        for path in glob.glob(os.path.join(self.index_dir, "segment_*.bin")):
+            if os.path.basename(path) not in referenced:
+                os.remove(path)
+
+    def maybe_merge(self, background: bool = True) -> None:
+        """Merge the segments picked by the merge policy, on a background thread unless told otherwise."""
+        with self.lock:
+            if self.merge_thread is not None and self.merge_thread.is_alive():
+                return
+            candidates = find_merges(self.segments)
+            if not candidates:
+                return
+            self.merge_thread = threading.Thread(target=self.__merge, args=(candidates,), name="segment-merge")
+            self.merge_thread.start()
+        if not background:
+            self.wait_for_merges()
+
+    def force_merge(self) -> None:
+        """Merge every saved segment into one, expunging all deleted documents."""
+        self.wait_for_merges()
+        with self.lock:
+            candidates = [segment for segment in self.segments if segment.name is not None]
+        if len(candidates) > 1 or any(segment.deleted for segment in candidates):
+            self.__merge(candidates, cascade=False)
+            return
+        with self.lock:
+            if self.saved_updates:
+                self.__compact_documents()
+                self.__write_manifest()
+
+    def wait_for_merges(self) -> None:
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+
+    def __merge(self, candidates: list[Segment], cascade: bool = True) -> None:
+        while candidates:
+            # Merge from frozen tombstones without holding the lock, queries and writes continue meanwhile
+            with self.lock:
+                frozen = [segment.snapshot() for segment in candidates]
+            doc_lengths = {}
+            for segment in frozen:
+                doc_lengths.update(segment.live_doc_lengths())
+            # A merged segment keeps positions only if every input has them
+            positional = self.positional and all(segment.reader.positional for segment in frozen)
+            buffer = encode_index(doc_lengths, merge_segment_postings(frozen), positional)
+
+            with self.lock:
+                if any(segment not in self.segments for segment in candidates):
+                    # The index was rebuilt or reloaded while merging
+                    return
+
+                merged = []
+                if doc_lengths:
+                    name = self.__write_segment(buffer)
+                    merged.append(Segment(MappedIndex.open(os.path.join(self.index_dir, name)), name))
+                    # Re-apply the deletes that arrived while the merge was running
+                    for segment, snapshot in zip(candidates, frozen):
+                        for ordinal in segment.deleted - snapshot.deleted:
+                            merged[0].delete(segment.reader.doc_ids[ordinal])
+
+                position = self.segments.index(candidates[0])
+                remaining = [segment for segment in self.segments if segment not in candidates]
+                self.segments = remaining[:position] + merged + remaining[position:]
+                # Expunged documents no longer count towards the collection statistics
+                self.revision += 1
+                if self.saved_updates and (not cascade or self.document_log_size > DOCUMENT_LOG_MAX_BYTES):
+                    self.__compact_documents()
+                self.__write_manifest()
+                self.__remove_unreferenced_segments()
+
+                candidates = find_merges(self.segments) if cascade else []
+
+    def build(self, movies: list[dict] | None = None, deduplicate: bool = True, duplicates: dict[int, list[int]] | None = None) -> None:
+        """Index the given movies, or the whole dataset if movies is None, replacing the current index.
+
+        With deduplicate, only one representative of every cluster of near-duplicate movies is
+        indexed; the others are returned together with it. duplicates, clusters found over a larger
+        collection by near_duplicate_clusters(), is used instead: cluster members among movies are
+        not indexed, and representatives among them return their members wherever those are stored.
+        """
+        if movies is None:
+            movies = load_movies()['movies']
+        if duplicates is not None:
+            duplicates = {representative: list(members) for representative, members in duplicates.items()}
+        else:
+            duplicates = near_duplicate_clusters(movies) if deduplicate else {}
+        duplicate_of = {member: representative for representative, members in duplicates.items() for member in members}
+
+        documents = []
+        for movie in movies:
+            if movie['id'] not in duplicate_of:
+                documents.append((movie['id'], f"{movie['title']} {movie['description']}"))
+
+        doc_lengths, postings = build_postings(documents, self.stopwords)
+
+        # A full build replaces every segment; it is served from memory until save() writes it to disk
+        segment = Segment(MappedIndex(encode_index(doc_lengths, postings, self.positional)))
+        with self.lock:
+            self.segments = [segment]
+            self.pending_documents = {}
+            self.pending_segment = None
+            self.documents = DocumentStore.from_documents(movies)
+            self.completions = TitleCompletions.from_documents(movies)
+            self.duplicates = duplicates
+            self.duplicate_of = duplicate_of
+            self.saved_updates = {}
+            self.document_updates = {}
+            self.documents_saved = False
+            self.revision += 1
+
+    def __write_manifest(self) -> None:
+        write_manifest(self.index_path, self.generation, self.segments, self.document_log_size)
+        if self.saved_generation is not None and not self.has_unsaved_changes():
+            self.__record_saved_state()
+
+    def __compact_documents(self) -> None:
+        # Called with the lock held and followed by a manifest write. Replaying the log over the new
+        # documents.bin is harmless, so a crash in between loses nothing.
+        write_documents(self.documents_path, self.__live_documents())
+        self.documents = DocumentStore.open(self.documents_path)
+        self.saved_updates = {}
+        self.document_log_size = 0
+        self.documents_saved = True
+        # The spelling dictionary and title completions follow the document set they were built from
+        write_spell_index(self.spelling_path, count_document_words(self.documents))
+        write_title_completions(self.completions_path, self.documents)
+        self.completions = TitleCompletions.open(self.completions_path)
 
     def save(self) -> None:
         try:
-            if not os.path.isdir(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache")):
-                os.mkdir(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache"))
+            if not os.path.isdir(self.index_dir):
+                os.makedirs(self.index_dir)
 
-            pickle.dump(self.index, open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "index.pkl"), "wb"))
-            pickle.dump(self.docmap, open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "docmap.pkl"), "wb"))
-            pickle.dump(self.term_frequencies, open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "term_frequencies.pkl"), "wb"))
-            pickle.dump(self.doc_lengths, open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "doc_lengths.pkl"), "wb"))
+            with self.lock:
+                self.flush()
+                for segment in self.segments:
+                    if segment.name is None:
+                        segment.name = self.__write_segment(segment.reader.buffer)
+                if self.document_updates or not self.documents_saved:
+                    # A saved store only gets its changes appended to the update log, a built one is written whole
+                    if self.documents_saved:
+                        self.document_log_size = append_document_updates(self.document_log_path, self.document_log_size, self.document_updates)
+                    self.saved_updates.update(self.document_updates)
+                    self.document_updates = {}
+                    if not self.documents_saved:
+                        self.__compact_documents()
+                    with open(self.duplicates_path, "w") as duplicates_file:
+                        json.dump({"clusters": [[representative] + members for representative, members in self.duplicates.items()]}, duplicates_file)
+                # The manifest is written last, it makes the segments and the log appends visible
+                write_manifest(self.index_path, self.generation, self.segments, self.document_log_size)
+                self.__remove_unreferenced_segments()
+                self.__record_saved_state()
         except Exception as e:
             print(f"Error: {e}")
-    
+            return
+
+        self.maybe_merge()
+
+    def __live_documents(self):
+        # Stored records in their original order with the saved updates applied, then the added records
+        for document in self.documents:
+            if document['id'] not in self.saved_updates:
+                yield document
+        for doc_id in sorted(self.saved_updates):
+            if self.saved_updates[doc_id] is not None:
+                yield self.saved_updates[doc_id]
+
     def load(self) -> bool:
         try:
-            self.index = pickle.load(open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "index.pkl"), "rb"))
-            self.docmap = pickle.load(open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "docmap.pkl"), "rb"))
-            self.term_frequencies = pickle.load(open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "term_frequencies.pkl"), "rb"))
-            self.doc_lengths = pickle.load(open(os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "doc_lengths.pkl"), "rb"))
+            manifest = read_manifest(self.index_path)
+            duplicates = {}
+            if os.path.exists(self.duplicates_path):
+                with open(self.duplicates_path, "r") as duplicates_file:
+                    duplicates = {cluster[0]: cluster[1:] for cluster in json.load(duplicates_file)["clusters"]}
+            document_log_size = manifest.get('document_log_size', 0)
+            saved_updates = read_document_updates(self.document_log_path, document_log_size)
+            segments = []
+            for entry in manifest['segments']:
+                segments.append(Segment(MappedIndex.open(os.path.join(self.index_dir, entry['name'])), entry['name'], entry['deleted']))
+            with self.lock:
+                self.generation = manifest['generation']
+                self.segments = segments
+                self.pending_documents = {}
+                self.pending_segment = None
+                self.documents = DocumentStore.open(self.documents_path)
+                self.completions = TitleCompletions.open(self.completions_path)
+                self.duplicates = duplicates
+                self.duplicate_of = {member: representative for representative, members in duplicates.items() for member in members}
+                self.saved_updates = saved_updates
+                self.document_updates = {}
+                self.documents_saved = True
+                self.document_log_size = document_log_size
+                self.revision += 1
+                self.__record_saved_state()
+                self.result_cache.load(self.result_cache_path)
             return True
         except Exception as e:
             print(f"Error loading index: {e}")
             return False
-
-    
-
-    
\ No newline at end of file
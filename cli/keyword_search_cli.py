@@ -1,29 +1,19 @@
 #!/usr/bin/env python3
 
 import argparse
-from utility import load_stopwords, tokenize
+from utility import load_json
 from inverted_index import InvertedIndex
-from constants import DEFAULT_BM25_K1, DEFAULT_BM25_B
+from lib.query_expansion import build_term_neighbours, write_term_neighbours
+from lib.spell_corrector import load_spell_index
+from lib.title_completion import load_title_completions
+from constants import DEFAULT_BM25_K1, DEFAULT_BM25_B, NEIGHBOURS_PATH, QUERY_EXPANSION_COOCCURRENCE_WEIGHT, COMPLETIONS_PATH, AUTOCOMPLETE_LIMIT
 
 def keyword_search(query_string: str, inverted_index: InvertedIndex, limit: int = 5) -> list[dict]:
-    
-    matches = []
-    stopwords = load_stopwords()
-    
-    if stopwords:
-        query_tokens = tokenize(query_string, stopwords)
-        doc_ids = []
-        for query_token in query_tokens:
-            doc_ids.extend(inverted_index.get_documents(query_token))
-            doc_ids = list(set(doc_ids))
-            if len(doc_ids) >= limit:
-                break
-        matches = []
-        for doc_id in doc_ids:
-            matches.append(inverted_index.docmap[doc_id])            
-        sorted_matches = sorted(matches, key=lambda d: d['id'])
-        return sorted_matches[0:min(len(sorted_matches), limit)]
-    else:
+    # Supports AND, OR, NOT, parentheses, "exact phrases" and "proximity phrases"~N; plain words are OR'ed
+    try:
+        return inverted_index.boolean_search(query_string, limit)
+    except ValueError as e:
+        print(f"Error: {e}")
         return []
 
 def build_command() -> None:
@@ -31,6 +21,73 @@ def build_command() -> None:
     inverted_index.build()
     inverted_index.save() 
 
+def add_command(file_path: str) -> None:
+    inverted_index = InvertedIndex()
+    if not inverted_index.load():
+        print("Index not found. Build index first!")
+        return
+    movies = load_json(file_path)
+    if movies is None:
+        return
+    updated = 0
+    for movie in movies['movies']:
+        if inverted_index.has_document(movie['id']):
+            updated += 1
+        inverted_index.add_document(movie)
+    inverted_index.save()
+    print(f"Added {len(movies['movies']) - updated} and updated {updated} documents")
+
+def delete_command(doc_ids: list[int]) -> None:
+    inverted_index = InvertedIndex()
+    if not inverted_index.load():
+        print("Index not found. Build index first!")
+        return
+    deleted = 0
+    for doc_id in doc_ids:
+        if inverted_index.delete_document(doc_id):
+            deleted += 1
+        else:
+            print(f"Document '{doc_id}' is not in the index")
+    inverted_index.save()
+    print(f"Deleted {deleted} documents")
+
+def merge_command() -> None:
+    inverted_index = InvertedIndex()
+    if not inverted_index.load():
+        print("Index not found. Build index first!")
+        return
+    inverted_index.force_merge()
+    print(f"Index merged into {len(inverted_index.segments)} segment(s)")
+
+def spell_command(query: str) -> None:
+    spell_index = load_spell_index()
+    if spell_index is None:
+        print("Spell index not found. Build index first!")
+        return
+    corrected, confidence = spell_index.correct_query(query)
+    print(f"Corrected query: '{corrected}' (confidence: {confidence:.2f})")
+
+def complete_command(prefix: str, limit: int = AUTOCOMPLETE_LIMIT) -> None:
+    # Reads only the title prefix index, not the segments or the document store
+    completions = load_title_completions(COMPLETIONS_PATH)
+    if completions is None:
+        print("Title completions not found. Build index first!")
+        return
+    for i, completion in enumerate(completions.complete(prefix, limit)):
+        print(f"{i + 1}. ({completion['id']}) {completion['title']}")
+
+def build_neighbours_command(cooccurrence_weight: float = QUERY_EXPANSION_COOCCURRENCE_WEIGHT) -> None:
+    # Imported here, the embedding model is only needed to build the neighbours
+    from lib.model_registry import embedding_model
+
+    inverted_index = InvertedIndex()
+    if not inverted_index.load():
+        print("Index not found. Build index first!")
+        return
+    neighbours = build_term_neighbours(inverted_index, embedding_model(), cooccurrence_weight=cooccurrence_weight)
+    write_term_neighbours(NEIGHBOURS_PATH, neighbours)
+    print(f"Stored the neighbour terms of {len(neighbours)} index terms")
+
 def bm25_idf_command(term: str) -> float:
     inverted_index = InvertedIndex()
     if not inverted_index.load():
@@ -51,24 +108,45 @@ def bm25_tf_command(doc_id: int, term: str, k1: float = DEFAULT_BM25_K1, b: floa
         except Exception as e:
             print(f"Error: {e}")            
     
-def bm25_search_command(query: str, limit: int) -> list[dict]:
+def bm25_search_command(query: str, limit: int, k1: float = DEFAULT_BM25_K1, b: float = DEFAULT_BM25_B, expansion: int = 0) -> list[dict]:
     inverted_index = InvertedIndex()
     if not inverted_index.load():
         print("Index not found. Build index first!")
         return []
     else:
-        return inverted_index.bm25_search(query, limit)
+        results = inverted_index.bm25_search(query, limit, k1=k1, b=b, expansion=expansion)
+        # The next invocation answers a repeated query from the saved cache
+        inverted_index.save_result_cache()
+        return results
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Keyword Search CLI")
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
-    search_parser = subparsers.add_parser("search", help="Search movies using BM25")
-    search_parser.add_argument("query", type=str, help="Search query")
+    search_parser = subparsers.add_parser("search", help="Search movies matching a boolean, phrase or proximity query")
+    search_parser.add_argument("query", type=str, help='Search query, e.g. \'"star wars" AND NOT clone\' or \'"lord rings"~2\'')
 
     subparsers.add_parser("build", help="(Re)build index of movies")
 
+    add_parser = subparsers.add_parser("add", help="Add or update the movies of a JSON file in the index without a rebuild")
+    add_parser.add_argument("file", type=str, help="JSON file in the format of movies.json")
+
+    delete_parser = subparsers.add_parser("delete", help="Delete movies from the index without a rebuild")
+    delete_parser.add_argument("doc_ids", type=int, nargs='+', help="DocumentIDs to delete")
+
+    subparsers.add_parser("merge", help="Merge all index segments into one")
+
+    spell_parser = subparsers.add_parser("spell", help="Correct typos in a query with the local spelling dictionary")
+    spell_parser.add_argument("query", type=str, help="Query to correct")
+
+    complete_parser = subparsers.add_parser("complete", help="Complete a partially typed movie title")
+    complete_parser.add_argument("prefix", type=str, help="Beginning of a title or of a word in it")
+    complete_parser.add_argument("--limit", type=int, nargs='?', default=AUTOCOMPLETE_LIMIT, help="Number of completions")
+
+    build_neighbours_parser = subparsers.add_parser("build-neighbours", help="Precompute the nearest neighbour terms of the index vocabulary for query expansion")
+    build_neighbours_parser.add_argument("--cooccurrence-weight", type=float, nargs='?', default=QUERY_EXPANSION_COOCCURRENCE_WEIGHT, help="Share of the posting list co-occurrence in the neighbour weights")
+
     term_frequency_parser = subparsers.add_parser("tf", help="Determine occurences of search term in given DocumentID")
     term_frequency_parser.add_argument("doc_id", type=int, help="DocumentID to search")
     term_frequency_parser.add_argument("term", type=str, help="Term to determine occurences of")
@@ -91,6 +169,9 @@ def main() -> None:
 
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
     bm25search_parser.add_argument("query", type=str, help="Search query")
+    bm25search_parser.add_argument("k1", type=float, nargs='?', default=DEFAULT_BM25_K1, help="Tunable BM25 K1 parameter")
+    bm25search_parser.add_argument("b", type=float, nargs='?', default=DEFAULT_BM25_B, help="Tunable BM25 B parameter")
+    bm25search_parser.add_argument("--expand", type=int, nargs='?', default=0, help="Number of neighbour terms added per query term (needs build-neighbours)")
 
     args = parser.parse_args()
 
@@ -144,13 +225,13 @@ def main() -> None:
 
         case "bm25tf":
             try:
-                print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25_tf_command(args.doc_id, args.term, args.k1):.2f}")
+                print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25_tf_command(args.doc_id, args.term, args.k1, args.b):.2f}")
             except Exception as e:
                 print(f"Error: {e}")
 
         case "bm25search":
             try:
-                sorted_scores = bm25_search_command(args.query, 5)
+                sorted_scores = bm25_search_command(args.query, 5, args.k1, args.b, args.expand)
                 for i in range(0, min(len(sorted_scores), 6)):                   
                     print(f"{i + 1}. ({sorted_scores[i]['doc_id']}) {sorted_scores[i]['movie']['title']} - Score: {sorted_scores[i]['score']:.2f}")
             except Exception as e:
@@ -162,6 +243,36 @@ def main() -> None:
 
             except Exception as e:
                 print(f"Error: {e}")
+
+        case "add":
+            try:
+                add_command(args.file)
+            except Exception as e:
+                print(f"Error: {e}")
+
+        case "delete":
+            try:
+                delete_command(args.doc_ids)
+            except Exception as e:
+                print(f"Error: {e}")
+
+        case "merge":
+            try:
+                merge_command()
+            except Exception as e:
+                print(f"Error: {e}")
+
+        case "spell":
+            spell_command(args.query)
+
+        case "complete":
+            complete_command(args.prefix, args.limit)
+
+        case "build-neighbours":
+            try:
+                build_neighbours_command(args.cooccurrence_weight)
+            except Exception as e:
+                print(f"Error: {e}")
         case _:
             parser.print_help()
 
@@ -0,0 +1,87 @@
+import string
+from collections import OrderedDict
+
+from nltk.stem import PorterStemmer
+
+from constants import ANALYZER_CACHE_SIZE, ANALYZER_VOCABULARY_SIZE
+
+# Marks a word that has not been analyzed yet; None is a cached stopword
+_MISSING = object()
+
+class Analyzer:
+    """Text analysis shared by indexing and querying: punctuation removal, lower-casing, stopword
+    removal and Porter stemming, with every distinct word analyzed only once.
+
+    Each word maps straight to an integer vocabulary id through a bounded LRU cache, so the stemmer
+    runs once per distinct word instead of once per occurrence. Ids are only valid until the next
+    call of token_ids(): once the vocabulary holds vocabulary_size stems it is cleared at the start
+    of a call, which bounds the memory of a long-lived analyzer. Ids are never persisted.
+    """
+
+    def __init__(self, stopwords: list[str], cache_size: int = ANALYZER_CACHE_SIZE, vocabulary_size: int = ANALYZER_VOCABULARY_SIZE) -> None:
+        self.stopwords = frozenset(stopwords or ())
+        self.translation = str.maketrans('', '', string.punctuation)
+        self.stemmer = PorterStemmer()
+        self.cache_size = cache_size
+        self.vocabulary_size = vocabulary_size
+        # word -> vocabulary id, or None for a stopword, least recently used first
+        self.cache = OrderedDict()
+        # stem -> vocabulary id and back
+        self.vocabulary = {}
+        self.tokens = []
+        self.lookups = 0
+        self.misses = 0
+
+    def __analyze_word(self, word: str) -> int | None:
+        self.misses += 1
+        if word in self.stopwords:
+            token_id = None
+        else:
+            token = self.stemmer.stem(word)
+            token_id = self.vocabulary.get(token)
+            if token_id is None:
+                token_id = len(self.tokens)
+                self.vocabulary[token] = token_id
+                self.tokens.append(token)
+        if len(self.cache) >= self.cache_size:
+            # Evict the least recently used word, the vocabulary itself is kept
+            self.cache.popitem(last=False)
+        self.cache[word] = token_id
+        return token_id
+
+    def token_ids(self, text: str) -> list[int]:
+        if len(self.tokens) >= self.vocabulary_size:
+            # Cached words map to ids of the old vocabulary, so they go with it
+            self.cache.clear()
+            self.vocabulary.clear()
+            self.tokens.clear()
+        words = text.translate(self.translation).lower().split()
+        self.lookups += len(words)
+        cache = self.cache
+        token_ids = []
+        for word in words:
+            token_id = cache.get(word, _MISSING)
+            if token_id is _MISSING:
+                token_id = self.__analyze_word(word)
+            else:
+                cache.move_to_end(word)
+            if token_id is not None:
+                token_ids.append(token_id)
+        return token_ids
+
+    def analyze(self, text: str) -> list[str]:
+        tokens = self.tokens
+        return [tokens[token_id] for token_id in self.token_ids(text)]
+
+    def token(self, token_id: int) -> str:
+        return self.tokens[token_id]
+
+    def stats(self) -> dict:
+        return {
+            "lookups": self.lookups,
+            "hits": self.lookups - self.misses,
+            "misses": self.misses,
+            "hit_rate": (self.lookups - self.misses) / self.lookups if self.lookups > 0 else 0.0,
+            "cached_words": len(self.cache),
+            "vocabulary_size": len(self.tokens),
+        }
@@ -1,13 +1,14 @@
-from utility import load_movies, format_documents
+from utility import format_documents
+from lib.document_store import load_document_store
 from constants import DEFAULT_RRF_K, DEFAULT_SEARCH_LIMIT
 from lib.hybrid_search import HybridSearch
 from lib.llm import LLM
 
 def rag_command(query: str):
 
-    movies = load_movies()
+    movies = load_document_store()
 
-    hybrid_search = HybridSearch(movies['movies'])
+    hybrid_search = HybridSearch(movies)
 
     results = hybrid_search.rrf_search(query, DEFAULT_RRF_K, DEFAULT_SEARCH_LIMIT)
 
@@ -26,9 +27,9 @@ def rag_command(query: str):
     print(rag_response)
 
 def summarize_command(query: str, limit: int):
-    movies = load_movies()
+    movies = load_document_store()
 
-    hybrid_search = HybridSearch(movies['movies'])
+    hybrid_search = HybridSearch(movies)
 
     results = hybrid_search.rrf_search(query, DEFAULT_RRF_K, limit)
 
@@ -48,9 +49,9 @@ def summarize_command(query: str, limit: int):
 
 def citations_command(query: str, limit: int):
 
-    movies = load_movies()
+    movies = load_document_store()
 
-    hybrid_search = HybridSearch(movies['movies'])
+    hybrid_search = HybridSearch(movies)
 
     results = hybrid_search.rrf_search(query, DEFAULT_RRF_K, limit)
 
@@ -70,9 +71,9 @@ def citations_command(query: str, limit: int):
 
 def question_command(question: str, limit: int):
 
-    movies = load_movies()
+    movies = load_document_store()
 
-    hybrid_search = HybridSearch(movies['movies'])
+    hybrid_search = HybridSearch(movies)
 
     results = hybrid_search.rrf_search(question, DEFAULT_RRF_K, limit)
 
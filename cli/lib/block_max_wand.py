@@ -0,0 +1,160 @@
+import bisect
+import heapq
+import operator
+import sys
+
+from lib.index_format import MappedIndex
+
+# Slack applied to every upper bound, so that a bound summed in a different order than the
+# exact score can never round below it and prune a document that belongs in the top-k
+UPPER_BOUND_SLACK = 1 + 1e-9
+
+# Ordinal of an exhausted cursor, sorts after every real document
+END_OF_POSTINGS = sys.maxsize
+
+def gallop(values, target: int, lo: int, hi: int) -> int:
+    """bisect_left over the sorted values[lo:hi], probing lo+1, lo+3, lo+7, ... before bisecting.
+
+    Costs O(log d) for a target d entries ahead, so short skips, which dominate when intersecting
+    lists of similar length, stay cheap while long skips remain logarithmic.
+    """
+    step = 1
+    bound = lo
+    while bound < hi and values[bound] < target:
+        lo = bound + 1
+        bound += step
+        step *= 2
+    return bisect.bisect_left(values, target, lo, min(bound, hi))
+
+class PostingCursor:
+    """Iterates the postings of one term of a MappedIndex, decoding one block at a time."""
+
+    def __init__(self, index: MappedIndex, term_id: int, weight: int = 1) -> None:
+        self.index = index
+        self.weight = weight
+        self.first_block = index.block_starts[term_id]
+        self.end_block = index.block_starts[term_id + 1]
+        self.posting_start = index.posting_starts[term_id]
+        self.max_score = weight * max(index.block_max_impacts[self.first_block:self.end_block]) * UPPER_BOUND_SLACK
+        # Block pointer of shallow moves, may run ahead of the block that is actually decoded
+        self.block = self.first_block
+        self.__load_block(self.first_block)
+
+    def __load_block(self, block: int) -> None:
+        self.decoded_block = block
+        self.position = 0
+        if block < self.end_block:
+            self.block_ordinals = self.index.decode_block(block, self.first_block)
+            self.doc = self.block_ordinals[0]
+        else:
+            self.block_ordinals = []
+            self.doc = END_OF_POSTINGS
+
+    def score(self) -> float:
+        return self.index.impacts[self.posting_index()]
+
+    def next(self) -> None:
+        self.position += 1
+        if self.position < len(self.block_ordinals):
+            self.doc = self.block_ordinals[self.position]
+        else:
+            self.__load_block(self.decoded_block + 1)
+
+    def seek(self, target: int) -> None:
+        if target <= self.doc:
+            return
+        # Skip whole blocks through their last ordinal (the skip pointers), then gallop inside the decoded block
+        block = gallop(self.index.block_last_ordinals, target, self.decoded_block, self.end_block)
+        if block != self.decoded_block:
+            self.__load_block(block)
+            if self.doc == END_OF_POSTINGS:
+                return
+        self.position = gallop(self.block_ordinals, target, self.position, len(self.block_ordinals))
+        self.doc = self.block_ordinals[self.position]
+
+    def posting_index(self) -> int:
+        # Index of the current posting into the frequencies, impacts and position_offsets columns
+        return self.posting_start + (self.decoded_block - self.first_block) * self.index.block_size + self.position
+
+    def block_max_score(self, target: int) -> float:
+        # Shallow move: only the block pointer advances, the block itself is not decoded
+        self.block = bisect.bisect_left(self.index.block_last_ordinals, target, self.block, self.end_block)
+        if self.block >= self.end_block:
+            return 0.0
+        return self.weight * self.index.block_max_impacts[self.block] * UPPER_BOUND_SLACK
+
+    def block_last_ordinal(self) -> int | None:
+        # None once the shallow move ran past the last block, i.e. no postings remain at or after the target
+        return self.index.block_last_ordinals[self.block] if self.block < self.end_block else None
+
+def block_max_wand(cursors: dict[str, PostingCursor], tokens: list[str], limit: int, deleted: set[int] = frozenset()) -> list[tuple[int, float]]:
+    """Return the (ordinal, score) pairs of the top `limit` documents, best first.
+
+    Documents whose per-term or per-block upper bounds cannot beat the current top-k threshold are
+    skipped without being scored. Scores are summed in query token order, so results are identical
+    to exhaustively accumulating every posting of every token. Ordinals in deleted are never returned.
+    """
+    if limit <= 0:
+        return []
+
+    active = [cursor for cursor in cursors.values() if cursor.doc != END_OF_POSTINGS]
+    # Min-heap of (score, -ordinal): the root is the weakest top-k entry, ties broken towards the larger ordinal
+    top_k = []
+
+    while active:
+        threshold = top_k[0][0] if len(top_k) == limit else 0.0
+        active.sort(key=operator.attrgetter('doc'))
+
+        # Find the pivot: the first cursor at which the summed term upper bounds exceed the threshold
+        upper_bound = 0.0
+        pivot = None
+        for i, cursor in enumerate(active):
+            upper_bound += cursor.max_score
+            if upper_bound > threshold:
+                pivot = i
+                break
+        if pivot is None:
+            break
+
+        pivot_doc = active[pivot].doc
+        while pivot + 1 < len(active) and active[pivot + 1].doc == pivot_doc:
+            pivot += 1
+
+        block_upper_bound = 0.0
+        for cursor in active[:pivot + 1]:
+            block_upper_bound += cursor.block_max_score(pivot_doc)
+
+        if block_upper_bound > threshold:
+            if active[0].doc == pivot_doc and pivot_doc in deleted:
+                for cursor in active[:pivot + 1]:
+                    cursor.next()
+            elif active[0].doc == pivot_doc:
+                score = 0.0
+                for token in tokens:
+                    cursor = cursors.get(token)
+                    if cursor is not None and cursor.doc == pivot_doc:
+                        score += cursor.score()
+
+                if score > threshold:
+                    if len(top_k) == limit:
+                        heapq.heapreplace(top_k, (score, -pivot_doc))
+                    else:
+                        heapq.heappush(top_k, (score, -pivot_doc))
+
+                for cursor in active[:pivot + 1]:
+                    cursor.next()
+            else:
+                for cursor in active[:pivot]:
+                    if cursor.doc < pivot_doc:
+                        cursor.seek(pivot_doc)
+        else:
+            # No document up to the end of the current blocks can enter the top-k, jump past them
+            next_doc = min(cursor.block_last_ordinal() for cursor in active[:pivot + 1] if cursor.block_last_ordinal() is not None) + 1
+            if pivot + 1 < len(active):
+                next_doc = min(next_doc, active[pivot + 1].doc)
+            for cursor in active[:pivot + 1]:
+                cursor.seek(next_doc)
+
+        active = [cursor for cursor in active if cursor.doc != END_OF_POSTINGS]
+
+    return [(-neg_ordinal, score) for score, neg_ordinal in sorted(top_k, reverse=True)]
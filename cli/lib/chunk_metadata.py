@@ -0,0 +1,96 @@
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+# Per-chunk metadata of the chunk embeddings as typed columns, row i describing embedding row i.
+# Loading maps the file and wraps the columns without parsing anything per chunk. Layout, native
+# byte order checked through a byte order mark:
+#
+#   header | section table | movie_idx | chunk_idx | total_chunks | content_hash
+#          | duplicate_representatives | duplicate_starts | duplicate_members
+#
+# content_hash keys every embedding row by its chunk text and model (lib.embedding_store), the
+# header's source fingerprint identifies the documents and model the chunks were built from. The
+# members of near-duplicate cluster i are duplicate_members[duplicate_starts[i]:duplicate_starts[i + 1]].
+CHUNK_METADATA_MAGIC = b"RSECHUNK"
+CHUNK_METADATA_VERSION = 2
+BYTE_ORDER_MARK = 0x01020304
+HEADER_FORMAT = "=8sIIIIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+SECTIONS = [
+    ("movie_idx", "I"),
+    ("chunk_idx", "I"),
+    ("total_chunks", "I"),
+    ("content_hash", "Q"),
+    ("duplicate_representatives", "I"),
+    ("duplicate_starts", "Q"),
+    ("duplicate_members", "I"),
+]
+SECTION_TABLE_FORMAT = "=" + "QQ" * len(SECTIONS)
+SECTION_TABLE_SIZE = struct.calcsize(SECTION_TABLE_FORMAT)
+
+def encode_chunk_metadata(movie_indexes: np.ndarray, chunk_indexes: np.ndarray, total_chunks: np.ndarray, content_hashes: np.ndarray,
+                          duplicates: dict[int, list[int]], source_fingerprint: int) -> bytes:
+    representatives = sorted(duplicates)
+    duplicate_starts = np.cumsum([0] + [len(duplicates[representative]) for representative in representatives])
+    duplicate_members = [member for representative in representatives for member in duplicates[representative]]
+
+    payloads = [np.asarray(movie_indexes, dtype=np.uint32).tobytes(), np.asarray(chunk_indexes, dtype=np.uint32).tobytes(),
+                np.asarray(total_chunks, dtype=np.uint32).tobytes(), np.asarray(content_hashes, dtype=np.uint64).tobytes(),
+                np.array(representatives, dtype=np.uint32).tobytes(),
+                duplicate_starts.astype(np.uint64).tobytes(), np.array(duplicate_members, dtype=np.uint32).tobytes()]
+
+    section_table = []
+    body = bytearray()
+    offset = HEADER_SIZE + SECTION_TABLE_SIZE
+    for payload in payloads:
+        body += b"\0" * (-(offset + len(body)) % 8)
+        section_table.extend([offset + len(body), len(payload)])
+        body += payload
+
+    header = struct.pack(HEADER_FORMAT, CHUNK_METADATA_MAGIC, CHUNK_METADATA_VERSION, BYTE_ORDER_MARK, len(movie_indexes), len(representatives), source_fingerprint)
+    return header + struct.pack(SECTION_TABLE_FORMAT, *section_table) + bytes(body)
+
+def write_chunk_metadata(path: str, movie_indexes: np.ndarray, chunk_indexes: np.ndarray, total_chunks: np.ndarray, content_hashes: np.ndarray,
+                         duplicates: dict[int, list[int]], source_fingerprint: int) -> None:
+    buffer = encode_chunk_metadata(movie_indexes, chunk_indexes, total_chunks, content_hashes, duplicates, source_fingerprint)
+    with open(f"{path}.tmp", "wb") as metadata_file:
+        metadata_file.write(buffer)
+    os.replace(f"{path}.tmp", path)
+
+class ChunkMetadata:
+    """Memory-mapped chunk metadata columns."""
+
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+        view = memoryview(buffer)
+        magic, version, byte_order_mark, self.chunk_count, self.cluster_count, self.source_fingerprint = struct.unpack_from(HEADER_FORMAT, view, 0)
+        if magic != CHUNK_METADATA_MAGIC or version != CHUNK_METADATA_VERSION:
+            raise ValueError("unsupported chunk metadata format")
+        if byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError(f"chunk metadata was written on a host with a different byte order than {sys.byteorder}")
+
+        section_table = struct.unpack_from(SECTION_TABLE_FORMAT, view, HEADER_SIZE)
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = section_table[2 * i], section_table[2 * i + 1]
+            setattr(self, name, np.frombuffer(buffer, dtype=np.dtype(typecode), count=length // struct.calcsize(typecode), offset=offset))
+
+    @classmethod
+    def open(cls, path: str) -> "ChunkMetadata":
+        with open(path, "rb") as metadata_file:
+            return cls(mmap.mmap(metadata_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self) -> int:
+        return self.chunk_count
+
+    def __getitem__(self, i: int) -> dict:
+        return {'movie_idx': int(self.movie_idx[i]), 'chunk_idx': int(self.chunk_idx[i]), 'total_chunks': int(self.total_chunks[i])}
+
+    def duplicates(self) -> dict[int, list[int]]:
+        """Near-duplicate clusters: representative movie position -> member positions."""
+        return {int(representative): self.duplicate_members[self.duplicate_starts[i]:self.duplicate_starts[i + 1]].tolist()
+                for i, representative in enumerate(self.duplicate_representatives)}
@@ -1,45 +1,179 @@
-from lib.semantic_search import SemanticSearch, semantic_chunking, cosine_similarity
-from utility import load_movies
-from constants import CACHE_DIR
+from lib.semantic_search import SemanticSearch, semantic_chunking, normalize_embeddings, top_k, save_embeddings_file, open_embeddings
+from lib.chunk_metadata import ChunkMetadata, write_chunk_metadata
+from lib.embedding_store import content_hashes, reuse_embeddings
+from lib.embedding_build import encode_resumable, clear_checkpoints
+from lib.document_store import DocumentStore, load_document_store
+from lib.near_duplicates import find_near_duplicates
+from lib.hnsw_index import HNSWIndex, load_hnsw_index
+from lib.vector_quantization import QuantizedVectors, load_quantized_vectors
+from constants import (CACHE_DIR, GOLDEN_DATASET_PATH, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH, HNSW_EXACT_FRACTION,
+                       CHUNK_CANDIDATES_PER_RESULT, BATCH_SCORE_MATRIX_SIZE, EMBEDDING_MODEL)
+from utility import load_json
 import os
+import time
+from collections.abc import Callable
 import numpy as np
-import json
 
 CHUNK_EMBEDDINGS_PATH = os.path.join(CACHE_DIR, "chunk_embeddings.npy")
-CHUNK_METADATA_PATH = os.path.join(CACHE_DIR, "chunk_metadata.json")
+CHUNK_METADATA_PATH = os.path.join(CACHE_DIR, "chunk_metadata.bin")
+LEGACY_CHUNK_METADATA_PATH = os.path.join(CACHE_DIR, "chunk_metadata.json")
+CHUNK_HNSW_PATH = os.path.join(CACHE_DIR, "chunk_hnsw.bin")
+CHUNK_QUANTIZED_PATH = os.path.join(CACHE_DIR, "chunk_embeddings_quantized.npz")
+# Checkpoints of an unfinished chunk embedding build
+CHUNK_BUILD_DIR = os.path.join(CACHE_DIR, "chunk_embeddings_build")
 
-def embed_chunks_command():
-    documents = load_movies()
+def open_chunk_metadata() -> ChunkMetadata | None:
+    # The JSON metadata of earlier versions has no content hashes, the chunks are embedded anew
+    if not os.path.exists(CHUNK_METADATA_PATH):
+        return None
+    try:
+        return ChunkMetadata.open(CHUNK_METADATA_PATH)
+    except Exception as e:
+        print(f"Error loading chunk metadata: {e}")
+        return None
+
+def embed_chunks_command(workers: int | None = None):
+    documents = load_document_store()
     chunked_semantic_search = ChunkedSemanticSearch()
-    chunked_semantic_search.load_or_create_chunk_embeddings(documents['movies'])
+    chunked_semantic_search.load_or_create_chunk_embeddings(documents, workers)
     print(f"Generated {len(chunked_semantic_search.chunk_embeddings)} chunked embeddings")
 
-def search_chunked_command(query: str, limit: int):
-    documents = load_movies()
+def search_chunked_command(query: str, limit: int, exact: bool = False, ef_search: int = HNSW_EF_SEARCH):
+    documents = load_document_store()
     chunked_semantic_search = ChunkedSemanticSearch()
-    chunked_semantic_search.load_or_create_chunk_embeddings(documents['movies'])
-    search_results = chunked_semantic_search.search_chunks(query, limit)
+    chunked_semantic_search.load_or_create_chunk_embeddings(documents)
+    search_results = chunked_semantic_search.search_chunks(query, limit, exact=exact, ef_search=ef_search)
 
     for idx, result in enumerate(search_results):
         print(f"\n{idx + 1}. {result['title']} (score: {result['score']:.4f})")
         print(f"   {result['description']}...")
 
+def _print_progress(inserted: int, total: int, started: float) -> None:
+    rate = inserted / max(time.perf_counter() - started, 1e-9)
+    print(f"\rInserted {inserted}/{total} vectors ({rate:.0f} vectors/s)", end="" if inserted < total else "\n", flush=True)
+
+def build_hnsw_command(m: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION):
+    documents = load_document_store()
+    chunked_semantic_search = ChunkedSemanticSearch()
+    chunked_semantic_search.load_or_create_chunk_embeddings(documents)
+    started = time.perf_counter()
+    chunked_semantic_search.build_hnsw_index(m, ef_construction, progress=lambda inserted, total: _print_progress(inserted, total, started))
+    print(f"Built HNSW index over {len(chunked_semantic_search.chunk_embeddings)} chunks (M={m}, efConstruction={ef_construction}) in {time.perf_counter() - started:.1f}s")
+
+def quantize_command(kind: str | None):
+    documents = load_document_store()
+    chunked_semantic_search = ChunkedSemanticSearch()
+    chunked_semantic_search.load_or_create_chunk_embeddings(documents)
+    started = time.perf_counter()
+    chunked_semantic_search.quantize_chunk_embeddings(kind)
+    if kind is None:
+        print("Removed the quantized chunk embeddings, search scans the float32 matrix")
+        return
+    embeddings = chunked_semantic_search.chunk_embeddings
+    codes = chunked_semantic_search.quantized.codes
+    print(f"Quantized {len(embeddings)} chunk embeddings to {kind} in {time.perf_counter() - started:.1f}s: "
+          f"{codes.nbytes / len(codes):.0f} instead of {embeddings.nbytes / len(embeddings):.0f} bytes per vector ({embeddings.nbytes / codes.nbytes:.0f}x smaller)")
+
+def report_queries(chunked_semantic_search: "ChunkedSemanticSearch", query_count: int) -> np.ndarray:
+    """Normalized query embeddings for the recall reports: the golden dataset queries plus
+    mixtures of two random chunks, which lie between real embeddings like typical queries do."""
+    embeddings = chunked_semantic_search.chunk_embeddings
+    queries = []
+    golden_dataset = load_json(GOLDEN_DATASET_PATH) if os.path.exists(GOLDEN_DATASET_PATH) else None
+    if golden_dataset is not None:
+        queries = [chunked_semantic_search.generate_embedding(test_case['query']) for test_case in golden_dataset['test_cases']][:query_count]
+    rng = np.random.default_rng(0)
+    while len(queries) < query_count:
+        first, second = rng.integers(0, len(embeddings), size=2)
+        queries.append(embeddings[first] + embeddings[second])
+    return normalize_embeddings(np.array(queries))
+
+def exact_report_results(embeddings: np.ndarray, queries: np.ndarray, limit: int) -> tuple[list[set], float]:
+    # Exact top `limit` rows of every query and the mean latency of the scan
+    started = time.perf_counter()
+    exact_results = [set(top_k(embeddings @ query, limit).tolist()) for query in queries]
+    return exact_results, (time.perf_counter() - started) / len(queries)
+
+def hnsw_report_command(ef_values: list[int], query_count: int = 200, limit: int = 10):
+    """Print recall@limit and latency of HNSW search at several efSearch values against exact search."""
+    documents = load_document_store()
+    chunked_semantic_search = ChunkedSemanticSearch()
+    chunked_semantic_search.load_or_create_chunk_embeddings(documents)
+    if chunked_semantic_search.hnsw is None:
+        print("HNSW index not found. Build it first with build_hnsw")
+        return
+    embeddings = chunked_semantic_search.chunk_embeddings
+    queries = report_queries(chunked_semantic_search, query_count)
+
+    exact_results, exact_latency = exact_report_results(embeddings, queries, limit)
+    print(f"{len(embeddings)} chunks, {len(queries)} queries, recall@{limit} against exact search ({exact_latency * 1000:.3f} ms/query)")
+    print(f"{'efSearch':>8}  {'recall':>7}  {'ms/query':>9}  {'speedup':>8}")
+    for ef_search in ef_values:
+        started = time.perf_counter()
+        approximate_results = [chunked_semantic_search.hnsw.search(query, limit, ef_search)[0] for query in queries]
+        latency = (time.perf_counter() - started) / len(queries)
+        recall = np.mean([len(exact & set(rows.tolist())) / len(exact) for exact, rows in zip(exact_results, approximate_results)])
+        print(f"{ef_search:>8}  {recall:>7.4f}  {latency * 1000:>9.3f}  {exact_latency / latency:>7.1f}x")
+
+def quantization_report_command(kinds: list[str], rescore_factors: list[int], query_count: int = 200, limit: int = 10):
+    """Print memory, recall@limit and latency of every quantization against float32 search.
+
+    Rescore factor 0 ranks by the coarse scores of the codes alone, larger factors rescore that many
+    times `limit` coarse candidates against the float32 vectors.
+    """
+    documents = load_document_store()
+    chunked_semantic_search = ChunkedSemanticSearch()
+    chunked_semantic_search.load_or_create_chunk_embeddings(documents)
+    embeddings = np.asarray(chunked_semantic_search.chunk_embeddings)
+    queries = report_queries(chunked_semantic_search, query_count)
+
+    exact_results, exact_latency = exact_report_results(embeddings, queries, limit)
+    print(f"{len(embeddings)} chunks, {len(queries)} queries, recall@{limit} against float32 search "
+          f"({embeddings.nbytes / len(embeddings):.0f} bytes/vector, {exact_latency * 1000:.3f} ms/query)")
+    print(f"{'kind':>5}  {'bytes':>6}  {'rescore':>7}  {'recall':>7}  {'ms/query':>9}  {'speedup':>8}")
+    for kind in kinds:
+        quantized = QuantizedVectors.build(embeddings, kind)
+        bytes_per_vector = quantized.codes.nbytes / len(embeddings)
+        for rescore_factor in rescore_factors:
+            started = time.perf_counter()
+            if rescore_factor > 0:
+                results = [quantized.search(query, limit, rescore_factor)[0] for query in queries]
+            else:
+                results = [top_k(quantized.approximate_scores(query), limit) for query in queries]
+            latency = (time.perf_counter() - started) / len(queries)
+            recall = np.mean([len(exact & set(rows.tolist())) / len(exact) for exact, rows in zip(exact_results, results)])
+            rescore = f"{rescore_factor}x" if rescore_factor > 0 else "none"
+            print(f"{kind:>5}  {bytes_per_vector:>6.0f}  {rescore:>7}  {recall:>7.4f}  {latency * 1000:>9.3f}  {exact_latency / latency:>7.1f}x")
+
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name = "all-MiniLM-L6-v2") -> None:
+    def __init__(self, model_name = EMBEDDING_MODEL) -> None:
         super().__init__(model_name)
         self.chunk_embeddings = None
-        self.chunk_metadata = None        
+        self.chunk_metadata = None
+        # Movie position of every chunk row, the grouping for the per-movie maximum
+        self.chunk_movie_indexes = None
+        # Near-duplicate clusters: representative movie position -> member positions, only the representative is embedded
+        self.duplicates = {}
+        # Approximate nearest neighbour graph over chunk_embeddings, if one has been built
+        self.hnsw = None
+        # Compressed codes of chunk_embeddings for the coarse scan, if they have been quantized
+        self.quantized = None
 
-    def build_chunk_embeddings(self, documents: list[dict]):
+    def build_chunk_embeddings(self, documents: DocumentStore, deduplicate: bool = True, quantization: str | None = None, workers: int | None = None):
         self.documents = documents
-        self.document_map = {}
 
         chunk_list = []
-        chunk_dict = []
+        movie_indexes = []
+        chunk_indexes = []
+        chunk_totals = []
+        self.duplicates = {}
+        if deduplicate:
+            self.duplicates = {cluster[0]: cluster[1:] for cluster in find_near_duplicates(self.documents)}
+        duplicate_positions = {member for members in self.duplicates.values() for member in members}
+        skipped_chunks = 0
 
         # Iterate over all documents
-        for i in range(0, len(self.documents)):
-            doc = self.documents[i]
+        for i, doc in enumerate(self.documents):
 
             # Skip document if there is no description
             if not doc['description'] or not doc['description'].strip():
@@ -47,64 +181,170 @@ class ChunkedSemanticSearch(SemanticSearch):
 
             # Generate chunks fpr current document description and add all chunks to the overall chunks-list
             doc_chunks = semantic_chunking(doc['description'], 4, 1)
+
+            # Near-duplicates share the embeddings of their representative
+            if i in duplicate_positions:
+                skipped_chunks += len(doc_chunks)
+                continue
+
             chunk_list.extend(doc_chunks)
 
-            # Iterate over chunks of current document description and add a dictionary for each chunk to store movie-index, relative chunk-index and number of chunks of current document-description
-            for j in range(0, len(doc_chunks)):
-                chunk_dict.append({'movie_idx': i, 'chunk_idx': j, 'total_chunks': len(doc_chunks)})
+            # Store movie-index, relative chunk-index and number of chunks of current document-description for each chunk
+            movie_indexes.extend([i] * len(doc_chunks))
+            chunk_indexes.extend(range(len(doc_chunks)))
+            chunk_totals.extend([len(doc_chunks)] * len(doc_chunks))
         
         print(f"Length chunk list: {len(chunk_list)}")
         print(f"1: {chunk_list[0]}")
+        if duplicate_positions:
+            print(f"Near-duplicates: skipped {len(duplicate_positions)} documents, embedding {len(chunk_list)} instead of {len(chunk_list) + skipped_chunks} chunks "
+                  f"({skipped_chunks * 100 / (len(chunk_list) + skipped_chunks):.1f}% fewer)")
+
+        # Only chunks whose text changed since the last build are encoded again, keyed by content hash.
+        # They are encoded by a pool of worker processes, and a build that was interrupted resumes from its checkpoints.
+        hashes = content_hashes(chunk_list, self.model_name)
+        stored_metadata = self.chunk_metadata if self.chunk_metadata is not None else open_chunk_metadata()
+        stored_embeddings = self.chunk_embeddings
+        if stored_embeddings is None and stored_metadata is not None and os.path.exists(CHUNK_EMBEDDINGS_PATH):
+            stored_embeddings = open_embeddings(CHUNK_EMBEDDINGS_PATH)
 
         # Set object-attributes 
-        self.chunk_embeddings = self.model.encode(chunk_list, show_progress_bar=True)
-        self.chunk_metadata = chunk_dict
-        
+        self.chunk_embeddings = reuse_embeddings(chunk_list, hashes, stored_metadata.content_hash if stored_metadata is not None else None, stored_embeddings,
+                                                 lambda texts: normalize_embeddings(encode_resumable(texts, self.model_name, CHUNK_BUILD_DIR, workers)))
+
+        # A graph over the previous embeddings would point at the wrong rows
+        self.hnsw = None
+        if os.path.exists(CHUNK_HNSW_PATH):
+            os.remove(CHUNK_HNSW_PATH)
+
         # Save Metadata and Embeddings to file
         if not os.path.isdir(CACHE_DIR):
             os.mkdir(CACHE_DIR)
 
-        np.save(open(CHUNK_EMBEDDINGS_PATH, "wb"), self.chunk_embeddings)
-        json.dump({"chunks": self.chunk_metadata, "total_chunks": len(chunk_list)}, open(CHUNK_METADATA_PATH, "w"), indent=2)
+        save_embeddings_file(CHUNK_EMBEDDINGS_PATH, self.chunk_embeddings)
+        write_chunk_metadata(CHUNK_METADATA_PATH, np.array(movie_indexes, dtype=np.uint32), np.array(chunk_indexes, dtype=np.uint32),
+                             np.array(chunk_totals, dtype=np.uint32), hashes, self.duplicates, self.source_fingerprint(documents))
+        if os.path.exists(LEGACY_CHUNK_METADATA_PATH):
+            os.remove(LEGACY_CHUNK_METADATA_PATH)
+        clear_checkpoints(CHUNK_BUILD_DIR)
+        self.chunk_metadata = ChunkMetadata.open(CHUNK_METADATA_PATH)
+        self.chunk_movie_indexes = self.chunk_metadata.movie_idx
+        self.quantize_chunk_embeddings(quantization)
 
         # Return Embeddings
         return self.chunk_embeddings
     
-    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
-        
+    def load_or_create_chunk_embeddings(self, documents: DocumentStore, workers: int | None = None) -> np.ndarray:
+
+        # Records are fetched from the store by position only for the movies that make it into the results
         self.documents = documents
-        
-        for doc in documents:
-            self.document_map[doc['id']] = doc
 
-        if os.path.exists(CHUNK_EMBEDDINGS_PATH) and os.path.exists(CHUNK_METADATA_PATH):
-            self.chunk_embeddings = np.load(CHUNK_EMBEDDINGS_PATH)            
-            data = json.load(open(CHUNK_METADATA_PATH, "r"))
-            self.chunk_metadata = data["chunks"]
-            return self.embeddings
+        # Embeddings and metadata are memory-mapped: nothing is parsed per chunk, and processes on
+        # the same host share one page cache copy of the vectors
+        chunk_metadata = open_chunk_metadata() if os.path.exists(CHUNK_EMBEDDINGS_PATH) else None
+        if chunk_metadata is not None:
+            self.chunk_metadata = chunk_metadata
+            self.chunk_embeddings = open_embeddings(CHUNK_EMBEDDINGS_PATH)
+            # Anything else than the documents and model the chunks were built from is brought up to date
+            if len(chunk_metadata) == len(self.chunk_embeddings) and chunk_metadata.source_fingerprint == self.source_fingerprint(documents):
+                self.chunk_movie_indexes = chunk_metadata.movie_idx
+                self.duplicates = chunk_metadata.duplicates()
+                self.quantized = load_quantized_vectors(CHUNK_QUANTIZED_PATH, self.chunk_embeddings)
+                self.hnsw = load_hnsw_index(CHUNK_HNSW_PATH, self.chunk_embeddings)
+                return self.chunk_embeddings
 
-        return self.build_chunk_embeddings(documents)
+        quantized = load_quantized_vectors(CHUNK_QUANTIZED_PATH, self.chunk_embeddings) if self.chunk_embeddings is not None else None
+        return self.build_chunk_embeddings(documents, quantization=quantized.kind if quantized is not None else None, workers=workers)
+
+    def source_fingerprint(self, documents: DocumentStore) -> int:
+        return int(content_hashes([str(documents.fingerprint())], self.model_name)[0])
+
+    def cache_generation(self) -> tuple:
+        # The chunk metadata on disk records the documents and model the embeddings were built from
+        return (self.chunk_metadata.source_fingerprint, len(self.chunk_metadata),
+                self.quantized.kind if self.quantized is not None else None, self.hnsw is not None)
         
-    def search_chunks(self, query: str, limit: int = 10):
+    def quantize_chunk_embeddings(self, kind: str | None) -> None:
+        """Additionally store the chunk embeddings as int8 or product-quantized codes, which
+        search_chunks then scans instead of the float32 matrix; None removes the codes."""
+        self.quantized = None
+        if os.path.exists(CHUNK_QUANTIZED_PATH):
+            os.remove(CHUNK_QUANTIZED_PATH)
+        if kind:
+            self.quantized = QuantizedVectors.build(self.chunk_embeddings, kind)
+            self.quantized.save(CHUNK_QUANTIZED_PATH)
+
+    def build_hnsw_index(self, m: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION, progress: Callable[[int, int], None] | None = None) -> HNSWIndex:
+        self.hnsw = HNSWIndex.build(self.chunk_embeddings, m, ef_construction, progress=progress)
+        self.hnsw.save(CHUNK_HNSW_PATH)
+        return self.hnsw
+
+    def search_chunks(self, query: str, limit: int = 10, with_documents: bool = True, exact: bool = False, ef_search: int = HNSW_EF_SEARCH):
         
-        # Generate embedding of query
-        query_embedding = super().generate_embedding(query)
-        chunk_scores = []
+        query_embedding = normalize_embeddings(super().generate_embedding(query))
 
-        # Iterate over all chunks and calculate the cosine similarity with the embeddings of the query, store result in list (idx of movie in documents etc.)
-        for i in range(0, len(self.chunk_embeddings)):            
-            cosine_similarity_score = cosine_similarity(self.chunk_embeddings[i], query_embedding)
-            chunk_scores.append({'chunk_idx': self.chunk_metadata[i]['chunk_idx'], 'movie_idx': self.chunk_metadata[i]['movie_idx'], 'score': cosine_similarity_score})            
+        method = self.__approximate_method(limit, exact)
+        if method is not None:
+            return self.__approximate_search(method, query_embedding, limit, with_documents, ef_search)
+        # Cosine similarity of the query with every (normalized) chunk in one matrix-vector product
+        movies, movie_scores = self.__movie_scores(self.chunk_embeddings @ query_embedding)
+        return self.__format_movies(movies, movie_scores, limit, with_documents)
 
-        movie_index_score_dict = {}
+    def batch_search_chunks(self, queries: list[str], limit: int = 10, with_documents: bool = True, exact: bool = False, ef_search: int = HNSW_EF_SEARCH) -> list[list[dict]]:
+        """Return the search_chunks() results of every query, found the same way. The queries are
+        embedded in one batch, and exact search scores them against the chunks as one matrix-matrix product."""
+        query_embeddings = normalize_embeddings(self.generate_embeddings(queries))
+        method = self.__approximate_method(limit, exact)
+        if method is not None:
+            return [self.__approximate_search(method, query_embedding, limit, with_documents, ef_search) for query_embedding in query_embeddings]
+        results = []
+        # Blocks of queries whose score matrix stays below BATCH_SCORE_MATRIX_SIZE entries
+        block_size = max(1, BATCH_SCORE_MATRIX_SIZE // max(len(self.chunk_embeddings), 1))
+        for start in range(0, len(queries), block_size):
+            movies, movie_scores = self.__movie_scores(self.chunk_embeddings @ query_embeddings[start:start + block_size].T)
+            results.extend(self.__format_movies(movies, movie_scores[:, i], limit, with_documents) for i in range(movie_scores.shape[1]))
+        return results
 
-        # Store highest chunk-score for any movie in a dictionary mapping the movie-idx to the chunk_score-dictionary
-        for chunk_score in chunk_scores:
-            if chunk_score['movie_idx'] not in movie_index_score_dict or chunk_score['score'] > movie_index_score_dict[chunk_score['movie_idx']]:
-                movie_index_score_dict[chunk_score['movie_idx']] = chunk_score['score']
+    def __approximate_method(self, limit: int, exact: bool) -> str | None:
+        # A movie has several chunks, so the graph or the coarse scan of the quantized codes is asked for
+        # a few chunks per requested movie. Large result lists, as requested by the hybrid searches,
+        # are cheaper to compute exactly than with the graph.
+        if exact:
+            return None
+        if self.hnsw is not None and limit * CHUNK_CANDIDATES_PER_RESULT < HNSW_EXACT_FRACTION * len(self.chunk_embeddings):
+            return "hnsw"
+        if self.quantized is not None:
+            return "quantized"
+        return None
 
-        # Sort mapped movie-idx-scores by score, limit results and convert to a list
-        sorted_movie_chunk_scores = list(sorted(movie_index_score_dict.items(), key=lambda d: d[1], reverse=True))[0:limit]
+    def __approximate_search(self, method: str, query_embedding: np.ndarray, limit: int, with_documents: bool, ef_search: int) -> list[dict]:
+        candidate_count = limit * CHUNK_CANDIDATES_PER_RESULT
+        if method == "hnsw":
+            rows, chunk_scores = self.hnsw.search(query_embedding, candidate_count, ef_search)
+        else:
+            rows, chunk_scores = self.quantized.search(query_embedding, candidate_count)
+        movies, movie_of_chunk = np.unique(self.chunk_movie_indexes[rows], return_inverse=True)
+        movie_scores = np.full(len(movies), -np.inf, dtype=np.float32)
+        np.maximum.at(movie_scores, movie_of_chunk, chunk_scores)
+        return self.__format_movies(movies, movie_scores, limit, with_documents)
+
+    def __movie_scores(self, chunk_scores: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Best chunk per movie: maximum over each run of consecutive chunks of the same movie, then over runs.
+        # chunk_scores holds one row per chunk, and one column per query for a batch.
+        run_starts = np.flatnonzero(np.r_[True, self.chunk_movie_indexes[1:] != self.chunk_movie_indexes[:-1]]) if len(chunk_scores) else np.empty(0, dtype=np.intp)
+        all_movie_scores = np.full((len(self.documents),) + chunk_scores.shape[1:], -np.inf, dtype=np.float32)
+        if len(run_starts):
+            np.maximum.at(all_movie_scores, self.chunk_movie_indexes[run_starts], np.maximum.reduceat(chunk_scores, run_starts))
+        movies = np.unique(self.chunk_movie_indexes[run_starts])
+        return movies, all_movie_scores[movies]
+
+    def __format_movies(self, movies: np.ndarray, movie_scores: np.ndarray, limit: int, with_documents: bool) -> list[dict]:
+        # Top movies by score without sorting the whole catalog
+        sorted_movie_chunk_scores = [(int(movies[i]), float(movie_scores[i])) for i in top_k(movie_scores, limit)]
+
+        # Near-duplicates follow their representative with its score
+        if self.duplicates:
+            sorted_movie_chunk_scores = [(position, score) for movie_idx, score in sorted_movie_chunk_scores for position in [movie_idx] + self.duplicates.get(movie_idx, [])][0:limit]
 
         formatted_sorted_movies = []
 
@@ -112,6 +352,9 @@ class ChunkedSemanticSearch(SemanticSearch):
         for movie_idx, score in sorted_movie_chunk_scores:
             if movie_idx is None:
                 continue
+            if not with_documents:
+                formatted_sorted_movies.append({'id': self.documents.doc_id_at(movie_idx), 'score': round(score, 4)})
+                continue
             movie = self.documents[movie_idx]
             formatted_sorted_movies.append({'id': movie['id'],
                                             'title': movie['title'],
@@ -0,0 +1,224 @@
+import collections
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+
+from utility import load_movies
+from constants import CACHE_DIR, DATA_PATH, DOCUMENTS_PATH, DOCUMENT_CACHE_SIZE
+
+# On-disk layout, all integers in native byte order (checked through a byte order mark):
+#
+#   header | section table | doc_ids | sorted_doc_ids | sorted_positions | offsets | records
+#
+# Records are compact JSON, stored in the order they were written, so a position in the file
+# matches a position in the source list. sorted_doc_ids/sorted_positions map a doc_id to its
+# position with a binary search, offsets[i]:offsets[i + 1] is the byte range of record i. The
+# header holds the record count and a 64-bit BLAKE2b fingerprint of everything after the header,
+# computed once when the store is written.
+DOCUMENTS_MAGIC = b"RSEDOCS\0"
+DOCUMENTS_VERSION = 2
+BYTE_ORDER_MARK = 0x01020304
+HEADER_FORMAT = "=8sIIIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+SECTIONS = [
+    ("doc_ids", "I"),
+    ("sorted_doc_ids", "I"),
+    ("sorted_positions", "I"),
+    ("offsets", "Q"),
+    ("records", None),
+]
+SECTION_TABLE_FORMAT = "=" + "QQ" * len(SECTIONS)
+SECTION_TABLE_SIZE = struct.calcsize(SECTION_TABLE_FORMAT)
+
+def encode_documents(documents: Iterable[dict]) -> bytes:
+    """Encode movie records (dicts with an integer 'id') into the document store layout."""
+    doc_ids = []
+    offsets = [0]
+    records = bytearray()
+    for document in documents:
+        doc_ids.append(document['id'])
+        records += json.dumps(document, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        offsets.append(len(records))
+
+    doc_id_array = np.array(doc_ids, dtype=np.uint32)
+    sorted_positions = np.argsort(doc_id_array, kind="stable").astype(np.uint32)
+    payloads = [doc_id_array.tobytes(), doc_id_array[sorted_positions].tobytes(), sorted_positions.tobytes(),
+                np.array(offsets, dtype=np.uint64).tobytes(), bytes(records)]
+
+    section_table = []
+    body = bytearray()
+    offset = HEADER_SIZE + SECTION_TABLE_SIZE
+    for payload in payloads:
+        body += b"\0" * (-(offset + len(body)) % 8)
+        section_table.extend([offset + len(body), len(payload)])
+        body += payload
+
+    contents = struct.pack(SECTION_TABLE_FORMAT, *section_table) + bytes(body)
+    fingerprint = int.from_bytes(hashlib.blake2b(contents, digest_size=8).digest(), "little")
+    header = struct.pack(HEADER_FORMAT, DOCUMENTS_MAGIC, DOCUMENTS_VERSION, BYTE_ORDER_MARK, len(doc_ids), fingerprint)
+    return header + contents
+
+def write_documents(path: str, documents: Iterable[dict]) -> None:
+    buffer = encode_documents(documents)
+    # Replace atomically, processes that still map the old file keep reading it
+    with open(f"{path}.tmp", "wb") as documents_file:
+        documents_file.write(buffer)
+    os.replace(f"{path}.tmp", path)
+
+def append_document_updates(path: str, size: int, updates: dict[int, dict | None]) -> int:
+    """Append changes to a saved store to its update log instead of rewriting the store, one JSON
+    line {"id", "document"} per change, with a null document for a deletion. Only the first `size`
+    bytes, as recorded in the index manifest, are valid: the tail of an append that was never
+    recorded is truncated first. Returns the new size of the log."""
+    lines = bytearray()
+    for doc_id, document in sorted(updates.items()):
+        lines += json.dumps({"id": doc_id, "document": document}, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n"
+    with open(path, "ab") as log_file:
+        log_file.truncate(size)
+        log_file.write(lines)
+    return size + len(lines)
+
+def read_document_updates(path: str, size: int) -> dict[int, dict | None]:
+    """doc_id -> latest record, or None if deleted, from the first `size` bytes of an update log."""
+    if size == 0:
+        return {}
+    with open(path, "rb") as log_file:
+        lines = log_file.read(size)
+    if len(lines) != size:
+        raise ValueError("document update log is shorter than recorded, rebuild the index")
+    updates = {}
+    for line in lines.splitlines():
+        update = json.loads(line)
+        updates[update['id']] = update['document']
+    return updates
+
+class DocumentStore:
+    """Read-only movie records backed by an mmap, decoded one record at a time on demand.
+
+    Behaves like the list of movies it was written from (len, iteration and indexing by
+    position) and additionally looks records up by doc_id. Only the offset table is touched
+    until a record is requested, so memory use does not grow with the size of the descriptions.
+    Recently decoded records are kept in a small LRU cache.
+    """
+
+    def __init__(self, buffer, cache_size: int = DOCUMENT_CACHE_SIZE) -> None:
+        self.buffer = buffer
+        view = memoryview(buffer)
+        magic, version, byte_order_mark, self.count, self.stored_fingerprint = struct.unpack_from(HEADER_FORMAT, view, 0)
+        if magic != DOCUMENTS_MAGIC or version != DOCUMENTS_VERSION:
+            raise ValueError("unsupported document store format, rebuild it")
+        if byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError(f"document store was written on a host with a different byte order than {sys.byteorder}")
+
+        section_table = struct.unpack_from(SECTION_TABLE_FORMAT, view, HEADER_SIZE)
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = section_table[2 * i], section_table[2 * i + 1]
+            section = view[offset:offset + length]
+            setattr(self, name, section.cast(typecode) if typecode else section)
+        self.sorted_doc_ids_array = np.frombuffer(self.sorted_doc_ids, dtype=np.uint32)
+
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+
+    @classmethod
+    def open(cls, path: str, cache_size: int = DOCUMENT_CACHE_SIZE) -> "DocumentStore":
+        with open(path, "rb") as documents_file:
+            if os.fstat(documents_file.fileno()).st_size == 0:
+                raise ValueError("document store file is empty")
+            buffer = mmap.mmap(documents_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, cache_size)
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[dict], cache_size: int = DOCUMENT_CACHE_SIZE) -> "DocumentStore":
+        # In-memory store, e.g. for an index that has been built but not saved yet
+        return cls(encode_documents(documents), cache_size)
+
+    def close(self) -> None:
+        self.cache.clear()
+        for name, _ in SECTIONS:
+            getattr(self, name).release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, position: int) -> dict:
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError("document position out of range")
+        document = self.cache.get(position)
+        if document is not None:
+            self.cache.move_to_end(position)
+            return document
+        document = json.loads(bytes(self.records[self.offsets[position]:self.offsets[position + 1]]))
+        if self.cache_size > 0:
+            self.cache[position] = document
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return document
+
+    def __iter__(self) -> Iterator[dict]:
+        # Sequential scans bypass the LRU cache so they do not flush the hot records
+        for position in range(self.count):
+            yield json.loads(bytes(self.records[self.offsets[position]:self.offsets[position + 1]]))
+
+    def position(self, doc_id: int) -> int | None:
+        i = int(np.searchsorted(self.sorted_doc_ids_array, doc_id))
+        if i < self.count and self.sorted_doc_ids[i] == doc_id:
+            return self.sorted_positions[i]
+        return None
+
+    def contains(self, doc_id: int) -> bool:
+        return self.position(doc_id) is not None
+
+    def get(self, doc_id: int, default: dict | None = None) -> dict | None:
+        position = self.position(doc_id)
+        return self[position] if position is not None else default
+
+    def doc_id_at(self, position: int) -> int:
+        return self.doc_ids[position]
+
+    def fingerprint(self) -> int:
+        """64-bit BLAKE2b hash of the store, which changes with any record or their order. It is read
+        from the header, so it costs nothing however large the store is."""
+        return self.stored_fingerprint
+
+def read_header(path: str) -> tuple | None:
+    """(magic, version, byte order mark, count, fingerprint) of a store file, without mapping the rest."""
+    with open(path, "rb") as documents_file:
+        header = documents_file.read(HEADER_SIZE)
+    return struct.unpack(HEADER_FORMAT, header) if len(header) == HEADER_SIZE else None
+
+def read_fingerprint(path: str) -> int:
+    header = read_header(path)
+    if header is None or header[:2] != (DOCUMENTS_MAGIC, DOCUMENTS_VERSION):
+        raise ValueError("unsupported document store format, rebuild it")
+    return header[4]
+
+def is_current_format(path: str) -> bool:
+    header = read_header(path)
+    return header is not None and header[:2] == (DOCUMENTS_MAGIC, DOCUMENTS_VERSION)
+
+def load_document_store(path: str = DOCUMENTS_PATH, cache_size: int = DOCUMENT_CACHE_SIZE) -> DocumentStore | None:
+    """Open the document store of the movie dataset, (re)writing it first if movies.json is newer."""
+    try:
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(DATA_PATH) or not is_current_format(path):
+            movies = load_movies()
+            if movies is None:
+                return None
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            write_documents(path, movies['movies'])
+        return DocumentStore.open(path, cache_size)
+    except Exception as e:
+        print(f"Error loading document store: {e}")
+        return None
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+
+from lib.embedding_store import content_hashes
+from lib.model_registry import embedding_model
+from constants import EMBEDDING_BUILD_BATCH_SIZE, EMBEDDING_BUILD_BATCHES_PER_WORKER
+
+_worker_model = None
+
+def _init_worker(model_name: str, threads: int) -> None:
+    global _worker_model
+    # Set before the model loads, so the workers together use each core once instead of each using all of them
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    _worker_model = embedding_model(model_name)
+
+def _encode_batch(batch: tuple[int, list[str]]) -> tuple[int, np.ndarray]:
+    batch_index, texts = batch
+    return batch_index, np.asarray(_worker_model.encode(texts), dtype=np.float32)
+
+def _print_progress(done: int, total: int, started: float) -> None:
+    percent = (done * 100) / total if total > 0 else 100.0
+    rate = done / max(time.perf_counter() - started, 1e-9)
+    print(f"\rEmbedded {done}/{total} texts ({percent:.1f}%, {rate:.0f} texts/s)", end="", flush=True)
+
+def clear_checkpoints(directory: str) -> None:
+    """Remove the checkpoints of encode_resumable() once its results have been saved."""
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+
+def encode_resumable(texts: list[str], model_name: str, directory: str, workers: int | None = None, batch_size: int = EMBEDDING_BUILD_BATCH_SIZE) -> np.ndarray:
+    """Encode texts across a process pool and return their embeddings in the order of texts.
+
+    Texts are sorted by length and cut into batches of similar length, which keeps the padding of
+    every batch small. Finished batches are written to a memory-mapped array in a subdirectory of
+    `directory` named after the texts, and marked done once they are on disk. Encoding the same
+    texts again after an interruption only encodes the batches that were not marked done, and
+    does not load the model at all if every batch is done. The embeddings are returned as one
+    array in memory; only the texts of the batches in flight are copied to the workers.
+    """
+    # Whitespace words stand in for tokens, the tokenizer lives in the workers
+    order = np.argsort([len(text.split()) for text in texts], kind="stable")
+    batches = [order[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+    fingerprint = hashlib.blake2b(content_hashes(texts, model_name).tobytes(), digest_size=8).hexdigest()
+    build_dir = os.path.join(directory, fingerprint)
+    manifest_path = os.path.join(build_dir, "manifest.json")
+    vectors = None
+    done_batches = np.zeros(len(batches), dtype=np.uint8)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['count'] == len(texts) and manifest['batch_size'] == batch_size:
+            vectors = np.load(os.path.join(build_dir, "vectors.npy"), mmap_mode="r+")
+            done_batches = np.load(os.path.join(build_dir, "done.npy"), mmap_mode="r+")
+            print(f"Resuming embedding build: {int(np.sum(done_batches))} of {len(batches)} batches already embedded")
+
+    def store(batch_index: int, embeddings: np.ndarray) -> None:
+        nonlocal vectors, done_batches
+        if vectors is None:
+            # Created with the first batch, which determines the dimension
+            os.makedirs(build_dir, exist_ok=True)
+            vectors = np.lib.format.open_memmap(os.path.join(build_dir, "vectors.npy"), mode="w+", dtype=np.float32, shape=(len(texts), embeddings.shape[1]))
+            np.save(os.path.join(build_dir, "done.npy"), done_batches)
+            done_batches = np.load(os.path.join(build_dir, "done.npy"), mmap_mode="r+")
+            with open(manifest_path, "w") as manifest_file:
+                json.dump({'count': len(texts), 'batch_size': batch_size, 'dimension': embeddings.shape[1]}, manifest_file)
+        start = batch_index * batch_size
+        vectors[start:start + len(embeddings)] = embeddings
+        # The vectors reach the disk before the batch is marked done
+        vectors.flush()
+        done_batches[batch_index] = 1
+        done_batches.flush()
+
+    def tasks(batch_indexes: list[int]):
+        # The texts of a batch are gathered only when it is handed out
+        return ((batch_index, [texts[i] for i in batches[batch_index]]) for batch_index in batch_indexes)
+
+    pending = [batch_index for batch_index in range(len(batches)) if not done_batches[batch_index]]
+    workers = min(workers or os.cpu_count() or 1, max(len(pending), 1))
+    done = len(texts) - sum(len(batches[batch_index]) for batch_index in pending)
+    started = time.perf_counter()
+
+    if workers > 1:
+        # Spawned, forked workers would inherit the parent's torch thread pools
+        context = multiprocessing.get_context("spawn")
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        # The pool reads its whole task iterable ahead, so it gets a few batches per worker at a time
+        window = workers * EMBEDDING_BUILD_BATCHES_PER_WORKER
+        with context.Pool(workers, initializer=_init_worker, initargs=(model_name, threads)) as pool:
+            for start in range(0, len(pending), window):
+                for batch_index, embeddings in pool.imap_unordered(_encode_batch, tasks(pending[start:start + window])):
+                    store(batch_index, embeddings)
+                    done += len(embeddings)
+                    _print_progress(done, len(texts), started)
+        print()
+    elif pending:
+        # Not reached if every batch was checkpointed before an interruption, so no model is loaded
+        model = embedding_model(model_name)
+        for batch_index, batch_texts in tasks(pending):
+            store(batch_index, np.asarray(model.encode(batch_texts), dtype=np.float32))
+            done += len(batch_texts)
+            _print_progress(done, len(texts), started)
+        print()
+
+    embeddings = np.empty(vectors.shape, dtype=np.float32)
+    embeddings[order] = vectors
+    return embeddings
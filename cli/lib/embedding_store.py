@@ -0,0 +1,44 @@
+import hashlib
+from collections.abc import Callable
+
+import numpy as np
+
+def content_hashes(texts: list[str], model_name: str) -> np.ndarray:
+    """64-bit BLAKE2b hash of every text together with the name of the model that embeds it, the
+    key under which its embedding is reused."""
+    prefix = f"{model_name}\n".encode("utf-8")
+    return np.array([int.from_bytes(hashlib.blake2b(prefix + text.encode("utf-8"), digest_size=8).digest(), "little") for text in texts], dtype=np.uint64)
+
+def reuse_embeddings(texts: list[str], hashes: np.ndarray, stored_hashes: np.ndarray | None, stored_embeddings: np.ndarray | None,
+                     encode: Callable[[list[str]], np.ndarray]) -> np.ndarray:
+    """Return the embeddings of texts, copying the stored row of every text whose hash is already
+    stored and encoding only the new or changed texts, each distinct text once. Stored rows that
+    no text hashes to any more are dropped."""
+    stored_rows = {}
+    if stored_hashes is not None and stored_embeddings is not None and len(stored_hashes) == len(stored_embeddings):
+        stored_rows = {content_hash: row for row, content_hash in enumerate(stored_hashes.tolist())}
+
+    targets = []
+    sources = []
+    # hash -> positions of the texts that need it encoded
+    missing = {}
+    for position, content_hash in enumerate(hashes.tolist()):
+        row = stored_rows.get(content_hash)
+        if row is None:
+            missing.setdefault(content_hash, []).append(position)
+        else:
+            targets.append(position)
+            sources.append(row)
+    dropped = len(stored_rows) - len(set(sources))
+    print(f"Embedding {len(missing)} new or changed of {len(texts)} texts, reusing {len(sources)}, dropping {dropped} stored embeddings")
+
+    encoded = encode([texts[positions[0]] for positions in missing.values()]) if missing else None
+    dimension = encoded.shape[1] if encoded is not None else stored_embeddings.shape[1] if sources else 0
+    embeddings = np.zeros((len(texts), dimension), dtype=np.float32)
+    if sources:
+        # Rows are read in file order, which keeps the reads of a memory-mapped matrix sequential
+        order = np.argsort(sources, kind="stable")
+        embeddings[np.array(targets)[order]] = stored_embeddings[np.array(sources)[order]]
+    for row, positions in enumerate(missing.values()):
+        embeddings[positions] = encoded[row]
+    return embeddings
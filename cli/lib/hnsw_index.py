@@ -0,0 +1,247 @@
+import heapq
+import math
+import mmap
+import os
+import struct
+import sys
+from collections.abc import Callable
+
+import numpy as np
+
+from constants import HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH
+
+# Hierarchical navigable small world graph over L2-normalized vectors, similarity is the dot
+# product. The vectors themselves are not stored, the graph is opened against the embedding
+# matrix it was built from. Layout, native byte order checked through a byte order mark:
+#
+#   header | section table | levels | layer0 | upper_nodes | upper_levels | upper_neighbours
+#
+# layer0 holds 2 * m neighbour slots per node, upper_neighbours m slots per (upper_nodes[i],
+# upper_levels[i]) entry; unused slots are -1.
+HNSW_MAGIC = b"RSEHNSW\0"
+HNSW_VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+HEADER_FORMAT = "=8sIIIIIIiI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+SECTIONS = [
+    ("levels", "B"),
+    ("layer0", "i"),
+    ("upper_nodes", "I"),
+    ("upper_levels", "B"),
+    ("upper_neighbours", "i"),
+]
+SECTION_TABLE_FORMAT = "=" + "QQ" * len(SECTIONS)
+SECTION_TABLE_SIZE = struct.calcsize(SECTION_TABLE_FORMAT)
+
+MAX_LEVEL = 15
+
+class HNSWIndex:
+    """Approximate nearest neighbour search in sub-linear time (Malkov & Yashunin).
+
+    Every vector is a node on layer 0 and, with exponentially decreasing probability, on the
+    layers above it. A query descends greedily through the sparse upper layers and then runs a
+    best-first search with a candidate list of ef_search nodes on layer 0. Larger m and
+    ef_construction build a denser graph (better recall, slower build), larger ef_search trades
+    query time for recall.
+    """
+
+    def __init__(self, vectors: np.ndarray, m: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION) -> None:
+        self.vectors = vectors
+        self.m = m
+        self.ef_construction = ef_construction
+        self.levels = np.zeros(len(vectors), dtype=np.uint8)
+        self.layer0 = np.full((len(vectors), 2 * m), -1, dtype=np.int32)
+        # (node, level) -> row of m neighbour slots, for the few nodes above layer 0
+        self.upper = {}
+        self.entry_point = -1
+        self.max_level = 0
+        # A node is visited in the current layer search if its mark equals the current visit stamp,
+        # which spares clearing a per-node array for every search
+        self.visit_marks = np.zeros(len(vectors), dtype=np.uint32)
+        self.visit_stamp = 0
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, m: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION, seed: int = 0,
+              progress: Callable[[int, int], None] | None = None) -> "HNSWIndex":
+        """Insert every vector; progress, if given, is called with (inserted, total) every 1000 vectors and at the end."""
+        index = cls(vectors, m, ef_construction)
+        rng = np.random.default_rng(seed)
+        levels = np.minimum(np.floor(-np.log(1.0 - rng.random(len(vectors))) / math.log(m)), MAX_LEVEL).astype(np.uint8)
+        for node in range(len(vectors)):
+            index.__insert(node, int(levels[node]))
+            if progress is not None and ((node + 1) % 1000 == 0 or node + 1 == len(vectors)):
+                progress(node + 1, len(vectors))
+        return index
+
+    def neighbours(self, node: int, level: int) -> np.ndarray:
+        row = self.layer0[node] if level == 0 else self.upper[(node, level)]
+        return row[row >= 0]
+
+    def __set_neighbours(self, node: int, level: int, nodes: list[int]) -> None:
+        row = self.layer0[node] if level == 0 else self.upper[(node, level)]
+        row[:] = -1
+        row[:len(nodes)] = nodes
+
+    def __search_layer(self, query: np.ndarray, entry_points: list[int], ef: int, level: int) -> list[tuple[float, int]]:
+        # Best-first search; returns up to ef (similarity, node) pairs, most similar first
+        self.visit_stamp += 1
+        if self.visit_stamp == 2 ** 32:
+            self.visit_marks[:] = 0
+            self.visit_stamp = 1
+        stamp = self.visit_stamp
+        marks = self.visit_marks
+        similarities = (self.vectors[entry_points] @ query).tolist()
+        marks[entry_points] = stamp
+        candidates = [(-similarity, node) for similarity, node in zip(similarities, entry_points)]
+        heapq.heapify(candidates)
+        results = [(similarity, node) for similarity, node in zip(similarities, entry_points)]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            negative_similarity, node = heapq.heappop(candidates)
+            if -negative_similarity < results[0][0] and len(results) >= ef:
+                break
+            neighbours = self.neighbours(node, level)
+            neighbours = neighbours[marks[neighbours] != stamp]
+            if len(neighbours) == 0:
+                continue
+            marks[neighbours] = stamp
+            similarities = self.vectors[neighbours] @ query
+            if len(results) >= ef:
+                # Only neighbours that beat the worst result can enter it
+                closer = similarities > results[0][0]
+                neighbours, similarities = neighbours[closer], similarities[closer]
+            for similarity, neighbour in zip(similarities.tolist(), neighbours.tolist()):
+                if len(results) < ef or similarity > results[0][0]:
+                    heapq.heappush(candidates, (-similarity, neighbour))
+                    heapq.heappush(results, (similarity, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted(results, reverse=True)
+
+    def __select_neighbours(self, candidates: list[tuple[float, int]], count: int) -> list[int]:
+        # Heuristic selection: skip a candidate that is closer to an already selected neighbour than
+        # to the new node, so the links spread in all directions; fill up with the skipped ones
+        if len(candidates) <= 1:
+            return [node for _, node in candidates]
+        nodes = [node for _, node in candidates]
+        pairwise = (self.vectors[nodes] @ self.vectors[nodes].T).tolist()
+        selected = []
+        skipped = []
+        for i, (similarity, node) in enumerate(candidates):
+            if len(selected) >= count:
+                break
+            if any(pairwise[i][j] > similarity for j in selected):
+                skipped.append(i)
+            else:
+                selected.append(i)
+        return [nodes[i] for i in selected + skipped[:count - len(selected)]]
+
+    def __insert(self, node: int, level: int) -> None:
+        self.levels[node] = level
+        for upper_level in range(1, level + 1):
+            self.upper[(node, upper_level)] = np.full(self.m, -1, dtype=np.int32)
+        if self.entry_point < 0:
+            self.entry_point = node
+            self.max_level = level
+            return
+
+        query = self.vectors[node]
+        entry_points = [self.entry_point]
+        for search_level in range(self.max_level, level, -1):
+            entry_points = [self.__search_layer(query, entry_points, 1, search_level)[0][1]]
+
+        for search_level in range(min(level, self.max_level), -1, -1):
+            candidates = self.__search_layer(query, entry_points, self.ef_construction, search_level)
+            neighbours = self.__select_neighbours(candidates, self.m)
+            self.__set_neighbours(node, search_level, neighbours)
+
+            capacity = 2 * self.m if search_level == 0 else self.m
+            for neighbour in neighbours:
+                links = self.neighbours(neighbour, search_level).tolist()
+                if len(links) < capacity:
+                    self.__set_neighbours(neighbour, search_level, links + [node])
+                else:
+                    # Over capacity: keep the best spread subset of the old links plus the new node
+                    links.append(node)
+                    similarities = (self.vectors[links] @ self.vectors[neighbour]).tolist()
+                    self.__set_neighbours(neighbour, search_level, self.__select_neighbours(sorted(zip(similarities, links), reverse=True), capacity))
+            entry_points = [candidate for _, candidate in candidates]
+
+        if level > self.max_level:
+            self.entry_point = node
+            self.max_level = level
+
+    def search(self, query: np.ndarray, limit: int, ef_search: int = HNSW_EF_SEARCH) -> tuple[np.ndarray, np.ndarray]:
+        """Return the (rows, similarities) of the approximately `limit` most similar vectors to a
+        normalized query, most similar first."""
+        if self.entry_point < 0 or limit <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        entry_points = [self.entry_point]
+        for level in range(self.max_level, 0, -1):
+            entry_points = [self.__search_layer(query, entry_points, 1, level)[0][1]]
+        results = self.__search_layer(query, entry_points, max(ef_search, limit), 0)[:limit]
+        return np.array([node for _, node in results], dtype=np.int64), np.array([similarity for similarity, _ in results], dtype=np.float32)
+
+    def encode(self) -> bytes:
+        keys = sorted(self.upper)
+        upper_neighbours = np.stack([self.upper[key] for key in keys]) if keys else np.empty((0, self.m), dtype=np.int32)
+        payloads = [self.levels.tobytes(), self.layer0.tobytes(), np.array([node for node, _ in keys], dtype=np.uint32).tobytes(),
+                    np.array([level for _, level in keys], dtype=np.uint8).tobytes(), upper_neighbours.astype(np.int32).tobytes()]
+
+        section_table = []
+        body = bytearray()
+        offset = HEADER_SIZE + SECTION_TABLE_SIZE
+        for payload in payloads:
+            body += b"\0" * (-(offset + len(body)) % 8)
+            section_table.extend([offset + len(body), len(payload)])
+            body += payload
+
+        header = struct.pack(HEADER_FORMAT, HNSW_MAGIC, HNSW_VERSION, BYTE_ORDER_MARK, len(self.vectors), self.vectors.shape[1],
+                             self.m, self.ef_construction, self.entry_point, self.max_level)
+        return header + struct.pack(SECTION_TABLE_FORMAT, *section_table) + bytes(body)
+
+    def save(self, path: str) -> None:
+        buffer = self.encode()
+        with open(f"{path}.tmp", "wb") as hnsw_file:
+            hnsw_file.write(buffer)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def open(cls, path: str, vectors: np.ndarray) -> "HNSWIndex":
+        with open(path, "rb") as hnsw_file:
+            buffer = mmap.mmap(hnsw_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(buffer)
+        magic, version, byte_order_mark, count, dimension, m, ef_construction, entry_point, max_level = struct.unpack_from(HEADER_FORMAT, view, 0)
+        if magic != HNSW_MAGIC or version != HNSW_VERSION:
+            raise ValueError("unsupported HNSW index format")
+        if byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError(f"HNSW index was written on a host with a different byte order than {sys.byteorder}")
+        if count != len(vectors) or dimension != vectors.shape[1]:
+            raise ValueError("HNSW index was built for different embeddings, rebuild it")
+
+        index = cls(vectors, m, ef_construction)
+        section_table = struct.unpack_from(SECTION_TABLE_FORMAT, view, HEADER_SIZE)
+        sections = {}
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = section_table[2 * i], section_table[2 * i + 1]
+            sections[name] = np.frombuffer(buffer, dtype=np.dtype(typecode), count=length // struct.calcsize(typecode), offset=offset)
+        index.levels = sections["levels"]
+        index.layer0 = sections["layer0"].reshape(count, 2 * m)
+        upper_neighbours = sections["upper_neighbours"].reshape(-1, m)
+        index.upper = {(int(node), int(level)): upper_neighbours[i] for i, (node, level) in enumerate(zip(sections["upper_nodes"], sections["upper_levels"]))}
+        index.entry_point = entry_point
+        index.max_level = max_level
+        return index
+
+def load_hnsw_index(path: str, vectors: np.ndarray) -> HNSWIndex | None:
+    if not os.path.exists(path):
+        return None
+    try:
+        return HNSWIndex.open(path, vectors)
+    except Exception as e:
+        print(f"Error loading HNSW index: {e}")
+        return None
@@ -1,12 +1,17 @@
 import os
 import time
 
-from sentence_transformers import CrossEncoder
-
+from lib.analyzer import Analyzer
 from lib.chunked_semantic_search import ChunkedSemanticSearch
 from inverted_index import InvertedIndex
-from utility import load_movies
+from lib.document_store import load_document_store
 from lib.llm import LLM
+from lib.model_registry import cross_encoder
+from lib.query_expansion import load_term_neighbours
+from lib.result_cache import ResultCache
+from lib.spell_corrector import correct_spelling
+from utility import load_stopwords
+from constants import CACHE_DIR, QUERY_EXPANSION_FAN_OUT, QUERY_EXPANSION_WEIGHT
 
 def normalize_scores(scores: list[float]) -> list[float]:
     
@@ -38,10 +43,22 @@ def normalize_command(scores: list[float]):
     for score in normalized_scores:
         print(f"* {score:.4f}")
 
-def weighted_search_command(query: str, alpha: float, limit: int):
-    documents = load_movies()
-    hybrid_search = HybridSearch(documents['movies'])
+def create_hybrid_search(documents, shards: int | None = None):
+    if shards:
+        # Imported here, the sharded search builds on HybridSearch
+        from lib.sharded_search import ShardedHybridSearch
+        return ShardedHybridSearch(documents, shards)
+    return HybridSearch(documents)
+
+def weighted_search_command(query: str, alpha: float, limit: int, shards: int | None = None):
+    documents = load_document_store()
+    try:
+        hybrid_search = create_hybrid_search(documents, shards)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
     results = hybrid_search.weighted_search(query, alpha, limit)
+    hybrid_search.save_result_cache()
 
     for idx, result in enumerate(results):
         print(f"{idx + 1}. {result[1]['document']['title']}")
@@ -49,24 +66,44 @@ def weighted_search_command(query: str, alpha: float, limit: int):
         print(f"BM25: {result[1]['bm25score']:.4f}, Semantic: {result[1]['semantic_score']:.4f}")
         print(f"{result[1]['document']['description'][:100]}...\n")
 
-def rrf_search_command(query: str, k: int, limit: int, enhance_choice: str, rerank_method: str, evaluate: bool):
-    documents = load_movies()
+def rrf_search_command(query: str, k: int, limit: int, enhance_choice: str, rerank_method: str, evaluate: bool, shards: int | None = None):
+    documents = load_document_store()
 
     llm = LLM("gemma-3-27b-it")
     rerank_limit = limit
+    expansion = 0
 
     if enhance_choice:
         
-        new_query = llm.enhance_query(query, enhance_choice)
+        term_neighbours = load_term_neighbours() if enhance_choice == "expand" else None
+        if enhance_choice == "spell":
+            # Local symmetric delete lookup, the LLM is only asked if the correction is uncertain
+            new_query = correct_spelling(query, llm)
+        elif term_neighbours is not None:
+            # Precomputed neighbour terms are added to the BM25 query with reduced weights
+            expansion = QUERY_EXPANSION_FAN_OUT
+            new_query = query
+            tokens = Analyzer(load_stopwords()).analyze(query)
+            weights = term_neighbours.expand(tokens, expansion, QUERY_EXPANSION_WEIGHT)
+            expansion_terms = [f"{token} ({weight:.2f})" for token, weight in weights.items() if token not in tokens]
+            if expansion_terms:
+                print(f"Enhanced query ({enhance_choice}): '{query}' + {', '.join(expansion_terms)}\n")
+        else:
+            new_query = llm.enhance_query(query, enhance_choice)
         if new_query != query:
            print(f"Enhanced query ({enhance_choice}): '{query}' -> '{new_query}'\n")
            query = new_query
 
-    hybrid_search = HybridSearch(documents['movies'])
+    try:
+        hybrid_search = create_hybrid_search(documents, shards)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
 
     if rerank_method == "individual":
         
-        results = hybrid_search.rrf_search(query, k, limit * 5)
+        results = hybrid_search.rrf_search(query, k, limit * 5, expansion)
+        hybrid_search.save_result_cache()
 
         for result in results:
 
@@ -86,7 +123,8 @@ def rrf_search_command(query: str, k: int, limit: int, enhance_choice: str, rera
     
     elif rerank_method == "batch":
         
-        results = hybrid_search.rrf_search(query, k, limit * 5)
+        results = hybrid_search.rrf_search(query, k, limit * 5, expansion)
+        hybrid_search.save_result_cache()
 
         ranked_movie_ids = llm.rerank_batch(query, results)[:limit]
 
@@ -108,16 +146,19 @@ def rrf_search_command(query: str, k: int, limit: int, enhance_choice: str, rera
 
     elif rerank_method == "cross_encoder":
 
-        results = dict(hybrid_search.rrf_search(query, k, limit * 5))
+        results = dict(hybrid_search.rrf_search(query, k, limit * 5, expansion))
+        hybrid_search.save_result_cache()
 
         pairs = []
 
         for key in results:
             pairs.append([query, f"{results[key]['document']['title']} - {results[key]['document']['description']}"])
 
-        cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
-
-        scores = cross_encoder.predict(pairs)
+        try:
+            scores = cross_encoder().predict(pairs)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
 
         for idx, key in enumerate(results):
             results[key]['cross_encoder_score'] = scores[idx]
@@ -134,7 +175,8 @@ def rrf_search_command(query: str, k: int, limit: int, enhance_choice: str, rera
 
     else:
 
-        results = hybrid_search.rrf_search(query, k, rerank_limit)
+        results = hybrid_search.rrf_search(query, k, rerank_limit, expansion)
+        hybrid_search.save_result_cache()
 
         formatted_evaluation_prompt_results = []
 
@@ -175,15 +217,89 @@ class HybridSearch:
         if not os.path.exists(self.idx.index_path):
             self.idx.build()
             self.idx.save()
-
-    def _bm25_search(self, query, limit):
-        self.idx.load()
-        return self.idx.bm25_search(query, limit)
+        else:
+            self.idx.load()
+
+        self.result_cache = ResultCache()
+        self.result_cache_path = os.path.join(CACHE_DIR, "hybrid_result_cache.json")
+        self.result_cache.load(self.result_cache_path)
+
+    def _cache_generation(self):
+        # Fused results depend on both the keyword index and the chunk embeddings
+        return (self.idx.cache_generation(), self.semantic_search.cache_generation())
+
+    def _save_result_cache(self):
+        try:
+            if self.result_cache.generation == self._cache_generation():
+                self.result_cache.save(self.result_cache_path)
+        except Exception as e:
+            print(f"Error: {e}")
+
+    def save_result_cache(self):
+        """Write the cached results to disk, where the next process with the same index and embeddings finds them."""
+        self.idx.save_result_cache()
+        if not self.idx.has_unsaved_changes():
+            self._save_result_cache()
+
+    def _cache_key(self, method, query, *params):
+        # Whitespace-normalized text, the analyzed tokens alone would not determine the query embedding
+        return (method, " ".join(query.split()), *params)
+
+    def _bm25_search(self, query, limit, expansion=0):
+        return self.idx.bm25_search(query, limit, with_documents=False, expansion=expansion)
+
+    def _search_chunks(self, query, limit):
+        return self.semantic_search.search_chunks(query, limit, with_documents=False)
+
+    def _get_document(self, doc_id):
+        document = self.idx.get_document(doc_id)
+        return document if document is not None else self.documents.get(doc_id)
+
+    def _batch_bm25_search(self, queries, limit, expansion=0):
+        return self.idx.batch_bm25_search(queries, limit, with_documents=False, expansion=expansion)
+
+    def _batch_search_chunks(self, queries, limit):
+        return self.semantic_search.batch_search_chunks(queries, limit, with_documents=False)
+
+    def _cached_search(self, keys, search):
+        # Runs search(positions) for the queries whose fused results are not cached, each distinct key once
+        generation = self._cache_generation()
+        results = {}
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in results or key in missing:
+                continue
+            cached = self.result_cache.get(key, generation)
+            if cached is not None:
+                results[key] = cached
+            else:
+                missing[key] = i
+        if missing:
+            for key, sorted_scores in zip(missing, search(list(missing.values()))):
+                self.result_cache.put(key, generation, sorted_scores)
+                results[key] = sorted_scores
+        # Callers annotate the result dicts (e.g. rerank scores), so hand out copies
+        return [[(doc_id, dict(result)) for doc_id, result in results[key]] for key in keys]
 
     def weighted_search(self, query, alpha, limit):
-        bm25_results = self._bm25_search(query, 500 * limit)
-        chunked_search_results = self.semantic_search.search_chunks(query, 500 * limit)
+        def search(positions):
+            return [self._weighted_fusion(self._bm25_search(query, 500 * limit), self._search_chunks(query, 500 * limit), alpha, limit)]
+
+        return self._cached_search([self._cache_key("weighted", query, alpha, limit)], search)[0]
+
+    def batch_weighted_search(self, queries, alpha, limit):
+        """Return the weighted_search() results of every query. Both legs score all queries in one
+        batch: one encode call and one matrix-matrix product for the semantic leg, one sparse
+        query-term x term-document product for BM25."""
+        def search(positions):
+            batch = [queries[i] for i in positions]
+            bm25_results = self._batch_bm25_search(batch, 500 * limit)
+            chunked_search_results = self._batch_search_chunks(batch, 500 * limit)
+            return [self._weighted_fusion(bm25, chunks, alpha, limit) for bm25, chunks in zip(bm25_results, chunked_search_results)]
 
+        return self._cached_search([self._cache_key("weighted", query, alpha, limit) for query in queries], search)
+
+    def _weighted_fusion(self, bm25_results, chunked_search_results, alpha, limit):
         weighted_scores = {}
         bm25_scores = []
         semantic_scores = []
@@ -199,7 +315,7 @@ class HybridSearch:
 
         for idx, result in enumerate(bm25_results):
             normalized_score = normalized_bm25_scores[idx]
-            weighted_scores[result['doc_id']] = {'bm25score': normalized_score, 'semantic_score': 0, 'hybrid_score': 0, 'document': result['movie']}
+            weighted_scores[result['doc_id']] = {'bm25score': normalized_score, 'semantic_score': 0, 'hybrid_score': 0}
 
         for idx, result in enumerate(chunked_search_results):
             normalized_score = normalized_semantic_scores[idx]
@@ -207,33 +323,53 @@ class HybridSearch:
             if result['id'] in weighted_scores:
                 weighted_scores[result['id']]['semantic_score'] = normalized_score
             else:
-                weighted_scores[result['id']] = {'bm25score': 0, 'semantic_score': normalized_score, 'hybrid_score':0, 'document': self.semantic_search.document_map[result['id']]}
+                weighted_scores[result['id']] = {'bm25score': 0, 'semantic_score': normalized_score, 'hybrid_score':0}
 
         for entry in weighted_scores.items():
             entry[1]['hybrid_score'] = hybrid_score(entry[1]['bm25score'], entry[1]['semantic_score'], alpha)
 
         sorted_scores = list(sorted(weighted_scores.items(), key=lambda d: d[1]['hybrid_score'], reverse=True))[0:limit]
 
+        # Only the records that survive the fusion are fetched from the document stores
+        for doc_id, result in sorted_scores:
+            result['document'] = self._get_document(doc_id)
+
         return sorted_scores
 
-    def rrf_search(self, query, k, limit):
+    def rrf_search(self, query, k, limit, expansion=0):
+        def search(positions):
+            # Expansion terms only widen the keyword side, the query embedding already covers synonyms
+            return [self._rrf_fusion(self._bm25_search(query, 500 * limit, expansion), self._search_chunks(query, 500 * limit), k, limit)]
+
+        return self._cached_search([self._cache_key("rrf", query, k, limit, expansion)], search)[0]
 
-        bm25_results = self._bm25_search(query, 500 * limit)
-        chunked_search_results = self.semantic_search.search_chunks(query, 500 * limit)
+    def batch_rrf_search(self, queries, k, limit, expansion=0):
+        """Return the rrf_search() results of every query, with both legs scored in one batch as in
+        batch_weighted_search()."""
+        def search(positions):
+            batch = [queries[i] for i in positions]
+            bm25_results = self._batch_bm25_search(batch, 500 * limit, expansion)
+            chunked_search_results = self._batch_search_chunks(batch, 500 * limit)
+            return [self._rrf_fusion(bm25, chunks, k, limit) for bm25, chunks in zip(bm25_results, chunked_search_results)]
 
+        return self._cached_search([self._cache_key("rrf", query, k, limit, expansion) for query in queries], search)
+
+    def _rrf_fusion(self, bm25_results, chunked_search_results, k, limit):
         rrf_score_dict = {}
 
         for idx, result in enumerate(bm25_results):
-            rrf_score_dict[result['doc_id']] = {'document': result['movie'], 'rrf_score': rrf_score(idx + 1, k), 'bm25_rank': idx + 1, 'semantic_rank': None}
+            rrf_score_dict[result['doc_id']] = {'rrf_score': rrf_score(idx + 1, k), 'bm25_rank': idx + 1, 'semantic_rank': None}
 
         for idx, result in enumerate(chunked_search_results):
             if result['id'] in rrf_score_dict:
                 rrf_score_dict[result['id']]['rrf_score'] += rrf_score(idx + 1, k)
                 rrf_score_dict[result['id']]['semantic_rank'] = idx + 1
             else:
-                rrf_score_dict[result['id']] = {'document': self.semantic_search.document_map[result['id']], 'rrf_score': rrf_score(idx + 1, k), 'bm25_rank': None, 'semantic_rank': idx + 1}
+                rrf_score_dict[result['id']] = {'rrf_score': rrf_score(idx + 1, k), 'bm25_rank': None, 'semantic_rank': idx + 1}
         
         sorted_scores = list(sorted(rrf_score_dict.items(), key=lambda d: d[1]['rrf_score'], reverse=True))[0:limit]
 
-        return sorted_scores
+        for doc_id, result in sorted_scores:
+            result['document'] = self._get_document(doc_id)
 
+        return sorted_scores
@@ -0,0 +1,90 @@
+import heapq
+import itertools
+import multiprocessing
+import os
+import time
+from collections.abc import Iterator
+
+from lib.analyzer import Analyzer
+from constants import INDEX_BUILD_BATCH_SIZE
+
+_worker_analyzer = None
+
+def _init_worker(stopwords: list[str]) -> None:
+    global _worker_analyzer
+    _worker_analyzer = Analyzer(stopwords)
+
+def token_positions(tokens: list) -> dict:
+    # token (or token id) -> positions. Positions count analyzed tokens, so a phrase matches across removed stopwords
+    positions = {}
+    for position, token in enumerate(tokens):
+        if token in positions:
+            positions[token].append(position)
+        else:
+            positions[token] = [position]
+    return positions
+
+def _invert_batch(documents: list[tuple[int, str]]) -> tuple[list[tuple[str, int, int, list[int]]], dict[int, int], tuple[int, int]]:
+    # SPIMI-style partial run: every (token, doc_id, tf, positions) of the batch, sorted so runs can be merged in one pass
+    run = []
+    doc_lengths = {}
+    lookups, misses = _worker_analyzer.lookups, _worker_analyzer.misses
+    for doc_id, text in documents:
+        # Group by integer vocabulary id, the token strings are only needed once per posting
+        token_ids = _worker_analyzer.token_ids(text)
+        doc_lengths[doc_id] = len(token_ids)
+        for token_id, positions in token_positions(token_ids).items():
+            run.append((_worker_analyzer.token(token_id), doc_id, len(positions), positions))
+    run.sort()
+    return run, doc_lengths, (_worker_analyzer.lookups - lookups, _worker_analyzer.misses - misses)
+
+def _print_progress(done: int, total: int, started: float) -> None:
+    percent = (done * 100) / total if total > 0 else 100.0
+    rate = done / max(time.perf_counter() - started, 1e-9)
+    print(f"\rTokenized {done}/{total} documents ({percent:.1f}%, {rate:.0f} docs/s)", end="", flush=True)
+
+def merge_runs(runs: list[list[tuple[str, int, int, list[int]]]]) -> Iterator[tuple[str, list[tuple[int, int, list[int]]]]]:
+    """Merge sorted partial runs into (token, [(doc_id, tf, positions), ...]) in token order."""
+    merged = heapq.merge(*runs)
+    for token, entries in itertools.groupby(merged, key=lambda entry: entry[0]):
+        yield token, [(doc_id, tf, positions) for _, doc_id, tf, positions in entries]
+
+def build_postings(documents: list[tuple[int, str]], stopwords: list[str], workers: int | None = None, batch_size: int = INDEX_BUILD_BATCH_SIZE) -> tuple[dict[int, int], Iterator[tuple[str, list[tuple[int, int, list[int]]]]]]:
+    """Tokenize (doc_id, text) pairs across a process pool and return (doc_lengths, merged postings).
+
+    Each batch of documents is inverted into a sorted run by a worker process; the runs are then
+    merged lazily in a single pass, so the cost of a build is bounded by tokenization throughput.
+    """
+    batches = [documents[i:i + batch_size] for i in range(0, len(documents), batch_size)]
+    workers = min(workers or os.cpu_count() or 1, max(len(batches), 1))
+
+    runs = []
+    doc_lengths = {}
+    lookups = misses = 0
+    done = 0
+    started = time.perf_counter()
+
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(stopwords,)) as pool:
+            for run, run_doc_lengths, (run_lookups, run_misses) in pool.imap_unordered(_invert_batch, batches):
+                runs.append(run)
+                lookups += run_lookups
+                misses += run_misses
+                doc_lengths.update(run_doc_lengths)
+                done += len(run_doc_lengths)
+                _print_progress(done, len(documents), started)
+    else:
+        _init_worker(stopwords)
+        for batch in batches:
+            run, run_doc_lengths, (run_lookups, run_misses) = _invert_batch(batch)
+            runs.append(run)
+            lookups += run_lookups
+            misses += run_misses
+            doc_lengths.update(run_doc_lengths)
+            done += len(run_doc_lengths)
+            _print_progress(done, len(documents), started)
+
+    hit_rate = (lookups - misses) * 100 / lookups if lookups > 0 else 0.0
+    print(f"\nAnalyzer cache: {hit_rate:.1f}% hits, {misses} of {lookups} words analyzed")
+    print(f"Merging {len(runs)} runs")
+    return doc_lengths, merge_runs(runs)
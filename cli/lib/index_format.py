@@ -0,0 +1,270 @@
+import array
+import bisect
+import math
+import mmap
+import struct
+import sys
+from collections.abc import Iterable
+
+import numpy as np
+
+from constants import DEFAULT_BM25_K1, DEFAULT_BM25_B, BM25_BLOCK_SIZE
+
+# Single-file index layout (native byte order, checked on open):
+#
+#   header    magic, version, byte order mark, counts and BM25 collection statistics
+#   sections  one (offset, length) pair per entry of SECTIONS, each section aligned to 8 bytes
+#
+# Terms are stored in code point order, which is also the order of their UTF-8 bytes, so a term
+# id is its rank in the dictionary.
+# Documents are addressed by ordinal, the rank of their doc_id. Postings of a term are split into
+# blocks of BM25_BLOCK_SIZE ordinals; each block is delta + varint encoded relative to the last
+# ordinal of the previous block, so any block can be decoded on its own. Positional indexes also
+# store, per posting, the delta + varint encoded token positions of the term in the document.
+INDEX_MAGIC = b"RSEINDEX"
+INDEX_VERSION = 2
+FLAG_POSITIONAL = 0x1
+BYTE_ORDER_MARK = 0x01020304
+
+HEADER_FORMAT = "=8sIIIIQQIIddd"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+SECTIONS = [
+    ("term_offsets", "Q"),       # [term_count + 1] byte offsets into term_bytes
+    ("term_bytes", None),        # concatenated sorted terms
+    ("doc_ids", "I"),            # [doc_count] doc_id of every ordinal, ascending
+    ("doc_lengths", "I"),        # [doc_count] token count of every ordinal
+    ("length_norms", "f"),       # [doc_count] BM25 length normalization 1 - b + b * dl / avgdl
+    ("doc_frequencies", "I"),    # [term_count]
+    ("posting_starts", "Q"),     # [term_count + 1] index of a term's first posting in frequencies/impacts
+    ("block_starts", "Q"),       # [term_count + 1] index of a term's first block
+    ("block_last_ordinals", "I"),  # [block_count] last ordinal in every block
+    ("block_max_impacts", "f"),  # [block_count] largest impact in every block
+    ("block_offsets", "Q"),      # [block_count + 1] byte offset of every block in postings
+    ("frequencies", "I"),        # [posting_count] term frequency of every posting
+    ("impacts", "f"),            # [posting_count] BM25 impact of every posting
+    ("postings", None),          # delta + varint encoded ordinals
+    ("position_offsets", "Q"),   # [posting_count + 1] byte offset of every posting's positions, empty if not positional
+    ("positions", None),         # delta + varint encoded token positions
+]
+SECTION_TABLE_FORMAT = "=" + "QQ" * len(SECTIONS)
+SECTION_TABLE_SIZE = struct.calcsize(SECTION_TABLE_FORMAT)
+
+def encode_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varints(data, start: int, end: int, base: int) -> list[int]:
+    # Decode consecutive varint deltas in data[start:end] into absolute values starting from base
+    values = []
+    value = 0
+    shift = 0
+    for i in range(start, end):
+        byte = data[i]
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            base += value
+            values.append(base)
+            value = 0
+            shift = 0
+    return values
+
+def decode_varint_array(data: np.ndarray) -> np.ndarray:
+    # Vectorized counterpart of decode_varints with base 0, for a uint8 array of whole varints
+    is_last = (data & 0x80) == 0
+    value_ends = np.flatnonzero(is_last)
+    value_starts = np.concatenate(([0], value_ends[:-1] + 1))
+    value_index = np.cumsum(is_last) - is_last
+    shifts = 7 * (np.arange(len(data)) - value_starts[value_index])
+    parts = (data & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.cumsum(np.add.reduceat(parts, value_starts)) if len(data) > 0 else np.zeros(0, dtype=np.uint64)
+
+def encode_index(doc_lengths: dict[int, int], postings: Iterable[tuple[str, list[tuple[int, int, list[int] | None]]]], positional: bool = False, k1: float = DEFAULT_BM25_K1, b: float = DEFAULT_BM25_B, block_size: int = BM25_BLOCK_SIZE) -> bytes:
+    """Serialize documents and postings into the single-file index format.
+
+    postings yields (token, [(doc_id, term frequency, positions), ...]) in token order, with every
+    list sorted by doc_id, so it can be streamed straight from a merge. positions are only stored
+    if positional is set and may be None otherwise. Document frequencies, the average
+    document length, length norms, BM25 impacts and per-block maxima are all computed here, once.
+    """
+    doc_ids = sorted(doc_lengths)
+    ordinals = {doc_id: ordinal for ordinal, doc_id in enumerate(doc_ids)}
+    doc_count = len(doc_ids)
+    avg_doc_length = sum(doc_lengths.values()) / doc_count if doc_count > 0 else 0.0
+
+    columns = {name: array.array(typecode) for name, typecode in SECTIONS if typecode}
+    term_bytes = bytearray()
+    posting_bytes = bytearray()
+    position_bytes = bytearray()
+
+    for doc_id in doc_ids:
+        columns["doc_ids"].append(doc_id)
+        columns["doc_lengths"].append(doc_lengths[doc_id])
+        columns["length_norms"].append(1 - b + b * (doc_lengths[doc_id] / avg_doc_length) if avg_doc_length > 0 else 1.0)
+    # Read the norms back from the float32 column so impacts match what a query would recompute
+    length_norms = columns["length_norms"]
+
+    term_count = 0
+    columns["term_offsets"].append(0)
+    columns["posting_starts"].append(0)
+    columns["block_starts"].append(0)
+    columns["block_offsets"].append(0)
+    if positional:
+        columns["position_offsets"].append(0)
+
+    for term, doc_postings in postings:
+        term_count += 1
+        term_bytes += term.encode("utf-8")
+        columns["term_offsets"].append(len(term_bytes))
+
+        term_postings = [(ordinals[doc_id], tf, positions) for doc_id, tf, positions in doc_postings]
+        term_doc_count = len(term_postings)
+        idf = math.log((doc_count - term_doc_count + 0.5) / (term_doc_count + 0.5) + 1)
+        columns["doc_frequencies"].append(term_doc_count)
+
+        for start in range(0, term_doc_count, block_size):
+            block = term_postings[start:start + block_size]
+            previous = columns["block_last_ordinals"][-1] if start > 0 else 0
+            block_impacts = array.array("f")
+            for ordinal, tf, positions in block:
+                encode_varint(ordinal - previous, posting_bytes)
+                previous = ordinal
+                columns["frequencies"].append(tf)
+                if positional:
+                    previous_position = 0
+                    for position in positions:
+                        encode_varint(position - previous_position, position_bytes)
+                        previous_position = position
+                    columns["position_offsets"].append(len(position_bytes))
+                block_impacts.append(idf * (tf * (k1 + 1)) / (tf + k1 * length_norms[ordinal]))
+
+            columns["impacts"].extend(block_impacts)
+            columns["block_last_ordinals"].append(previous)
+            columns["block_max_impacts"].append(max(block_impacts))
+            columns["block_offsets"].append(len(posting_bytes))
+
+        columns["posting_starts"].append(len(columns["frequencies"]))
+        columns["block_starts"].append(len(columns["block_last_ordinals"]))
+
+    header = struct.pack(HEADER_FORMAT, INDEX_MAGIC, INDEX_VERSION, BYTE_ORDER_MARK, FLAG_POSITIONAL if positional else 0, doc_count,
+                         term_count, len(columns["block_last_ordinals"]), len(columns["frequencies"]), block_size, k1, b, avg_doc_length)
+
+    payloads = []
+    for name, typecode in SECTIONS:
+        if name == "term_bytes":
+            payloads.append(bytes(term_bytes))
+        elif name == "postings":
+            payloads.append(bytes(posting_bytes))
+        elif name == "positions":
+            payloads.append(bytes(position_bytes))
+        else:
+            payloads.append(columns[name].tobytes())
+
+    section_table = []
+    body = bytearray()
+    offset = HEADER_SIZE + SECTION_TABLE_SIZE
+    for payload in payloads:
+        padding = -(offset + len(body)) % 8
+        body += b"\0" * padding
+        section_table.extend([offset + len(body), len(payload)])
+        body += payload
+
+    return header + struct.pack(SECTION_TABLE_FORMAT, *section_table) + bytes(body)
+
+class MappedIndex:
+    """Read-only view over an encoded index, usable directly on an mmap without deserializing it."""
+
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+        view = memoryview(buffer)
+
+        (magic, version, byte_order_mark, flags, self.doc_count, self.term_count, self.block_count, self.posting_count,
+         self.block_size, self.k1, self.b, self.avg_doc_length) = struct.unpack_from(HEADER_FORMAT, view, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError("unsupported index file format")
+        if byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError(f"index file was written on a host with a different byte order than {sys.byteorder}")
+        self.positional = bool(flags & FLAG_POSITIONAL)
+
+        section_table = struct.unpack_from(SECTION_TABLE_FORMAT, view, HEADER_SIZE)
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = section_table[2 * i], section_table[2 * i + 1]
+            section = view[offset:offset + length]
+            setattr(self, name, section.cast(typecode) if typecode else section)
+
+        # Zero-copy NumPy views for vectorized scoring. Together with posting_starts and the
+        # varint ordinals they form a compressed sparse row matrix with one row per term id.
+        self.postings_array = np.frombuffer(self.postings, dtype=np.uint8)
+        self.frequencies_array = np.frombuffer(self.frequencies, dtype=np.uint32)
+        self.doc_lengths_array = np.frombuffer(self.doc_lengths, dtype=np.uint32)
+        self.doc_ids_array = np.frombuffer(self.doc_ids, dtype=np.uint32)
+
+    @classmethod
+    def open(cls, path: str) -> "MappedIndex":
+        with open(path, "rb") as index_file:
+            return cls(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def close(self) -> None:
+        del self.postings_array, self.frequencies_array, self.doc_lengths_array, self.doc_ids_array
+        for name, _ in SECTIONS:
+            getattr(self, name).release()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def term(self, term_id: int) -> str:
+        return bytes(self.term_bytes[self.term_offsets[term_id]:self.term_offsets[term_id + 1]]).decode("utf-8")
+
+    def term_id(self, term: str) -> int | None:
+        # Binary search over the sorted term dictionary
+        key = term.encode("utf-8")
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.term_bytes[self.term_offsets[middle]:self.term_offsets[middle + 1]]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.term_count and self.term(low) == term:
+            return low
+        return None
+
+    def ordinal(self, doc_id: int) -> int | None:
+        ordinal = bisect.bisect_left(self.doc_ids, doc_id)
+        if ordinal < self.doc_count and self.doc_ids[ordinal] == doc_id:
+            return ordinal
+        return None
+
+    def decode_block(self, block: int, first_block: int) -> list[int]:
+        base = self.block_last_ordinals[block - 1] if block > first_block else 0
+        return decode_varints(self.postings, self.block_offsets[block], self.block_offsets[block + 1], base)
+
+    def term_ordinals(self, term_id: int) -> list[int]:
+        first_block = self.block_starts[term_id]
+        return decode_varints(self.postings, self.block_offsets[first_block], self.block_offsets[self.block_starts[term_id + 1]], 0)
+
+    def posting_positions(self, posting: int) -> list[int]:
+        """Token positions of one posting, addressed by its index into frequencies/impacts."""
+        return decode_varints(self.positions, self.position_offsets[posting], self.position_offsets[posting + 1], 0)
+
+    def term_row(self, term_id: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return the (ordinals, frequencies) of one term-document matrix row."""
+        first_block, end_block = self.block_starts[term_id], self.block_starts[term_id + 1]
+        ordinals = decode_varint_array(self.postings_array[self.block_offsets[first_block]:self.block_offsets[end_block]])
+        frequencies = self.frequencies_array[self.posting_starts[term_id]:self.posting_starts[term_id + 1]]
+        return ordinals.astype(np.intp), frequencies
+
+    def posting_position(self, term_id: int, ordinal: int) -> int | None:
+        # Index into frequencies/impacts of (term, ordinal), found through the block skip list
+        first_block, end_block = self.block_starts[term_id], self.block_starts[term_id + 1]
+        block = bisect.bisect_left(self.block_last_ordinals, ordinal, first_block, end_block)
+        if block >= end_block:
+            return None
+        block_ordinals = self.decode_block(block, first_block)
+        position = bisect.bisect_left(block_ordinals, ordinal)
+        if position < len(block_ordinals) and block_ordinals[position] == ordinal:
+            return self.posting_starts[term_id] + (block - first_block) * self.block_size + position
+        return None
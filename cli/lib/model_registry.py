@@ -0,0 +1,207 @@
+import glob
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from constants import (MODELS_DIR, EXPORTED_MODELS_DIR, EMBEDDING_MODEL, CROSS_ENCODER_MODEL, INFERENCE_BACKEND,
+                       BACKEND_PARITY_MIN_COSINE)
+
+MODEL_KINDS = ["embedding", "cross_encoder"]
+INFERENCE_BACKENDS = ["torch", "onnx", "onnx-int8"]
+EXPORT_MANIFEST = "export.json"
+
+# Models loaded by this process: (kind, name, backend) -> model
+_models = {}
+_lock = threading.Lock()
+
+def model_path(name: str) -> str:
+    """Pinned local directory of a model, filled by download_model()."""
+    return os.path.join(MODELS_DIR, name.replace("/", "--"))
+
+def exported_model_path(name: str, backend: str) -> str:
+    """Directory of the ONNX export of a model for an inference backend, filled by export_model()."""
+    return os.path.join(EXPORTED_MODELS_DIR, f"{name.replace('/', '--')}--{backend}")
+
+def _model_class(kind: str):
+    # sentence_transformers imports torch, so commands that neither embed nor rerank never import it
+    from sentence_transformers import CrossEncoder, SentenceTransformer
+    if kind == "embedding":
+        return SentenceTransformer
+    if kind == "cross_encoder":
+        return CrossEncoder
+    raise ValueError(f"unknown model kind '{kind}', expected one of {', '.join(MODEL_KINDS)}")
+
+def _model_source(name: str) -> str:
+    path = model_path(name)
+    return path if os.path.isdir(path) else name
+
+def _read_export_manifest(directory: str) -> dict | None:
+    manifest_path = os.path.join(directory, EXPORT_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+def _require_onnx_runtime() -> None:
+    if importlib.util.find_spec("optimum") is None or importlib.util.find_spec("onnxruntime") is None:
+        raise ValueError("the onnx backends need optimum and onnxruntime, install them with the onnx extra: pip install -e '.[onnx]'")
+
+def _load_model(kind: str, name: str, backend: str):
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"unknown inference backend '{backend}', expected one of {', '.join(INFERENCE_BACKENDS)}")
+    model_class = _model_class(kind)
+    if backend != "torch":
+        # Only exports that passed the parity check have a manifest
+        directory = exported_model_path(name, backend)
+        manifest = _read_export_manifest(directory)
+        if manifest is not None:
+            _require_onnx_runtime()
+            return model_class(directory, backend="onnx", model_kwargs={"file_name": manifest["file_name"]}, local_files_only=True)
+        print(f"No {backend} export of {name} found, using torch. Export it first with export_models --backend {backend}")
+    return model_class(_model_source(name), local_files_only=True)
+
+def model_identity(kind: str, name: str, backend: str = INFERENCE_BACKEND) -> str:
+    """What get_model() serves for these arguments: the model name, the backend that actually runs it,
+    which is torch if there is no export, and the ONNX file of an export."""
+    if backend != "torch":
+        manifest = _read_export_manifest(exported_model_path(name, backend))
+        if manifest is not None:
+            return f"{name}@{backend}/{manifest['file_name']}"
+    return f"{name}@torch"
+
+def get_model(kind: str, name: str, backend: str = INFERENCE_BACKEND):
+    """Return the model, loading it on first use. Every model is loaded once per process and shared
+    by all callers. It is read from its pinned directory in MODELS_DIR, or from the local Hugging
+    Face cache if it has not been downloaded there, and never looked up on the hub. The ONNX
+    backends run the export of the model in EXPORTED_MODELS_DIR."""
+    key = (kind, name, backend)
+    model = _models.get(key)
+    if model is None:
+        with _lock:
+            model = _models.get(key)
+            if model is None:
+                try:
+                    model = _load_model(kind, name, backend)
+                except ValueError:
+                    raise
+                except Exception as e:
+                    raise ValueError(f"model '{name}' not found in {model_path(name)}, download it first with download_models ({e})") from e
+                _models[key] = model
+    return model
+
+def embedding_model(name: str = EMBEDDING_MODEL, backend: str = INFERENCE_BACKEND):
+    return get_model("embedding", name, backend)
+
+def cross_encoder(name: str = CROSS_ENCODER_MODEL, backend: str = INFERENCE_BACKEND):
+    return get_model("cross_encoder", name, backend)
+
+def download_model(kind: str, name: str) -> str:
+    """Download a model from the Hugging Face hub into its pinned local directory, the only step
+    that needs network access."""
+    path = model_path(name)
+    model = _model_class(kind)(name)
+    if os.path.isdir(f"{path}.tmp"):
+        shutil.rmtree(f"{path}.tmp")
+    model.save(f"{path}.tmp")
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+def download_models_command(embedding_name: str = EMBEDDING_MODEL, cross_encoder_name: str = CROSS_ENCODER_MODEL):
+    for kind, name in [("embedding", embedding_name), ("cross_encoder", cross_encoder_name)]:
+        try:
+            print(f"Stored {name} in {download_model(kind, name)}")
+        except Exception as e:
+            print(f"Error: {e}")
+
+def onnx_quantization_config() -> str:
+    """Dynamic int8 quantization config of onnxruntime for the instruction set of this CPU."""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    flags = ""
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as cpuinfo_file:
+            flags = cpuinfo_file.read()
+    if "avx512_vnni" in flags:
+        return "avx512_vnni"
+    if "avx512f" in flags:
+        return "avx512"
+    return "avx2"
+
+def _find_onnx_file(directory: str, pattern: str) -> str:
+    matches = sorted(glob.glob(os.path.join(directory, "**", pattern), recursive=True))
+    if not matches:
+        raise ValueError(f"no {pattern} written to {directory}")
+    return os.path.relpath(matches[0], directory)
+
+def _predict(kind: str, model, inputs: list):
+    # Embeddings per text, or one relevance score per (query, document) pair
+    return model.encode(inputs) if kind == "embedding" else model.predict(inputs)
+
+def parity(kind: str, reference, candidate, inputs: list) -> float:
+    """Agreement of a candidate backend with the torch model on inputs: the lowest cosine similarity
+    of two embeddings of the same text, or for a cross-encoder the cosine similarity of the centered
+    score vectors (their correlation)."""
+    expected = np.asarray(_predict(kind, reference, inputs), dtype=np.float64)
+    actual = np.asarray(_predict(kind, candidate, inputs), dtype=np.float64)
+    if kind == "embedding":
+        cosines = np.sum(expected * actual, axis=1) / np.maximum(np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1), 1e-12)
+        return float(np.min(cosines))
+    expected = expected.reshape(len(inputs), -1)[:, 0] - np.mean(expected)
+    actual = actual.reshape(len(inputs), -1)[:, 0] - np.mean(actual)
+    return float(np.dot(expected, actual) / max(np.linalg.norm(expected) * np.linalg.norm(actual), 1e-12))
+
+def export_model(kind: str, name: str, backend: str, inputs: list, min_cosine: float = BACKEND_PARITY_MIN_COSINE) -> dict:
+    """Export a model to ONNX for an inference backend, dynamically quantized to int8 for onnx-int8,
+    and keep the export only if it agrees with the torch model on inputs, see parity(). Returns the
+    manifest of the export, which also records the latency of both backends on inputs."""
+    if backend not in INFERENCE_BACKENDS or backend == "torch":
+        raise ValueError(f"'{backend}' is not an export backend, expected onnx or onnx-int8")
+    _require_onnx_runtime()
+    model_class = _model_class(kind)
+    reference = get_model(kind, name, "torch")
+    directory = exported_model_path(name, backend)
+    staging = f"{directory}.tmp"
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+
+    # Loading with the onnx backend converts the model, saving it writes the ONNX graph
+    model_class(_model_source(name), backend="onnx", local_files_only=True).save(staging)
+    file_name = _find_onnx_file(staging, "model.onnx")
+    if backend == "onnx-int8":
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        config = onnx_quantization_config()
+        export_dynamic_quantized_onnx_model(model_class(staging, backend="onnx", model_kwargs={"file_name": file_name}, local_files_only=True),
+                                            config, staging)
+        file_name = _find_onnx_file(staging, f"model_qint8_{config}.onnx")
+    candidate = model_class(staging, backend="onnx", model_kwargs={"file_name": file_name}, local_files_only=True)
+
+    agreement = parity(kind, reference, candidate, inputs)
+    if agreement < min_cosine:
+        shutil.rmtree(staging)
+        raise ValueError(f"{backend} export of {name} agrees with torch only to {agreement:.4f} (< {min_cosine}), not kept")
+
+    latencies = {}
+    for backend_name, model in [("torch", reference), (backend, candidate)]:
+        # One input per call, as queries are encoded at search time
+        started = time.perf_counter()
+        for item in inputs:
+            _predict(kind, model, [item])
+        latencies[backend_name] = (time.perf_counter() - started) / len(inputs)
+
+    manifest = {'kind': kind, 'name': name, 'backend': backend, 'file_name': file_name, 'parity': agreement, 'latency': latencies}
+    with open(os.path.join(staging, EXPORT_MANIFEST), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.replace(staging, directory)
+    with _lock:
+        _models.pop((kind, name, backend), None)
+    return manifest
@@ -0,0 +1,84 @@
+import zlib
+from collections.abc import Iterable
+
+import numpy as np
+
+from utility import strip_punctuation
+from constants import DEDUP_SHINGLE_SIZE, DEDUP_PERMUTATIONS, DEDUP_BANDS, DEDUP_THRESHOLD
+
+# Prime above every 32-bit shingle hash for the universal hash family (a * x + b) mod p;
+# with a, b and x below 2^32 the sum cannot overflow 64 bits
+HASH_PRIME = 4294967311
+# Documents whose shingles are hashed at once, bounds the (documents x shingles x permutations) work array
+SIGNATURE_BATCH_SIZE = 512
+
+def shingles(text: str, size: int = DEDUP_SHINGLE_SIZE) -> np.ndarray:
+    """Sorted unique 32-bit hashes of the word `size`-grams of text (of its words if it is shorter)."""
+    words = strip_punctuation(text).split()
+    grams = [" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 0))] or words
+    return np.unique(np.array([zlib.crc32(gram.encode("utf-8")) for gram in grams], dtype=np.uint64))
+
+def minhash_signatures(shingle_sets: list[np.ndarray], permutations: int = DEDUP_PERMUTATIONS, seed: int = 0) -> np.ndarray:
+    """Return the (documents, permutations) MinHash signatures of the shingle sets. Empty sets get
+    an all-maximum signature, which never shares a band with a real document."""
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 1 << 32, size=permutations, dtype=np.uint64)
+    b = rng.integers(0, 1 << 32, size=permutations, dtype=np.uint64)
+
+    signatures = np.full((len(shingle_sets), permutations), HASH_PRIME, dtype=np.uint64)
+    for start in range(0, len(shingle_sets), SIGNATURE_BATCH_SIZE):
+        batch = [(i, shingle_set) for i, shingle_set in enumerate(shingle_sets[start:start + SIGNATURE_BATCH_SIZE], start) if len(shingle_set)]
+        if not batch:
+            continue
+        values = np.concatenate([shingle_set for _, shingle_set in batch])
+        hashes = (a[:, None] * values[None, :] + b[:, None]) % HASH_PRIME
+        # Minimum over each document's segment of the concatenated shingles
+        boundaries = np.cumsum([0] + [len(shingle_set) for _, shingle_set in batch[:-1]])
+        signatures[[i for i, _ in batch]] = np.minimum.reduceat(hashes, boundaries, axis=1).T
+    return signatures
+
+def jaccard(first: np.ndarray, second: np.ndarray) -> float:
+    shared = len(np.intersect1d(first, second, assume_unique=True))
+    union = len(first) + len(second) - shared
+    return shared / union if union > 0 else 0.0
+
+def find_near_duplicates(documents: Iterable[dict], threshold: float = DEDUP_THRESHOLD, bands: int = DEDUP_BANDS) -> list[list[int]]:
+    """Cluster near-identical movies by the Jaccard similarity of their title and description shingles.
+
+    Candidate pairs come from locality sensitive hashing: the MinHash signatures are cut into bands
+    and documents sharing any band are compared exactly. Returns the clusters of two or more
+    positions in the input, each sorted so its first, earliest position is the representative.
+    """
+    shingle_sets = [shingles(f"{document['title']} {document['description']}") for document in documents]
+    signatures = minhash_signatures(shingle_sets)
+    rows = signatures.shape[1] // bands
+
+    parents = list(range(len(shingle_sets)))
+
+    def find(position: int) -> int:
+        while parents[position] != position:
+            parents[position] = parents[parents[position]]
+            position = parents[position]
+        return position
+
+    compared = set()
+    for band in range(bands):
+        buckets = {}
+        for position, signature in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            if len(shingle_sets[position]):
+                buckets.setdefault(signature.tobytes(), []).append(position)
+        for bucket in buckets.values():
+            for i, first in enumerate(bucket):
+                for second in bucket[i + 1:]:
+                    if (first, second) in compared or find(first) == find(second):
+                        continue
+                    compared.add((first, second))
+                    if jaccard(shingle_sets[first], shingle_sets[second]) >= threshold:
+                        # The smaller position becomes the root, so it ends up as representative
+                        first_root, second_root = find(first), find(second)
+                        parents[max(first_root, second_root)] = min(first_root, second_root)
+
+    clusters = {}
+    for position in range(len(parents)):
+        clusters.setdefault(find(position), []).append(position)
+    return [members for members in clusters.values() if len(members) > 1]
@@ -0,0 +1,102 @@
+import os
+import re
+
+import numpy as np
+
+from lib.embedding_store import content_hashes
+from lib.result_cache import ResultCache
+from constants import QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_DISK_CACHE_SIZE, QUERY_EMBEDDINGS_DIR
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.split())
+
+class QueryEmbeddingCache:
+    """Embeddings of recent queries, so that repeated and popular queries skip the transformer.
+
+    Queries are keyed by the content hash of the model identity and the whitespace-normalized text.
+    The identity, see model_registry.model_identity(), includes the inference backend, as an ONNX
+    or int8 export embeds slightly differently than the torch model.
+    The memory tier is a ResultCache, an LRU cache with TinyLFU admission. The optional disk tier
+    is a memory-mapped table of `disk_slots` (key, embedding) rows in QUERY_EMBEDDINGS_DIR, one
+    file per model identity, which survives restarts and is shared by all processes on the host. A query
+    lives in the slot its key selects and replaces whatever query was there before, so the table
+    never grows.
+    """
+
+    def __init__(self, model_identity: str, capacity: int = QUERY_EMBEDDING_CACHE_SIZE, disk_slots: int = QUERY_EMBEDDING_DISK_CACHE_SIZE,
+                 directory: str | None = QUERY_EMBEDDINGS_DIR) -> None:
+        self.model_identity = model_identity
+        self.memory = ResultCache(capacity)
+        self.disk_slots = disk_slots
+        file_name = re.sub(r"[^\w.-]", "_", model_identity) + ".npy"
+        self.path = os.path.join(directory, file_name) if directory and disk_slots > 0 else None
+        self.table = None
+        self.disk_hits = 0
+
+    def key(self, text: str) -> int:
+        return int(content_hashes([normalize_query(text)], self.model_identity)[0])
+
+    def __open_table(self, dimension: int | None = None) -> np.ndarray | None:
+        # Opened on first use; created by the first insert, once the embedding dimension is known
+        if self.table is None and self.path is not None and os.path.exists(self.path):
+            try:
+                table = np.load(self.path, mmap_mode="r+")
+                if table.dtype.names == ("key", "embedding") and len(table) == self.disk_slots:
+                    self.table = table
+            except Exception as e:
+                print(f"Error loading query embedding cache: {e}")
+                self.path = None
+        if self.table is None and self.path is not None and dimension is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            dtype = np.dtype([("key", np.uint64), ("embedding", np.float32, (dimension,))])
+            table = np.lib.format.open_memmap(f"{self.path}.tmp", mode="w+", dtype=dtype, shape=(self.disk_slots,))
+            table.flush()
+            del table
+            os.replace(f"{self.path}.tmp", self.path)
+            self.table = np.load(self.path, mmap_mode="r+")
+        return self.table
+
+    def get(self, text: str) -> np.ndarray | None:
+        key = self.key(text)
+        embedding = self.memory.get(key, self.model_identity)
+        if embedding is not None:
+            return embedding
+        table = self.__open_table()
+        if table is None:
+            return None
+        slot = key % len(table)
+        # The key is read again after the embedding, so a row another process is rewriting is not returned
+        if table["key"][slot] != key:
+            return None
+        embedding = np.array(table["embedding"][slot])
+        if table["key"][slot] != key:
+            return None
+        embedding.setflags(write=False)
+        self.disk_hits += 1
+        self.memory.put(key, self.model_identity, embedding)
+        return embedding
+
+    def put(self, text: str, embedding: np.ndarray) -> np.ndarray:
+        key = self.key(text)
+        embedding = np.array(embedding, dtype=np.float32)
+        embedding.setflags(write=False)
+        self.memory.put(key, self.model_identity, embedding)
+        table = self.__open_table(len(embedding))
+        if table is not None and table.dtype["embedding"].shape == embedding.shape:
+            slot = key % len(table)
+            table["key"][slot] = 0
+            table["embedding"][slot] = embedding
+            table["key"][slot] = key
+        return embedding
+
+    def stats(self) -> dict:
+        memory_stats = self.memory.stats()
+        lookups = memory_stats["hits"] + memory_stats["misses"]
+        hits = memory_stats["hits"] + self.disk_hits
+        return {
+            "lookups": lookups,
+            "memory_hits": memory_stats["hits"],
+            "disk_hits": self.disk_hits,
+            "misses": lookups - hits,
+            "hit_rate": hits / lookups if lookups > 0 else 0.0,
+        }
@@ -0,0 +1,325 @@
+import re
+
+from lib.analyzer import Analyzer
+from lib.block_max_wand import END_OF_POSTINGS, PostingCursor
+from lib.index_format import MappedIndex
+from lib.segments import Segment
+
+# Query syntax: words, "exact phrases", "proximity phrases"~N, the operators AND, OR and NOT
+# (upper case) and parentheses. Adjacent clauses without an operator are OR'ed, AND binds
+# tighter than OR and NOT applies to the clause that follows it.
+QUERY_TOKEN_PATTERN = re.compile(r'"([^"]*)"(?:~(\d+))?|(\()|(\))|(\S+?)(?=[()"]|\s|$)')
+
+OPERATORS = {"AND", "OR", "NOT"}
+
+def _lex(query: str) -> list[tuple[str, object]]:
+    lexemes = []
+    for match in QUERY_TOKEN_PATTERN.finditer(query):
+        phrase, slop, open_paren, close_paren, word = match.groups()
+        if phrase is not None:
+            lexemes.append(("phrase", (phrase, int(slop) if slop is not None else 0)))
+        elif open_paren:
+            lexemes.append(("(", None))
+        elif close_paren:
+            lexemes.append((")", None))
+        elif word in OPERATORS:
+            lexemes.append((word, None))
+        else:
+            lexemes.append(("word", word))
+    return lexemes
+
+class QueryParser:
+    """Recursive descent parser from a query string to a tree of nested tuples.
+
+    Nodes are ("term", token), ("phrase", tokens, slop), ("and", children), ("or", children) and
+    ("not", child). Words go through the index's analyzer; clauses that analyze to nothing,
+    such as stopwords, are dropped.
+    """
+
+    def __init__(self, analyzer: Analyzer) -> None:
+        self.analyzer = analyzer
+
+    def parse(self, query: str) -> tuple | None:
+        self.lexemes = _lex(query)
+        self.position = 0
+        node = self.__parse_or()
+        if self.position < len(self.lexemes):
+            raise ValueError(f"unexpected '{self.lexemes[self.position][1] or self.lexemes[self.position][0]}' in query")
+        return node
+
+    def __peek(self) -> str | None:
+        return self.lexemes[self.position][0] if self.position < len(self.lexemes) else None
+
+    def __parse_or(self) -> tuple | None:
+        children = [self.__parse_and()]
+        while self.__peek() not in (None, ")"):
+            if self.__peek() == "OR":
+                self.position += 1
+            children.append(self.__parse_and())
+        return _combine("or", children)
+
+    def __parse_and(self) -> tuple | None:
+        children = [self.__parse_not()]
+        while self.__peek() == "AND":
+            self.position += 1
+            children.append(self.__parse_not())
+        return _combine("and", children)
+
+    def __parse_not(self) -> tuple | None:
+        if self.__peek() == "NOT":
+            self.position += 1
+            child = self.__parse_not()
+            return ("not", child) if child is not None else None
+        return self.__parse_primary()
+
+    def __parse_primary(self) -> tuple | None:
+        if self.position >= len(self.lexemes):
+            raise ValueError("unexpected end of query")
+        kind, value = self.lexemes[self.position]
+        self.position += 1
+        if kind == "(":
+            node = self.__parse_or()
+            if self.__peek() != ")":
+                raise ValueError("missing ')' in query")
+            self.position += 1
+            return node
+        if kind == "phrase":
+            text, slop = value
+            tokens = self.analyzer.analyze(text)
+        elif kind == "word":
+            text, slop = value, 0
+            tokens = self.analyzer.analyze(text)
+        else:
+            raise ValueError(f"unexpected '{kind}' in query")
+
+        if not tokens:
+            return None
+        if len(tokens) == 1:
+            return ("term", tokens[0])
+        return ("phrase", tokens, slop)
+
+def _combine(operator: str, children: list[tuple | None]) -> tuple | None:
+    children = [child for child in children if child is not None]
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else (operator, children)
+
+class EmptyIterator:
+    cost = 0
+
+    def __init__(self) -> None:
+        self.doc = END_OF_POSTINGS
+
+    def next(self) -> None:
+        pass
+
+    def seek(self, target: int) -> None:
+        pass
+
+class TermIterator:
+    """Matching ordinals of one term, skipping through block skip pointers and galloping inside blocks."""
+
+    def __init__(self, reader: MappedIndex, term_id: int) -> None:
+        self.term_id = term_id
+        self.cursor = PostingCursor(reader, term_id)
+        self.cost = reader.doc_frequencies[term_id]
+        self.doc = self.cursor.doc
+
+    def next(self) -> None:
+        self.cursor.next()
+        self.doc = self.cursor.doc
+
+    def seek(self, target: int) -> None:
+        self.cursor.seek(target)
+        self.doc = self.cursor.doc
+
+    def positions(self) -> list[int]:
+        return self.cursor.index.posting_positions(self.cursor.posting_index())
+
+class ConjunctionIterator:
+    """Documents matching every child and none of the excluded iterators.
+
+    Children are leapfrogged from the cheapest one: each proposes a candidate that the others seek
+    to, so the rarest posting list drives the intersection and the longer ones are mostly skipped.
+    """
+
+    def __init__(self, children: list, excluded: list = ()) -> None:
+        self.children = sorted(children, key=lambda child: child.cost)
+        self.excluded = list(excluded)
+        self.cost = self.children[0].cost
+        self.doc = -1
+        self.__advance(0)
+
+    def matches(self) -> bool:
+        return True
+
+    def next(self) -> None:
+        self.__advance(self.doc + 1)
+
+    def seek(self, target: int) -> None:
+        if target > self.doc:
+            self.__advance(target)
+
+    def __advance(self, target: int) -> None:
+        while target != END_OF_POSTINGS:
+            for child in self.children:
+                child.seek(target)
+                if child.doc != target:
+                    target = child.doc
+                    break
+            else:
+                if self.__is_excluded(target) or not self.matches():
+                    target += 1
+                    continue
+                self.doc = target
+                return
+        self.doc = END_OF_POSTINGS
+
+    def __is_excluded(self, target: int) -> bool:
+        for iterator in self.excluded:
+            iterator.seek(target)
+            if iterator.doc == target:
+                return True
+        return False
+
+class PhraseIterator(ConjunctionIterator):
+    """Documents containing the terms in order and adjacent, or with slop > 0, all within a
+    window of len(terms) + slop positions in any order. Every term needs a position of its own,
+    so a term repeated in the phrase has to occur that many times in the window."""
+
+    def __init__(self, terms: list[TermIterator], slop: int) -> None:
+        self.terms = terms
+        self.slop = slop
+        super().__init__(terms)
+
+    def matches(self) -> bool:
+        positions = [term.positions() for term in self.terms]
+        if self.slop == 0:
+            following = [set(term_positions) for term_positions in positions[1:]]
+            return any(all(start + offset in term_positions for offset, term_positions in enumerate(following, 1)) for start in positions[0])
+
+        # Smallest window holding as many positions of every distinct term as the phrase repeats it,
+        # sweeping the merged positions
+        window = len(self.terms) - 1 + self.slop
+        required = {}
+        term_positions = {}
+        for term, term_position_list in zip(self.terms, positions):
+            required[term.term_id] = required.get(term.term_id, 0) + 1
+            term_positions[term.term_id] = term_position_list
+        occurrences = sorted((position, term_id) for term_id, term_position_list in term_positions.items() for position in term_position_list)
+        counts = dict.fromkeys(required, 0)
+        covered = 0
+        left = 0
+        for position, i in occurrences:
+            counts[i] += 1
+            if counts[i] == required[i]:
+                covered += 1
+            while covered == len(required):
+                left_position, left_term = occurrences[left]
+                if position - left_position <= window:
+                    return True
+                if counts[left_term] == required[left_term]:
+                    covered -= 1
+                counts[left_term] -= 1
+                left += 1
+        return False
+
+class DisjunctionIterator:
+    """Documents matching any child."""
+
+    def __init__(self, children: list) -> None:
+        self.children = children
+        self.cost = sum(child.cost for child in children)
+        self.doc = min(child.doc for child in children)
+
+    def next(self) -> None:
+        current = self.doc
+        for child in self.children:
+            if child.doc == current:
+                child.next()
+        self.doc = min(child.doc for child in self.children)
+
+    def seek(self, target: int) -> None:
+        for child in self.children:
+            child.seek(target)
+        self.doc = min(child.doc for child in self.children)
+
+class ComplementIterator:
+    """Every ordinal of the segment that the excluded iterator does not match."""
+
+    def __init__(self, excluded, doc_count: int) -> None:
+        self.excluded = excluded
+        self.doc_count = doc_count
+        self.cost = doc_count
+        self.doc = -1
+        self.seek(0)
+
+    def next(self) -> None:
+        self.seek(self.doc + 1)
+
+    def seek(self, target: int) -> None:
+        if target <= self.doc:
+            return
+        self.excluded.seek(target)
+        while target < self.doc_count and self.excluded.doc == target:
+            target += 1
+            self.excluded.seek(target)
+        self.doc = target if target < self.doc_count else END_OF_POSTINGS
+
+def build_iterator(node: tuple, reader: MappedIndex):
+    kind = node[0]
+    if kind == "term":
+        term_id = reader.term_id(node[1])
+        return TermIterator(reader, term_id) if term_id is not None else EmptyIterator()
+
+    if kind == "phrase":
+        _, tokens, slop = node
+        if not reader.positional:
+            raise ValueError("phrase queries need a positional index, rebuild it with positions")
+        terms = []
+        for token in tokens:
+            term_id = reader.term_id(token)
+            if term_id is None:
+                return EmptyIterator()
+            terms.append(TermIterator(reader, term_id))
+        return PhraseIterator(terms, slop)
+
+    if kind == "and":
+        # NOT clauses inside a conjunction are evaluated as exclusion checks, not complements
+        required = [build_iterator(child, reader) for child in node[1] if child[0] != "not"]
+        excluded = [build_iterator(child[1], reader) for child in node[1] if child[0] == "not"]
+        if not required:
+            return ComplementIterator(DisjunctionIterator(excluded), reader.doc_count)
+        if any(isinstance(iterator, EmptyIterator) for iterator in required):
+            return EmptyIterator()
+        return ConjunctionIterator(required, excluded)
+
+    if kind == "or":
+        children = [build_iterator(child, reader) for child in node[1]]
+        children = [child for child in children if not isinstance(child, EmptyIterator)]
+        if not children:
+            return EmptyIterator()
+        return children[0] if len(children) == 1 else DisjunctionIterator(children)
+
+    if kind == "not":
+        return ComplementIterator(build_iterator(node[1], reader), reader.doc_count)
+
+    raise ValueError(f"unknown query node '{kind}'")
+
+def execute(node: tuple | None, segments: list[Segment], limit: int) -> list[int]:
+    """Return the smallest `limit` doc_ids matching the parsed query across all segments."""
+    if node is None or limit <= 0:
+        return []
+
+    doc_ids = []
+    for segment in segments:
+        iterator = build_iterator(node, segment.reader)
+        # Ordinals follow doc_id order, so each segment can stop after its first `limit` matches
+        matches = 0
+        while iterator.doc != END_OF_POSTINGS and matches < limit:
+            if iterator.doc not in segment.deleted:
+                doc_ids.append(segment.reader.doc_ids[iterator.doc])
+                matches += 1
+            iterator.next()
+
+    return sorted(doc_ids)[:limit]
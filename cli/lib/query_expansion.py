@@ -0,0 +1,201 @@
+import collections
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+from constants import (NEIGHBOURS_PATH, QUERY_EXPANSION_NEIGHBOURS, QUERY_EXPANSION_MIN_SIMILARITY,
+                       QUERY_EXPANSION_MIN_DOCUMENT_FREQUENCY, QUERY_EXPANSION_COOCCURRENCE_WEIGHT)
+from lib.spell_corrector import count_document_words
+
+# Nearest neighbour terms of the index vocabulary, precomputed so that expanding a query is a
+# lookup instead of an LLM call. Layout, native byte order checked through a byte order mark:
+#
+#   header | section table | term_offsets | term_bytes | neighbour_starts | neighbour_ids | neighbour_weights
+#
+# Terms are the analyzed index tokens, sorted by their UTF-8 bytes for binary search. The
+# neighbours of term i are neighbour_ids[neighbour_starts[i]:neighbour_starts[i + 1]], most similar
+# first, each with a similarity weight in (0, 1].
+NEIGHBOURS_MAGIC = b"RSENEIGH"
+NEIGHBOURS_VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+HEADER_FORMAT = "=8sIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+SECTIONS = [
+    ("term_offsets", "Q"),
+    ("term_bytes", None),
+    ("neighbour_starts", "Q"),
+    ("neighbour_ids", "I"),
+    ("neighbour_weights", "f"),
+]
+SECTION_TABLE_FORMAT = "=" + "QQ" * len(SECTIONS)
+SECTION_TABLE_SIZE = struct.calcsize(SECTION_TABLE_FORMAT)
+
+# Rows of the term similarity matrix computed at once
+SIMILARITY_BLOCK_SIZE = 1024
+
+def surface_forms(inverted_index, terms: list[str]) -> list[str]:
+    """The most frequent unstemmed word of every term; stems such as 'famili' embed poorly."""
+    best = {}
+    for word, frequency in count_document_words(inverted_index.documents).items():
+        tokens = inverted_index.analyzer.analyze(word)
+        if len(tokens) == 1 and frequency > best.get(tokens[0], ("", 0))[1]:
+            best[tokens[0]] = (word, frequency)
+    return [best[term][0] if term in best else term for term in terms]
+
+def cooccurrence(doc_ids: dict[str, np.ndarray], term: str, other: str) -> float:
+    # Cosine similarity of the two terms' binary document vectors
+    shared = len(np.intersect1d(doc_ids[term], doc_ids[other], assume_unique=True))
+    return shared / np.sqrt(len(doc_ids[term]) * len(doc_ids[other]))
+
+def build_term_neighbours(inverted_index, model, neighbour_count: int = QUERY_EXPANSION_NEIGHBOURS, cooccurrence_weight: float = QUERY_EXPANSION_COOCCURRENCE_WEIGHT) -> dict[str, list[tuple[str, float]]]:
+    """Find the nearest neighbours of every index term with at least
+    QUERY_EXPANSION_MIN_DOCUMENT_FREQUENCY documents.
+
+    Candidates are the terms closest in the embedding space of model. Their weight is the cosine
+    similarity of the embeddings, blended with cooccurrence_weight of the co-occurrence similarity
+    of the two posting lists, so that terms which also appear together in the corpus rank higher.
+    """
+    vocabulary = inverted_index.vocabulary(QUERY_EXPANSION_MIN_DOCUMENT_FREQUENCY)
+    terms = sorted(vocabulary)
+    if len(terms) < 2:
+        return {}
+
+    embeddings = np.asarray(model.encode(surface_forms(inverted_index, terms), batch_size=256, show_progress_bar=True), dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms != 0)
+    doc_ids = {term: np.array(inverted_index.get_documents(term), dtype=np.int64) for term in terms} if cooccurrence_weight > 0 else {}
+
+    candidate_count = min(3 * neighbour_count, len(terms) - 1)
+    neighbours = {}
+    for start in range(0, len(terms), SIMILARITY_BLOCK_SIZE):
+        similarities = embeddings[start:start + SIMILARITY_BLOCK_SIZE] @ embeddings.T
+        rows = np.arange(len(similarities))
+        similarities[rows, rows + start] = -np.inf
+        candidates = np.argpartition(-similarities, candidate_count - 1, axis=1)[:, :candidate_count]
+
+        for row, term_candidates in enumerate(candidates):
+            term = terms[start + row]
+            weighted = []
+            for candidate in term_candidates:
+                similarity = float(similarities[row, candidate])
+                if similarity < QUERY_EXPANSION_MIN_SIMILARITY:
+                    continue
+                other = terms[candidate]
+                weight = similarity
+                if cooccurrence_weight > 0:
+                    weight = (1 - cooccurrence_weight) * similarity + cooccurrence_weight * cooccurrence(doc_ids, term, other)
+                weighted.append((other, weight))
+            weighted.sort(key=lambda neighbour: (-neighbour[1], neighbour[0]))
+            if weighted:
+                neighbours[term] = weighted[:neighbour_count]
+    return neighbours
+
+def encode_term_neighbours(neighbours: dict[str, list[tuple[str, float]]]) -> bytes:
+    terms = sorted(set(neighbours) | {other for term_neighbours in neighbours.values() for other, _ in term_neighbours}, key=lambda term: term.encode("utf-8"))
+    term_ids = {term: term_id for term_id, term in enumerate(terms)}
+
+    term_bytes = bytearray()
+    term_offsets = [0]
+    neighbour_starts = [0]
+    neighbour_ids = []
+    neighbour_weights = []
+    for term in terms:
+        term_bytes += term.encode("utf-8")
+        term_offsets.append(len(term_bytes))
+        for other, weight in neighbours.get(term, ()):
+            neighbour_ids.append(term_ids[other])
+            neighbour_weights.append(weight)
+        neighbour_starts.append(len(neighbour_ids))
+
+    payloads = [np.array(term_offsets, dtype=np.uint64).tobytes(), bytes(term_bytes), np.array(neighbour_starts, dtype=np.uint64).tobytes(),
+                np.array(neighbour_ids, dtype=np.uint32).tobytes(), np.array(neighbour_weights, dtype=np.float32).tobytes()]
+
+    section_table = []
+    body = bytearray()
+    offset = HEADER_SIZE + SECTION_TABLE_SIZE
+    for payload in payloads:
+        body += b"\0" * (-(offset + len(body)) % 8)
+        section_table.extend([offset + len(body), len(payload)])
+        body += payload
+
+    header = struct.pack(HEADER_FORMAT, NEIGHBOURS_MAGIC, NEIGHBOURS_VERSION, BYTE_ORDER_MARK, len(terms))
+    return header + struct.pack(SECTION_TABLE_FORMAT, *section_table) + bytes(body)
+
+def write_term_neighbours(path: str, neighbours: dict[str, list[tuple[str, float]]]) -> None:
+    buffer = encode_term_neighbours(neighbours)
+    with open(f"{path}.tmp", "wb") as neighbours_file:
+        neighbours_file.write(buffer)
+    os.replace(f"{path}.tmp", path)
+
+class TermNeighbours:
+    """Memory-mapped nearest neighbour terms of the index vocabulary."""
+
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+        view = memoryview(buffer)
+        magic, version, byte_order_mark, self.term_count = struct.unpack_from(HEADER_FORMAT, view, 0)
+        if magic != NEIGHBOURS_MAGIC or version != NEIGHBOURS_VERSION:
+            raise ValueError("unsupported term neighbours format")
+        if byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError(f"term neighbours were written on a host with a different byte order than {sys.byteorder}")
+
+        section_table = struct.unpack_from(SECTION_TABLE_FORMAT, view, HEADER_SIZE)
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = section_table[2 * i], section_table[2 * i + 1]
+            section = view[offset:offset + length]
+            setattr(self, name, section.cast(typecode) if typecode else section)
+
+    @classmethod
+    def open(cls, path: str) -> "TermNeighbours":
+        with open(path, "rb") as neighbours_file:
+            return cls(mmap.mmap(neighbours_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def term(self, term_id: int) -> str:
+        return bytes(self.term_bytes[self.term_offsets[term_id]:self.term_offsets[term_id + 1]]).decode("utf-8")
+
+    def term_id(self, term: str) -> int | None:
+        key = term.encode("utf-8")
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.term_bytes[self.term_offsets[middle]:self.term_offsets[middle + 1]]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.term_count and self.term(low) == term:
+            return low
+        return None
+
+    def neighbours(self, term: str, fan_out: int = QUERY_EXPANSION_NEIGHBOURS) -> list[tuple[str, float]]:
+        term_id = self.term_id(term)
+        if term_id is None:
+            return []
+        start = self.neighbour_starts[term_id]
+        end = min(self.neighbour_starts[term_id + 1], start + fan_out)
+        return [(self.term(self.neighbour_ids[i]), self.neighbour_weights[i]) for i in range(start, end)]
+
+    def expand(self, tokens: list[str], fan_out: int, weight: float) -> dict[str, float]:
+        """Return the BM25 weight of every token of an analyzed query plus its `fan_out` nearest
+        neighbours. Query tokens keep their count as weight; a neighbour gets weight times its
+        similarity, the highest if it neighbours several query tokens."""
+        weights = {token: float(count) for token, count in collections.Counter(tokens).items()}
+        if fan_out <= 0 or weight <= 0:
+            return weights
+        expansions = {}
+        for token in list(weights):
+            for other, similarity in self.neighbours(token, fan_out):
+                if other not in weights:
+                    expansions[other] = max(expansions.get(other, 0.0), weight * similarity)
+        weights.update(expansions)
+        return weights
+
+def load_term_neighbours(path: str = NEIGHBOURS_PATH) -> TermNeighbours | None:
+    try:
+        return TermNeighbours.open(path)
+    except Exception as e:
+        print(f"Error loading term neighbours: {e}")
+        return None
@@ -0,0 +1,133 @@
+import collections
+import json
+import os
+
+from constants import RESULT_CACHE_SIZE
+
+class FrequencySketch:
+    """Count-min sketch of approximate access counts, halved periodically so old popularity fades."""
+
+    def __init__(self, capacity: int, depth: int = 4) -> None:
+        self.width = 1 << max(capacity * 4 - 1, 1).bit_length()
+        self.depth = depth
+        self.rows = [[0] * self.width for _ in range(depth)]
+        # Reset period of TinyLFU: after this many increments every counter is halved
+        self.sample_size = 10 * max(capacity, 1)
+        self.additions = 0
+
+    def __slots(self, key) -> list[int]:
+        return [hash((seed, key)) & (self.width - 1) for seed in range(self.depth)]
+
+    def increment(self, key) -> None:
+        for row, slot in zip(self.rows, self.__slots(key)):
+            if row[slot] < 15:
+                row[slot] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            for row in self.rows:
+                for slot in range(self.width):
+                    row[slot] >>= 1
+            self.additions //= 2
+
+    def frequency(self, key) -> int:
+        return min(row[slot] for row, slot in zip(self.rows, self.__slots(key)))
+
+def _freeze(value):
+    return tuple(_freeze(item) for item in value) if isinstance(value, list) else value
+
+class ResultCache:
+    """Bounded LRU cache of search results with TinyLFU admission and generation based invalidation.
+
+    Every lookup is counted in a frequency sketch. Once the cache is full a new entry is only
+    admitted if it has been requested more often than the least recently used entry it would
+    evict, so a burst of one-off queries cannot flush the popular ones. Entries belong to the
+    generation they were computed for; a lookup or insert for a different generation drops every
+    entry, because the index or embeddings they were computed from have changed. save() and load()
+    keep the entries in a JSON file, so that other processes reuse them while the generation holds.
+    """
+
+    def __init__(self, capacity: int = RESULT_CACHE_SIZE) -> None:
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.sketch = FrequencySketch(capacity)
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejections = 0
+        # Set by every insert, save() only writes a cache that changed
+        self.changed = False
+
+    def __check_generation(self, generation) -> None:
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        self.__check_generation(generation)
+        self.sketch.increment(key)
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, generation, value) -> None:
+        self.__check_generation(generation)
+        if self.capacity <= 0:
+            return
+        if key in self.entries:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.changed = True
+            return
+        if len(self.entries) >= self.capacity:
+            victim = next(iter(self.entries))
+            if self.sketch.frequency(key) <= self.sketch.frequency(victim):
+                self.rejections += 1
+                return
+            del self.entries[victim]
+            self.evictions += 1
+        self.entries[key] = value
+        self.changed = True
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def save(self, path: str) -> None:
+        if not self.changed or self.generation is None:
+            return
+        # Keys and generations are tuples, JSON turns them into lists that load() turns back
+        cache = {"generation": self.generation, "entries": [[key, value] for key, value in self.entries.items()]}
+        with open(f"{path}.tmp", "w") as cache_file:
+            json.dump(cache, cache_file, default=lambda value: value.item())
+        os.replace(f"{path}.tmp", path)
+        self.changed = False
+
+    def load(self, path: str) -> None:
+        """Replace the entries with those saved to path, least recently used first."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as cache_file:
+                cache = json.load(cache_file)
+        except Exception as e:
+            print(f"Error loading result cache: {e}")
+            return
+        self.generation = _freeze(cache["generation"])
+        entries = cache["entries"]
+        self.entries = collections.OrderedDict((_freeze(key), value) for key, value in entries[max(len(entries) - self.capacity, 0):])
+        self.changed = False
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+            "rejections": self.rejections,
+            "entries": len(self.entries),
+        }
@@ -0,0 +1,111 @@
+import heapq
+import itertools
+import json
+import math
+import os
+from collections.abc import Iterator
+
+import numpy as np
+
+from lib.index_format import MappedIndex, decode_varints
+from constants import SEGMENT_MERGE_FACTOR, SEGMENT_MAX_DELETED_RATIO
+
+class Segment:
+    """One immutable index segment plus the tombstones of the documents deleted from it since it was written."""
+
+    def __init__(self, reader: MappedIndex, name: str | None = None, deleted_doc_ids: list[int] = ()) -> None:
+        # name is None until the segment has been written to disk
+        self.name = name
+        self.reader = reader
+        self.deleted = set()
+        for doc_id in deleted_doc_ids:
+            self.delete(doc_id)
+
+    def snapshot(self) -> "Segment":
+        # Same postings with a frozen copy of the tombstones, for merges that run alongside deletes
+        snapshot = Segment(self.reader, self.name)
+        snapshot.deleted = set(self.deleted)
+        return snapshot
+
+    def delete(self, doc_id: int) -> bool:
+        ordinal = self.reader.ordinal(doc_id)
+        if ordinal is None or ordinal in self.deleted:
+            return False
+        self.deleted.add(ordinal)
+        return True
+
+    def contains(self, doc_id: int) -> int | None:
+        # Ordinal of doc_id if it is live in this segment
+        ordinal = self.reader.ordinal(doc_id)
+        return ordinal if ordinal is not None and ordinal not in self.deleted else None
+
+    def deleted_doc_ids(self) -> list[int]:
+        return sorted(self.reader.doc_ids[ordinal] for ordinal in self.deleted)
+
+    def deleted_ordinals_array(self) -> np.ndarray:
+        return np.fromiter(self.deleted, dtype=np.intp, count=len(self.deleted))
+
+    def live_doc_count(self) -> int:
+        return self.reader.doc_count - len(self.deleted)
+
+    def live_postings(self) -> Iterator[tuple[str, list[tuple[int, int, list[int] | None]]]]:
+        """Yield (token, [(doc_id, tf, positions), ...]) in token order, skipping deleted documents.
+
+        positions is None if the segment is not positional.
+        """
+        reader = self.reader
+        for term_id in range(reader.term_count):
+            start = reader.posting_starts[term_id]
+            first_block = reader.block_starts[term_id]
+            ordinals = decode_varints(reader.postings, reader.block_offsets[first_block], reader.block_offsets[reader.block_starts[term_id + 1]], 0)
+            postings = [(reader.doc_ids[ordinal], reader.frequencies[start + i], reader.posting_positions(start + i) if reader.positional else None)
+                        for i, ordinal in enumerate(ordinals) if ordinal not in self.deleted]
+            if postings:
+                yield reader.term(term_id), postings
+
+    def live_doc_lengths(self) -> dict[int, int]:
+        return {self.reader.doc_ids[ordinal]: self.reader.doc_lengths[ordinal] for ordinal in range(self.reader.doc_count) if ordinal not in self.deleted}
+
+def merge_segment_postings(segments: list[Segment]) -> Iterator[tuple[str, list[tuple[int, int, list[int] | None]]]]:
+    """Merge the live postings of several segments into one token-ordered stream."""
+    merged = heapq.merge(*(segment.live_postings() for segment in segments), key=lambda entry: entry[0])
+    for token, entries in itertools.groupby(merged, key=lambda entry: entry[0]):
+        # A live doc_id exists in exactly one segment, so the lists only need interleaving
+        yield token, sorted(itertools.chain.from_iterable(postings for _, postings in entries), key=lambda posting: posting[0])
+
+def find_merges(segments: list[Segment]) -> list[Segment]:
+    """Pick the segments to merge next, or an empty list if the index is in good shape.
+
+    Segments are grouped into size tiers that grow by SEGMENT_MERGE_FACTOR; a tier holding that many
+    segments is merged into one segment of the next tier. A segment whose share of deleted
+    documents exceeds SEGMENT_MAX_DELETED_RATIO is rewritten on its own to reclaim the space.
+    """
+    tiers = {}
+    for segment in segments:
+        if segment.name is None:
+            continue
+        if segment.reader.doc_count > 0 and len(segment.deleted) / segment.reader.doc_count > SEGMENT_MAX_DELETED_RATIO:
+            return [segment]
+        tier = int(math.log(max(segment.live_doc_count(), 1), SEGMENT_MERGE_FACTOR))
+        tiers.setdefault(tier, []).append(segment)
+
+    for tier in sorted(tiers):
+        if len(tiers[tier]) >= SEGMENT_MERGE_FACTOR:
+            return tiers[tier][:SEGMENT_MERGE_FACTOR]
+    return []
+
+def read_manifest(path: str) -> dict:
+    with open(path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+def write_manifest(path: str, generation: int, segments: list[Segment], document_log_size: int = 0) -> None:
+    # document_log_size is the valid length of the document update log, see append_document_updates()
+    manifest = {
+        "generation": generation,
+        "segments": [{"name": segment.name, "deleted": segment.deleted_doc_ids()} for segment in segments if segment.name is not None],
+        "document_log_size": document_log_size,
+    }
+    # Replace atomically, a reader must never see a half-written manifest
+    with open(f"{path}.tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(f"{path}.tmp", path)
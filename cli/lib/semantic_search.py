@@ -1,9 +1,13 @@
-from sentence_transformers import SentenceTransformer
 import numpy as np
 import json
 import os
 import re
-from constants import CACHE_DIR, DATA_PATH
+from constants import CACHE_DIR, DATA_PATH, GOLDEN_DATASET_PATH, EMBEDDING_MODEL, CROSS_ENCODER_MODEL, BACKEND_PARITY_SAMPLE
+from lib.model_registry import embedding_model, export_model, model_identity
+from utility import load_json
+from lib.vector_quantization import QuantizedVectors, load_quantized_vectors
+from lib.embedding_store import content_hashes, reuse_embeddings
+from lib.query_embedding_cache import QueryEmbeddingCache, normalize_query
 
 def verify_model():
     semantic_search = SemanticSearch()
@@ -26,6 +30,8 @@ def verify_embeddings():
     semantic_search.load_or_create_embeddings(documents)
     print(f"Number of docs:   {len(documents)}")
     print(f"Embeddings shape: {semantic_search.embeddings.shape[0]} vectors in {semantic_search.embeddings.shape[1]} dimensions")
+    if semantic_search.quantized is not None:
+        print(f"Quantized:        {semantic_search.quantized.kind} ({semantic_search.quantized.codes.nbytes} bytes of codes)")
 
 def search_command(query: str, limit: int):
     semantic_search = SemanticSearch()
@@ -37,6 +43,25 @@ def search_command(query: str, limit: int):
         print(f"{i + 1}. {search_result[i]['title']} (score: {search_result[i]['score']:.4f})")
         print(f"{search_result[i]['description'][:100]}...\n")
 
+def export_models_command(backend: str, sample_size: int = BACKEND_PARITY_SAMPLE):
+    """Export the embedding model and the cross-encoder for an ONNX inference backend, checked
+    against torch on golden dataset queries and movie descriptions."""
+    documents = load_data()
+    queries = [test_case['query'] for test_case in load_json(GOLDEN_DATASET_PATH)['test_cases']] if os.path.exists(GOLDEN_DATASET_PATH) else []
+    texts = (queries + [document_text(document) for document in documents])[:sample_size]
+    # Every query is paired with documents in turn, the scores only have to agree, not be relevant
+    pairs = [[queries[i % len(queries)] if queries else documents[i]['title'], document_text(documents[i])] for i in range(min(sample_size, len(documents)))]
+
+    for kind, name, inputs in [("embedding", EMBEDDING_MODEL, texts), ("cross_encoder", CROSS_ENCODER_MODEL, pairs)]:
+        try:
+            manifest = export_model(kind, name, backend, inputs)
+        except Exception as e:
+            print(f"Error: {e}")
+            continue
+        latency = manifest['latency']
+        print(f"Exported {name} for {backend} ({manifest['file_name']}): parity {manifest['parity']:.4f} on {len(inputs)} inputs, "
+              f"{latency[backend] * 1000:.2f} ms per input instead of {latency['torch'] * 1000:.2f} ms with torch ({latency['torch'] / latency[backend]:.1f}x)")
+
 def fixed_size_chunking(text: str, chunk_size: int, chunk_overlap: int):
     words = text.split()
     chunks = []
@@ -124,55 +149,147 @@ def cosine_similarity(vec1, vec2):
 
     return dot_product / (norm1 * norm2)
 
+def normalize_embeddings(embeddings) -> np.ndarray:
+    """Return the rows of embeddings L2-normalized as a contiguous float32 matrix, so that cosine
+    similarity against a normalized query is a single matrix-vector product. Zero rows stay zero."""
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms != 0)
+
+def top_k(scores: np.ndarray, limit: int) -> np.ndarray:
+    """Indexes of the `limit` highest scores, best first and ties by index, without a full sort."""
+    if limit <= 0:
+        return np.empty(0, dtype=np.intp)
+    if limit < len(scores):
+        # argpartition picks arbitrarily among scores tied with the last one, so all of those compete
+        threshold = scores[np.argpartition(-scores, limit - 1)[limit - 1]]
+        candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.lexsort((candidates, -scores[candidates]))][:limit]
+
+def save_embeddings_file(path: str, embeddings: np.ndarray) -> None:
+    # Written to a temporary file and renamed, so processes that have the old file mapped keep reading it intact
+    with open(f"{path}.tmp", "wb") as embeddings_file:
+        np.save(embeddings_file, embeddings)
+    os.replace(f"{path}.tmp", path)
+
+def open_embeddings(path: str) -> np.ndarray:
+    """Memory-map a saved embedding matrix read-only. Pages are read on demand and shared through the
+    page cache by every process on the host. Files of earlier versions, which were not stored as
+    normalized float32, are rewritten once."""
+    embeddings = np.load(path, mmap_mode="r")
+    sample = np.asarray(embeddings[np.linspace(0, len(embeddings) - 1, min(len(embeddings), 1024)).astype(np.int64)], dtype=np.float32)
+    norms = np.linalg.norm(sample, axis=-1)
+    if embeddings.dtype != np.float32 or embeddings.ndim != 2 or not np.allclose(norms[norms > 0], 1.0, atol=1e-3):
+        save_embeddings_file(path, normalize_embeddings(embeddings))
+        embeddings = np.load(path, mmap_mode="r")
+    return np.asarray(embeddings)
+
+def document_text(document: dict) -> str:
+    return f"{document['title']}: {document['description']}"
+
 class SemanticSearch:
 
-    def __init__(self, model_name="all-MiniLM-L6-v2") -> None:
-        self.model = SentenceTransformer('all-MiniLM-L6-v2', token=True)
+    def __init__(self, model_name=EMBEDDING_MODEL) -> None:
         self.embeddings = None
         self.documents = None
         self.document_map = {}
+        self.model_name = model_name
+        # Embeddings of recent queries, in memory and in cache/query_embeddings
+        self.query_embeddings = QueryEmbeddingCache(model_identity("embedding", model_name))
         self.embeddings_path = os.path.join(CACHE_DIR, "movie_embeddings.npy")
+        # Content hash of the text behind every embedding row, see lib.embedding_store
+        self.embedding_hashes = None
+        self.embedding_hashes_path = os.path.join(CACHE_DIR, "movie_embedding_hashes.npy")
+        # Compressed codes of the embeddings for the coarse scan, if the embeddings have been quantized
+        self.quantized = None
+        self.quantized_path = os.path.join(CACHE_DIR, "movie_embeddings_quantized.npz")
+
+    @property
+    def model(self):
+        # Loaded on first use and shared by every instance in the process, see lib.model_registry
+        return embedding_model(self.model_name)
 
     def search(self, query:str, limit: int):
         if self.embeddings is None:
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
         
-        query_embeddings = self.generate_embedding(query)
-
-        score_document_tuples = []
+        # Rows are normalized once at build/load time, so cosine similarity is one matrix-vector product
+        query_embedding = normalize_embeddings(self.generate_embedding(query))
+        if self.quantized is not None:
+            rows, scores = self.quantized.search(query_embedding, limit)
+        else:
+            scores = self.embeddings @ query_embedding
+            rows = top_k(scores, limit)
+            scores = scores[rows]
 
-        for i in range(0, len(self.documents)):
-            similarity_score = cosine_similarity(self.embeddings[i], query_embeddings)
-            score_document_tuples.append((similarity_score, self.documents[i]))
-
-        sorted_score_document_tuples = sorted(score_document_tuples, key=lambda d: d[0], reverse=True)
-        
         results = []
-        for score, document in sorted_score_document_tuples[:limit]:
-            results.append({'score': score, 'title': document['title'], 'description': document['description']})
+        for i, score in zip(rows, scores):
+            document = self.documents[i]
+            results.append({'score': float(score), 'title': document['title'], 'description': document['description']})
 
         return results
     
     def generate_embedding(self, text: str):
         if not text or not text.strip():
             raise ValueError(f"Error: generate_embedding(): text mus not by empty")
-        
-        embedding = self.model.encode([text])
 
-        return embedding[0]
+        embedding = self.query_embeddings.get(text)
+        if embedding is None:
+            embedding = self.query_embeddings.put(text, self.model.encode([text])[0])
+
+        return embedding
+
+    def generate_embeddings(self, texts: list[str]) -> np.ndarray:
+        """Return the embeddings of texts as rows of a matrix. Texts that are not cached are encoded
+        together in one batch, each distinct text once."""
+        for text in texts:
+            if not text or not text.strip():
+                raise ValueError(f"Error: generate_embeddings(): texts must not be empty")
+
+        embeddings = [self.query_embeddings.get(text) for text in texts]
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(normalize_query(texts[i]), []).append(i)
+        if missing:
+            encoded = self.model.encode([texts[positions[0]] for positions in missing.values()])
+            for positions, embedding in zip(missing.values(), encoded):
+                embedding = self.query_embeddings.put(texts[positions[0]], embedding)
+                for i in positions:
+                    embeddings[i] = embedding
+        return np.array(embeddings, dtype=np.float32)
     
-    def build_embeddings(self, documents: list[dict]):
+    def build_embeddings(self, documents: list[dict], quantization: str | None = None):
         self.documents = documents
         document_list = []
         for document in documents:
             self.document_map[document['id']] = document
-            document_list.append(f"{document['title']}: {document['description']}")
+            document_list.append(document_text(document))
 
-        self.embeddings = self.model.encode(document_list, show_progress_bar=True)
+        # Only documents whose text changed since the last build are encoded again
+        if self.embeddings is None and os.path.exists(self.embeddings_path):
+            self.load_embeddings()
+        hashes = content_hashes(document_list, self.model_name)
+        self.embeddings = reuse_embeddings(document_list, hashes, self.embedding_hashes, self.embeddings,
+                                           lambda texts: normalize_embeddings(self.model.encode(texts, show_progress_bar=True)))
+        self.embedding_hashes = hashes
         self.save_embeddings()
+        self.quantize_embeddings(quantization)
 
         return self.embeddings
 
+    def quantize_embeddings(self, kind: str | None) -> None:
+        """Additionally store the embeddings as int8 or product-quantized codes, which search then
+        scans instead of the float32 matrix; None removes the codes."""
+        self.quantized = None
+        if os.path.exists(self.quantized_path):
+            os.remove(self.quantized_path)
+        if kind:
+            self.quantized = QuantizedVectors.build(self.embeddings, kind)
+            self.quantized.save(self.quantized_path)
+
     def load_or_create_embeddings(self, documents: list[dict]):
         
         self.documents = documents
@@ -182,16 +299,26 @@ class SemanticSearch:
 
         if os.path.exists(self.embeddings_path):
             self.load_embeddings()
-            if len(self.embeddings) == len(documents):
+            hashes = content_hashes([document_text(document) for document in documents], self.model_name)
+            if self.embedding_hashes is None and len(self.embeddings) == len(documents):
+                # Embeddings of earlier versions have no hashes and are taken to match the documents
+                self.embedding_hashes = hashes
+                save_embeddings_file(self.embedding_hashes_path, self.embedding_hashes)
+            if self.embedding_hashes is not None and np.array_equal(self.embedding_hashes, hashes):
                 return self.embeddings
 
-        return self.build_embeddings(documents)
+        return self.build_embeddings(documents, self.quantized.kind if self.quantized is not None else None)
 
     def save_embeddings(self) -> None:
         if not os.path.isdir(CACHE_DIR):
             os.mkdir(CACHE_DIR)
 
-        np.save(open(self.embeddings_path, "wb"), self.embeddings)
+        save_embeddings_file(self.embeddings_path, self.embeddings)
+        save_embeddings_file(self.embedding_hashes_path, self.embedding_hashes)
 
     def load_embeddings(self) -> None:
-        self.embeddings = np.load(self.embeddings_path)
\ No newline at end of file
+        self.embeddings = open_embeddings(self.embeddings_path)
+        self.embedding_hashes = np.load(self.embedding_hashes_path) if os.path.exists(self.embedding_hashes_path) else None
+        if self.embedding_hashes is not None and len(self.embedding_hashes) != len(self.embeddings):
+            self.embedding_hashes = None
+        self.quantized = load_quantized_vectors(self.quantized_path, self.embeddings)
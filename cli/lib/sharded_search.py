@@ -0,0 +1,289 @@
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from inverted_index import InvertedIndex, file_stamp, near_duplicate_clusters, saved_index_generation
+from utility import load_movies
+from constants import DEFAULT_BM25_K1, DEFAULT_BM25_B, DOCUMENTS_PATH, SHARDS_DIR, QUERY_EXPANSION_WEIGHT
+from lib.chunked_semantic_search import CHUNK_EMBEDDINGS_PATH, CHUNK_METADATA_PATH, open_chunk_metadata
+from lib.document_store import DocumentStore
+from lib.hybrid_search import HybridSearch
+from lib.result_cache import ResultCache
+from lib.semantic_search import SemanticSearch, normalize_embeddings, top_k, open_embeddings
+
+def shard_of(doc_id: int, shard_count: int) -> int:
+    return doc_id % shard_count
+
+def shard_dir(shard: int) -> str:
+    return os.path.join(SHARDS_DIR, f"shard_{shard}")
+
+def build_shards_command(shard_count: int) -> None:
+    movies = load_movies()['movies']
+    # Near-duplicates are found once over the whole collection, clusters may span shards. A shard
+    # keeps the clusters it holds a movie of: it skips its members and expands its representatives.
+    duplicates = near_duplicate_clusters(movies)
+    for shard in range(shard_count):
+        shard_movies = [movie for movie in movies if shard_of(movie['id'], shard_count) == shard]
+        shard_duplicates = {representative: members for representative, members in duplicates.items()
+                            if any(shard_of(doc_id, shard_count) == shard for doc_id in [representative] + members)}
+        inverted_index = InvertedIndex(index_dir=shard_dir(shard))
+        inverted_index.build(shard_movies, deduplicate=False, duplicates=shard_duplicates)
+        inverted_index.save()
+        print(f"Shard {shard}: {len(shard_movies)} documents")
+
+    with open(os.path.join(SHARDS_DIR, "shards.json"), "w") as manifest_file:
+        json.dump({"shard_count": shard_count}, manifest_file)
+
+class ShardVectors:
+    """The chunk embeddings of the movies that belong to one shard."""
+
+    def __init__(self, shard: int, shard_count: int, documents: DocumentStore) -> None:
+        chunk_metadata = open_chunk_metadata()
+        duplicates = chunk_metadata.duplicates()
+        rows = []
+        movie_indexes = []
+        for i, chunk_movie_idx in enumerate(chunk_metadata.movie_idx.tolist()):
+            # The chunks of a representative also stand for its near-duplicates, which may live in other shards
+            for movie_idx in [chunk_movie_idx] + duplicates.get(chunk_movie_idx, []):
+                if shard_of(documents.doc_id_at(movie_idx), shard_count) == shard:
+                    rows.append(i)
+                    movie_indexes.append(movie_idx)
+        # Only this shard's rows are read from the memory-mapped matrix of all chunks
+        self.embeddings = open_embeddings(CHUNK_EMBEDDINGS_PATH)[rows]
+        self.movie_indexes = np.array(movie_indexes, dtype=np.int64)
+        self.documents = documents
+
+    def search(self, query_embedding: np.ndarray, limit: int) -> list[tuple[int, float, int]]:
+        """Return (doc_id, best chunk cosine similarity, movie position) of the top `limit` movies."""
+        if len(self.embeddings) == 0:
+            return []
+        scores = self.embeddings @ normalize_embeddings(query_embedding)
+
+        movies, movie_of_chunk = np.unique(self.movie_indexes, return_inverse=True)
+        movie_scores = np.full(len(movies), -np.inf, dtype=np.float32)
+        np.maximum.at(movie_scores, movie_of_chunk, scores)
+
+        ranking = top_k(movie_scores, limit)
+        return [(self.documents.doc_id_at(int(movies[i])), float(movie_scores[i]), int(movies[i])) for i in ranking]
+
+    def batch_search(self, query_embeddings: np.ndarray, limit: int) -> list[list[tuple[int, float, int]]]:
+        """search() of every row of query_embeddings, scored as one matrix-matrix product."""
+        if len(self.embeddings) == 0:
+            return [[] for _ in query_embeddings]
+        scores = self.embeddings @ normalize_embeddings(query_embeddings).T
+
+        movies, movie_of_chunk = np.unique(self.movie_indexes, return_inverse=True)
+        movie_scores = np.full((len(movies), len(query_embeddings)), -np.inf, dtype=np.float32)
+        np.maximum.at(movie_scores, movie_of_chunk, scores)
+
+        results = []
+        for query_scores in movie_scores.T:
+            ranking = top_k(query_scores, limit)
+            results.append([(self.documents.doc_id_at(int(movies[i])), float(query_scores[i]), int(movies[i])) for i in ranking])
+        return results
+
+def _serve_shard(connection, shard: int, shard_count: int, documents_path: str) -> None:
+    # Worker process main loop: one request in, one reply out, until the coordinator closes the pipe
+    try:
+        inverted_index = InvertedIndex(index_dir=shard_dir(shard))
+        if not inverted_index.load():
+            raise ValueError(f"shard {shard} not found")
+        vectors = ShardVectors(shard, shard_count, DocumentStore.open(documents_path))
+        connection.send(("ready", None))
+    except Exception as e:
+        connection.send(("error", str(e)))
+        return
+
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        command, args = request
+        try:
+            if command == "statistics":
+                reply = inverted_index.term_statistics(*args)
+            elif command == "batch_statistics":
+                reply = inverted_index.batch_term_statistics(*args)
+            elif command == "bm25":
+                query, limit, k1, b, statistics, expansion, expansion_weight = args
+                reply = [(result['doc_id'], result['score']) for result in inverted_index.bm25_search(query, limit, k1=k1, b=b, with_documents=False, statistics=statistics, expansion=expansion, expansion_weight=expansion_weight)]
+            elif command == "batch_bm25":
+                queries, limit, k1, b, statistics, expansion, expansion_weight = args
+                reply = [[(result['doc_id'], result['score']) for result in results]
+                         for results in inverted_index.batch_bm25_search(queries, limit, k1=k1, b=b, with_documents=False, statistics=statistics, expansion=expansion, expansion_weight=expansion_weight)]
+            elif command == "chunks":
+                reply = vectors.search(*args)
+            elif command == "batch_chunks":
+                reply = vectors.batch_search(*args)
+            elif command == "close":
+                return
+            else:
+                raise ValueError(f"unknown command '{command}'")
+            connection.send(("ok", reply))
+        except Exception as e:
+            connection.send(("error", str(e)))
+
+class ShardCoordinator:
+    """Scatter-gather over one worker process per shard.
+
+    Every request is sent to all shards before any reply is read, so the shards work in parallel.
+    BM25 runs in two rounds: the term statistics of all shards are summed first and then passed to
+    every shard, which makes the merged top-k identical to searching one unsharded index.
+    """
+
+    def __init__(self, shard_count: int, documents_path: str) -> None:
+        self.shard_count = shard_count
+        self.connections = []
+        self.workers = []
+        for shard in range(shard_count):
+            parent_connection, child_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_serve_shard, args=(child_connection, shard, shard_count, documents_path), name=f"shard-{shard}", daemon=True)
+            worker.start()
+            self.connections.append(parent_connection)
+            self.workers.append(worker)
+        try:
+            self.__gather()
+        except Exception:
+            self.close()
+            raise
+
+    def __scatter(self, command: str, args: tuple) -> None:
+        for connection in self.connections:
+            connection.send((command, args))
+
+    def __gather(self) -> list:
+        replies = []
+        errors = []
+        for shard, connection in enumerate(self.connections):
+            status, reply = connection.recv()
+            if status == "error":
+                errors.append(f"shard {shard}: {reply}")
+            replies.append(reply)
+        if errors:
+            raise ValueError("; ".join(errors))
+        return replies
+
+    def term_statistics(self, query: str, expansion: int = 0, expansion_weight: float = QUERY_EXPANSION_WEIGHT) -> tuple[int, int, dict[str, int]]:
+        self.__scatter("statistics", (query, expansion, expansion_weight))
+        return self.__sum_statistics(self.__gather())
+
+    def batch_term_statistics(self, queries: list[str], expansion: int = 0, expansion_weight: float = QUERY_EXPANSION_WEIGHT) -> tuple[int, int, dict[str, int]]:
+        self.__scatter("batch_statistics", (queries, expansion, expansion_weight))
+        return self.__sum_statistics(self.__gather())
+
+    def __sum_statistics(self, shard_statistics: list[tuple[int, int, dict[str, int]]]) -> tuple[int, int, dict[str, int]]:
+        doc_count = 0
+        total_length = 0
+        document_frequencies = {}
+        for shard_doc_count, shard_total_length, shard_frequencies in shard_statistics:
+            doc_count += shard_doc_count
+            total_length += shard_total_length
+            for token, frequency in shard_frequencies.items():
+                document_frequencies[token] = document_frequencies.get(token, 0) + frequency
+        return doc_count, total_length, document_frequencies
+
+    def bm25_search(self, query: str, limit: int, k1: float = DEFAULT_BM25_K1, b: float = DEFAULT_BM25_B, expansion: int = 0, expansion_weight: float = QUERY_EXPANSION_WEIGHT) -> list[dict]:
+        statistics = self.term_statistics(query, expansion, expansion_weight)
+        self.__scatter("bm25", (query, limit, k1, b, statistics, expansion, expansion_weight))
+        # Every document lives in exactly one shard, so the global top-k is among the per-shard top-k lists
+        merged = [entry for shard_results in self.__gather() for entry in shard_results]
+        merged.sort(key=lambda entry: (-entry[1], entry[0]))
+        return [{'doc_id': doc_id, 'score': score} for doc_id, score in merged[:limit]]
+
+    def batch_bm25_search(self, queries: list[str], limit: int, k1: float = DEFAULT_BM25_K1, b: float = DEFAULT_BM25_B, expansion: int = 0, expansion_weight: float = QUERY_EXPANSION_WEIGHT) -> list[list[dict]]:
+        statistics = self.batch_term_statistics(queries, expansion, expansion_weight)
+        self.__scatter("batch_bm25", (queries, limit, k1, b, statistics, expansion, expansion_weight))
+        shard_replies = self.__gather()
+        results = []
+        for i in range(len(queries)):
+            merged = [entry for shard_results in shard_replies for entry in shard_results[i]]
+            merged.sort(key=lambda entry: (-entry[1], entry[0]))
+            results.append([{'doc_id': doc_id, 'score': score} for doc_id, score in merged[:limit]])
+        return results
+
+    def search_chunks(self, query_embedding: np.ndarray, limit: int) -> list[dict]:
+        self.__scatter("chunks", (query_embedding, limit))
+        merged = [entry for shard_results in self.__gather() for entry in shard_results]
+        # Ties are broken by movie position, as in ChunkedSemanticSearch.search_chunks
+        merged.sort(key=lambda entry: (-entry[1], entry[2]))
+        return [{'id': doc_id, 'score': round(score, 4)} for doc_id, score, _ in merged[:limit]]
+
+    def batch_search_chunks(self, query_embeddings: np.ndarray, limit: int) -> list[list[dict]]:
+        self.__scatter("batch_chunks", (query_embeddings, limit))
+        shard_replies = self.__gather()
+        results = []
+        for i in range(len(query_embeddings)):
+            merged = [entry for shard_results in shard_replies for entry in shard_results[i]]
+            merged.sort(key=lambda entry: (-entry[1], entry[2]))
+            results.append([{'id': doc_id, 'score': round(score, 4)} for doc_id, score, _ in merged[:limit]])
+        return results
+
+    def close(self) -> None:
+        for connection in self.connections:
+            try:
+                connection.send(("close", None))
+            except (BrokenPipeError, OSError):
+                pass
+            connection.close()
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+class ShardedHybridSearch(HybridSearch):
+    """HybridSearch over sharded keyword indexes and chunk embeddings served by worker processes.
+
+    The coordinator only holds the embedding model, to embed each query once, and the
+    memory-mapped document store, to fetch the records of the fused top results.
+    """
+
+    def __init__(self, documents: DocumentStore, shard_count: int) -> None:
+        if not os.path.exists(os.path.join(SHARDS_DIR, "shards.json")):
+            raise ValueError("Shards not found. Build them first with build-shards")
+        if json.load(open(os.path.join(SHARDS_DIR, "shards.json")))["shard_count"] != shard_count:
+            raise ValueError(f"Shards were built for a different shard count, rebuild them with build-shards --shards {shard_count}")
+        if not os.path.exists(CHUNK_EMBEDDINGS_PATH) or open_chunk_metadata() is None:
+            raise ValueError("Chunk embeddings not found. Generate them first with embed_chunks")
+
+        self.documents = documents
+        self.semantic_search = SemanticSearch()
+        self.coordinator = ShardCoordinator(shard_count, DOCUMENTS_PATH)
+        self.result_cache = ResultCache()
+        self.result_cache_path = os.path.join(SHARDS_DIR, "result_cache.json")
+        self.result_cache.load(self.result_cache_path)
+        self.generation = None
+        self.generation_stamps = None
+
+    def _cache_generation(self):
+        # The saved shard indexes and the chunk metadata, read again whenever one of them is rewritten
+        paths = [os.path.join(shard_dir(shard), "segments.json") for shard in range(self.coordinator.shard_count)] + [CHUNK_METADATA_PATH]
+        stamps = tuple(file_stamp(path) for path in paths)
+        if stamps != self.generation_stamps:
+            self.generation = (tuple(saved_index_generation(shard_dir(shard)) for shard in range(self.coordinator.shard_count)),
+                               open_chunk_metadata().source_fingerprint)
+            self.generation_stamps = stamps
+        return self.generation
+
+    def save_result_cache(self):
+        self._save_result_cache()
+
+    def _bm25_search(self, query, limit, expansion=0):
+        return self.coordinator.bm25_search(query, limit, expansion=expansion)
+
+    def _search_chunks(self, query, limit):
+        return self.coordinator.search_chunks(self.semantic_search.generate_embedding(query), limit)
+
+    def _batch_bm25_search(self, queries, limit, expansion=0):
+        return self.coordinator.batch_bm25_search(queries, limit, expansion=expansion)
+
+    def _batch_search_chunks(self, queries, limit):
+        return self.coordinator.batch_search_chunks(self.semantic_search.generate_embeddings(queries), limit)
+
+    def _get_document(self, doc_id):
+        return self.documents.get(doc_id)
+
+    def close(self) -> None:
+        self.coordinator.close()
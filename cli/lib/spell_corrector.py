@@ -0,0 +1,261 @@
+import collections
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from collections.abc import Iterable
+
+from utility import strip_punctuation
+from constants import INDEX_DIR, SPELL_MAX_EDIT_DISTANCE, SPELL_PREFIX_LENGTH, SPELL_CONFIDENCE_THRESHOLD
+
+# Symmetric delete spelling dictionary (SymSpell). Every dictionary word is indexed under all
+# strings reachable by deleting up to max_edit_distance characters from its prefix; a misspelled
+# word finds its candidates by looking up its own deletes, so no edit of the input ever has to be
+# generated except deletions. Layout, native byte order checked through a byte order mark:
+#
+#   header | section table | word_offsets | word_bytes | word_frequencies | delete_offsets
+#          | delete_bytes | candidate_starts | candidates
+#
+# Words and deletes are sorted by their UTF-8 bytes for binary search. candidates holds, for each
+# delete, the ids of the words that produce it.
+SPELL_MAGIC = b"RSESPELL"
+SPELL_VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+HEADER_FORMAT = "=8sIIIIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+SECTIONS = [
+    ("word_offsets", "Q"),
+    ("word_bytes", None),
+    ("word_frequencies", "I"),
+    ("delete_offsets", "Q"),
+    ("delete_bytes", None),
+    ("candidate_starts", "Q"),
+    ("candidates", "I"),
+]
+SECTION_TABLE_FORMAT = "=" + "QQ" * len(SECTIONS)
+SECTION_TABLE_SIZE = struct.calcsize(SECTION_TABLE_FORMAT)
+
+# Leading and trailing punctuation of a query word, kept around its correction
+WORD_PATTERN = re.compile(r"^(\W*)(.*?)(\W*)$")
+
+def count_document_words(documents: Iterable[dict]) -> dict[str, int]:
+    """Document frequency of every surface word (punctuation stripped, lower-cased, not stemmed)."""
+    frequencies = collections.Counter()
+    for document in documents:
+        frequencies.update(set(strip_punctuation(f"{document['title']} {document['description']}").split()))
+    return frequencies
+
+def deletes(word: str, max_edit_distance: int, prefix_length: int) -> set[str]:
+    # The word's prefix and every string reachable from it by up to max_edit_distance deletions
+    prefix = word[:prefix_length]
+    results = {prefix}
+    frontier = [prefix]
+    for _ in range(max_edit_distance):
+        next_frontier = []
+        for candidate in frontier:
+            for i in range(len(candidate)):
+                shorter = candidate[:i] + candidate[i + 1:]
+                if shorter not in results:
+                    results.add(shorter)
+                    next_frontier.append(shorter)
+        frontier = next_frontier
+    return results
+
+def edit_distance(source: str, target: str, max_distance: int) -> int:
+    """Damerau-Levenshtein (optimal string alignment) distance, or max_distance + 1 if larger."""
+    if abs(len(source) - len(target)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        current = [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and source[i - 1] == target[j - 2] and source[i - 2] == target[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+def encode_spell_index(word_frequencies: dict[str, int], max_edit_distance: int = SPELL_MAX_EDIT_DISTANCE, prefix_length: int = SPELL_PREFIX_LENGTH) -> bytes:
+    words = sorted(word_frequencies, key=lambda word: word.encode("utf-8"))
+    delete_candidates = collections.defaultdict(list)
+    for word_id, word in enumerate(words):
+        for delete in deletes(word, max_edit_distance, prefix_length):
+            delete_candidates[delete].append(word_id)
+
+    columns = {name: array(typecode) for name, typecode in SECTIONS if typecode}
+    word_bytes = bytearray()
+    columns["word_offsets"].append(0)
+    for word in words:
+        word_bytes += word.encode("utf-8")
+        columns["word_offsets"].append(len(word_bytes))
+        columns["word_frequencies"].append(word_frequencies[word])
+
+    delete_bytes = bytearray()
+    columns["delete_offsets"].append(0)
+    columns["candidate_starts"].append(0)
+    for delete in sorted(delete_candidates, key=lambda delete: delete.encode("utf-8")):
+        delete_bytes += delete.encode("utf-8")
+        columns["delete_offsets"].append(len(delete_bytes))
+        columns["candidates"].extend(delete_candidates[delete])
+        columns["candidate_starts"].append(len(columns["candidates"]))
+
+    payloads = []
+    for name, typecode in SECTIONS:
+        if name == "word_bytes":
+            payloads.append(bytes(word_bytes))
+        elif name == "delete_bytes":
+            payloads.append(bytes(delete_bytes))
+        else:
+            payloads.append(columns[name].tobytes())
+
+    section_table = []
+    body = bytearray()
+    offset = HEADER_SIZE + SECTION_TABLE_SIZE
+    for payload in payloads:
+        body += b"\0" * (-(offset + len(body)) % 8)
+        section_table.extend([offset + len(body), len(payload)])
+        body += payload
+
+    header = struct.pack(HEADER_FORMAT, SPELL_MAGIC, SPELL_VERSION, BYTE_ORDER_MARK, len(words), len(delete_candidates), max_edit_distance, prefix_length)
+    return header + struct.pack(SECTION_TABLE_FORMAT, *section_table) + bytes(body)
+
+def write_spell_index(path: str, word_frequencies: dict[str, int]) -> None:
+    buffer = encode_spell_index(word_frequencies)
+    with open(f"{path}.tmp", "wb") as spell_file:
+        spell_file.write(buffer)
+    os.replace(f"{path}.tmp", path)
+
+def _find(offsets, data, count: int, key: bytes) -> int | None:
+    # Binary search over count sorted strings stored as data[offsets[i]:offsets[i + 1]]
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if bytes(data[offsets[middle]:offsets[middle + 1]]) < key:
+            low = middle + 1
+        else:
+            high = middle
+    if low < count and bytes(data[offsets[low]:offsets[low + 1]]) == key:
+        return low
+    return None
+
+class SpellIndex:
+    """Memory-mapped symmetric delete dictionary of the indexed words, weighted by document frequency."""
+
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+        view = memoryview(buffer)
+        (magic, version, byte_order_mark, self.word_count, self.delete_count,
+         self.max_edit_distance, self.prefix_length) = struct.unpack_from(HEADER_FORMAT, view, 0)
+        if magic != SPELL_MAGIC or version != SPELL_VERSION:
+            raise ValueError("unsupported spell index format")
+        if byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError(f"spell index was written on a host with a different byte order than {sys.byteorder}")
+
+        section_table = struct.unpack_from(SECTION_TABLE_FORMAT, view, HEADER_SIZE)
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = section_table[2 * i], section_table[2 * i + 1]
+            section = view[offset:offset + length]
+            setattr(self, name, section.cast(typecode) if typecode else section)
+
+    @classmethod
+    def open(cls, path: str) -> "SpellIndex":
+        with open(path, "rb") as spell_file:
+            return cls(mmap.mmap(spell_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def word(self, word_id: int) -> str:
+        return bytes(self.word_bytes[self.word_offsets[word_id]:self.word_offsets[word_id + 1]]).decode("utf-8")
+
+    def frequency(self, word: str) -> int:
+        word_id = _find(self.word_offsets, self.word_bytes, self.word_count, word.encode("utf-8"))
+        return self.word_frequencies[word_id] if word_id is not None else 0
+
+    def suggestions(self, word: str) -> list[tuple[str, int, int]]:
+        """Return (word, edit distance, document frequency) of the dictionary words within the
+        maximum edit distance of word, closest and then most frequent first."""
+        frequency = self.frequency(word)
+        if frequency > 0:
+            return [(word, 0, frequency)]
+
+        seen = set()
+        suggestions = []
+        for delete in deletes(word, self.max_edit_distance, self.prefix_length):
+            delete_id = _find(self.delete_offsets, self.delete_bytes, self.delete_count, delete.encode("utf-8"))
+            if delete_id is None:
+                continue
+            for position in range(self.candidate_starts[delete_id], self.candidate_starts[delete_id + 1]):
+                word_id = self.candidates[position]
+                if word_id in seen:
+                    continue
+                seen.add(word_id)
+                candidate = self.word(word_id)
+                distance = edit_distance(word, candidate, self.max_edit_distance)
+                if distance <= self.max_edit_distance:
+                    suggestions.append((candidate, distance, self.word_frequencies[word_id]))
+        suggestions.sort(key=lambda suggestion: (suggestion[1], -suggestion[2], suggestion[0]))
+        return suggestions
+
+    def correct_word(self, word: str) -> tuple[str, float]:
+        """Return the most likely spelling of a lower-cased word and the confidence in it.
+
+        Known words are kept with confidence 1. Otherwise the confidence is the share of document
+        frequency the best candidate holds among the candidates at the same distance, discounted
+        for every extra edit; a word without any candidate is kept with confidence 0.
+        """
+        if len(word) <= 2 or word.isdigit():
+            return word, 1.0
+        suggestions = self.suggestions(word)
+        if not suggestions:
+            return word, 0.0
+        best, distance, frequency = suggestions[0]
+        if distance == 0:
+            return best, 1.0
+        total = sum(suggestion[2] for suggestion in suggestions if suggestion[1] == distance)
+        return best, (frequency / total) * (0.8 ** (distance - 1))
+
+    def correct_query(self, query: str) -> tuple[str, float]:
+        """Correct every word of query, keeping punctuation and capitalization; the confidence of
+        the query is that of its least certain word."""
+        corrected = []
+        confidence = 1.0
+        for token in query.split():
+            leading, core, trailing = WORD_PATTERN.match(token).groups()
+            word = strip_punctuation(core)
+            if not word:
+                corrected.append(token)
+                continue
+            correction, word_confidence = self.correct_word(word)
+            confidence = min(confidence, word_confidence)
+            if correction == word:
+                corrected.append(token)
+            elif core.isupper() and len(core) > 1:
+                corrected.append(leading + correction.upper() + trailing)
+            elif core[:1].isupper():
+                corrected.append(leading + correction.capitalize() + trailing)
+            else:
+                corrected.append(leading + correction + trailing)
+        return " ".join(corrected), confidence
+
+def load_spell_index(path: str = os.path.join(INDEX_DIR, "spelling.bin")) -> SpellIndex | None:
+    try:
+        return SpellIndex.open(path)
+    except Exception as e:
+        print(f"Error loading spell index: {e}")
+        return None
+
+def correct_spelling(query: str, llm=None) -> str:
+    """Correct typos with the local spell index, asking the LLM only if the correction is uncertain."""
+    spell_index = load_spell_index()
+    if spell_index is not None:
+        corrected, confidence = spell_index.correct_query(query)
+        if confidence >= SPELL_CONFIDENCE_THRESHOLD or llm is None:
+            return corrected
+    if llm is None:
+        return query
+    return llm.enhance_query(query, "spell")
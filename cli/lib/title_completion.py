@@ -0,0 +1,227 @@
+import itertools
+import mmap
+import os
+import struct
+import sys
+from collections.abc import Iterable
+
+import numpy as np
+
+from utility import strip_punctuation
+from constants import AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_PRECOMPUTED_COUNT, AUTOCOMPLETE_PRECOMPUTED_PREFIX_LENGTH
+
+# Sorted array of normalized title keys for search-as-you-type. Every title is stored under its
+# whole normalized form and under the suffix starting at each later word, so "rings" completes
+# "The Lord of the Rings". Layout, native byte order checked through a byte order mark:
+#
+#   header | section table | key_offsets | key_bytes | key_titles | key_ranks
+#          | title_offsets | title_bytes | doc_ids
+#          | prefix_offsets | prefix_bytes | prefix_title_offsets | prefix_titles
+#
+# Keys are sorted by their UTF-8 bytes, so the keys starting with a prefix form one contiguous
+# range found by two binary searches. key_titles maps a key to its title, key_ranks orders the
+# keys by static score: whole-title matches first, then by popularity and shorter titles.
+# The ranges of short prefixes span much of the index, so the top AUTOCOMPLETE_PRECOMPUTED_COUNT
+# titles of every prefix of up to AUTOCOMPLETE_PRECOMPUTED_PREFIX_LENGTH characters are stored
+# too: prefix_bytes holds the sorted prefixes and prefix_titles their titles, best first.
+COMPLETION_MAGIC = b"RSECMPLT"
+COMPLETION_VERSION = 2
+BYTE_ORDER_MARK = 0x01020304
+HEADER_FORMAT = "=8sIIIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+SECTIONS = [
+    ("key_offsets", "Q"),
+    ("key_bytes", None),
+    ("key_titles", "I"),
+    ("key_ranks", "I"),
+    ("title_offsets", "Q"),
+    ("title_bytes", None),
+    ("doc_ids", "I"),
+    ("prefix_offsets", "Q"),
+    ("prefix_bytes", None),
+    ("prefix_title_offsets", "Q"),
+    ("prefix_titles", "I"),
+]
+SECTION_TABLE_FORMAT = "=" + "QQ" * len(SECTIONS)
+SECTION_TABLE_SIZE = struct.calcsize(SECTION_TABLE_FORMAT)
+
+def normalize_title(text: str) -> str:
+    """Lower-case, strip punctuation and collapse whitespace. A trailing space is kept, it marks
+    the end of the last word of a prefix ("star " does not complete "stardust")."""
+    normalized = " ".join(strip_punctuation(text).split())
+    if normalized and text[-1:].isspace():
+        normalized += " "
+    return normalized
+
+def encode_title_completions(documents: Iterable[dict]) -> bytes:
+    titles = []
+    doc_ids = []
+    keys = []
+    for document in documents:
+        title_id = len(titles)
+        titles.append(document['title'])
+        doc_ids.append(document['id'])
+        words = normalize_title(document['title']).split()
+        popularity = float(document.get('popularity') or 0.0)
+        for start in range(len(words)):
+            # (key, is inner word, -popularity, title length, title id)
+            keys.append((" ".join(words[start:]).encode("utf-8"), start > 0, -popularity, len(document['title']), title_id))
+
+    ranks = np.empty(len(keys), dtype=np.uint32)
+    ranks[sorted(range(len(keys)), key=lambda i: keys[i][1:])] = np.arange(len(keys), dtype=np.uint32)
+    order = sorted(range(len(keys)), key=lambda i: (keys[i][0], keys[i][4]))
+
+    key_bytes = bytearray()
+    key_offsets = [0]
+    for i in order:
+        key_bytes += keys[i][0]
+        key_offsets.append(len(key_bytes))
+    title_bytes = bytearray()
+    title_offsets = [0]
+    for title in titles:
+        title_bytes += title.encode("utf-8")
+        title_offsets.append(len(title_bytes))
+    prefix_offsets, prefix_bytes, prefix_title_offsets, prefix_titles = precompute_prefixes([keys[i][0].decode("utf-8") for i in order],
+                                                                                            [keys[i][4] for i in order], ranks[order])
+
+    payloads = [np.array(key_offsets, dtype=np.uint64).tobytes(), bytes(key_bytes),
+                np.array([keys[i][4] for i in order], dtype=np.uint32).tobytes(), ranks[order].tobytes(),
+                np.array(title_offsets, dtype=np.uint64).tobytes(), bytes(title_bytes), np.array(doc_ids, dtype=np.uint32).tobytes(),
+                np.array(prefix_offsets, dtype=np.uint64).tobytes(), bytes(prefix_bytes),
+                np.array(prefix_title_offsets, dtype=np.uint64).tobytes(), np.array(prefix_titles, dtype=np.uint32).tobytes()]
+
+    section_table = []
+    body = bytearray()
+    offset = HEADER_SIZE + SECTION_TABLE_SIZE
+    for payload in payloads:
+        body += b"\0" * (-(offset + len(body)) % 8)
+        section_table.extend([offset + len(body), len(payload)])
+        body += payload
+
+    header = struct.pack(HEADER_FORMAT, COMPLETION_MAGIC, COMPLETION_VERSION, BYTE_ORDER_MARK, len(keys), len(titles), len(prefix_offsets) - 1)
+    return header + struct.pack(SECTION_TABLE_FORMAT, *section_table) + bytes(body)
+
+def precompute_prefixes(sorted_keys: list[str], key_titles: list[int], key_ranks: np.ndarray) -> tuple[list[int], bytearray, list[int], list[int]]:
+    # The keys with a prefix are contiguous in sorted_keys, so one pass per prefix length finds every range
+    prefixes = []
+    for length in range(1, AUTOCOMPLETE_PRECOMPUTED_PREFIX_LENGTH + 1):
+        start = 0
+        for prefix, group in itertools.groupby(sorted_keys, key=lambda key: key[:length] if len(key) >= length else None):
+            end = start + sum(1 for _ in group)
+            if prefix is not None:
+                title_ids = {}
+                for i in start + np.argsort(key_ranks[start:end], kind="stable"):
+                    title_ids.setdefault(key_titles[i])
+                    if len(title_ids) == AUTOCOMPLETE_PRECOMPUTED_COUNT:
+                        break
+                prefixes.append((prefix.encode("utf-8"), list(title_ids)))
+            start = end
+    prefixes.sort()
+
+    prefix_offsets = [0]
+    prefix_bytes = bytearray()
+    prefix_title_offsets = [0]
+    prefix_titles = []
+    for prefix, title_ids in prefixes:
+        prefix_bytes += prefix
+        prefix_offsets.append(len(prefix_bytes))
+        prefix_titles.extend(title_ids)
+        prefix_title_offsets.append(len(prefix_titles))
+    return prefix_offsets, prefix_bytes, prefix_title_offsets, prefix_titles
+
+def write_title_completions(path: str, documents: Iterable[dict]) -> None:
+    buffer = encode_title_completions(documents)
+    with open(f"{path}.tmp", "wb") as completion_file:
+        completion_file.write(buffer)
+    os.replace(f"{path}.tmp", path)
+
+class TitleCompletions:
+    """Memory-mapped title prefix index. Lookups touch only the key range of the prefix, never
+    postings, embeddings or movie records."""
+
+    def __init__(self, buffer) -> None:
+        self.buffer = buffer
+        view = memoryview(buffer)
+        magic, version, byte_order_mark, self.key_count, self.title_count, self.prefix_count = struct.unpack_from(HEADER_FORMAT, view, 0)
+        if magic != COMPLETION_MAGIC or version != COMPLETION_VERSION:
+            raise ValueError("unsupported title completion format, rebuild the index")
+        if byte_order_mark != BYTE_ORDER_MARK:
+            raise ValueError(f"title completions were written on a host with a different byte order than {sys.byteorder}")
+
+        section_table = struct.unpack_from(SECTION_TABLE_FORMAT, view, HEADER_SIZE)
+        for i, (name, typecode) in enumerate(SECTIONS):
+            offset, length = section_table[2 * i], section_table[2 * i + 1]
+            section = view[offset:offset + length]
+            setattr(self, name, section.cast(typecode) if typecode else section)
+        self.key_ranks_array = np.frombuffer(self.key_ranks, dtype=np.uint32)
+
+    @classmethod
+    def open(cls, path: str) -> "TitleCompletions":
+        with open(path, "rb") as completion_file:
+            return cls(mmap.mmap(completion_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[dict]) -> "TitleCompletions":
+        return cls(encode_title_completions(documents))
+
+    def __key(self, i: int) -> bytes:
+        return bytes(self.key_bytes[self.key_offsets[i]:self.key_offsets[i + 1]])
+
+    def __prefix(self, i: int) -> bytes:
+        return bytes(self.prefix_bytes[self.prefix_offsets[i]:self.prefix_offsets[i + 1]])
+
+    def __lower_bound(self, key: bytes, entry, count: int) -> int:
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if entry(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __precomputed(self, key: bytes, limit: int) -> list[int]:
+        i = self.__lower_bound(key, self.__prefix, self.prefix_count)
+        if i == self.prefix_count or self.__prefix(i) != key:
+            # No key starts with a precomputed-length prefix that is not stored
+            return []
+        return list(self.prefix_titles[self.prefix_title_offsets[i]:min(self.prefix_title_offsets[i] + limit, self.prefix_title_offsets[i + 1])])
+
+    def title(self, title_id: int) -> str:
+        return bytes(self.title_bytes[self.title_offsets[title_id]:self.title_offsets[title_id + 1]]).decode("utf-8")
+
+    def complete(self, prefix: str, limit: int = AUTOCOMPLETE_LIMIT) -> list[dict]:
+        """Return the top `limit` titles starting with prefix, or with a word starting with it."""
+        normalized = normalize_title(prefix)
+        key = normalized.encode("utf-8")
+        if not key or limit <= 0:
+            return []
+        if len(normalized) <= AUTOCOMPLETE_PRECOMPUTED_PREFIX_LENGTH and limit <= AUTOCOMPLETE_PRECOMPUTED_COUNT:
+            return [{'id': self.doc_ids[title_id], 'title': self.title(title_id)} for title_id in self.__precomputed(key, limit)]
+
+        # 0xff never occurs in UTF-8, so every key with the prefix sorts before prefix + 0xff
+        start = self.__lower_bound(key, self.__key, self.key_count)
+        end = self.__lower_bound(key + b"\xff", self.__key, self.key_count)
+
+        ranks = self.key_ranks_array[start:end]
+        # A title can match under several of its keys, so take a few spare candidates to dedupe
+        candidate_count = min(len(ranks), 2 * limit)
+        while True:
+            if candidate_count < len(ranks):
+                candidates = np.argpartition(ranks, candidate_count - 1)[:candidate_count]
+            else:
+                candidates = np.arange(len(ranks))
+            candidates = candidates[np.argsort(ranks[candidates])]
+            title_ids = list(dict.fromkeys(self.key_titles[start + int(i)] for i in candidates))
+            if len(title_ids) >= limit or candidate_count >= len(ranks):
+                break
+            candidate_count = min(len(ranks), 2 * candidate_count)
+        return [{'id': self.doc_ids[title_id], 'title': self.title(title_id)} for title_id in title_ids[:limit]]
+
+def load_title_completions(path: str) -> TitleCompletions | None:
+    try:
+        return TitleCompletions.open(path)
+    except Exception as e:
+        print(f"Error loading title completions: {e}")
+        return None
@@ -0,0 +1,179 @@
+import os
+
+import numpy as np
+
+from constants import PQ_SUBSPACES, PQ_TRAINING_ITERATIONS, PQ_TRAINING_SAMPLE, QUANTIZATION_RESCORE_FACTOR
+
+QUANTIZATION_KINDS = ["int8", "pq"]
+# One uint8 code per subspace
+PQ_CENTROIDS = 256
+# Rows encoded at once, bounds the float32 work arrays
+ENCODE_BLOCK_SIZE = 65536
+# Rows scanned at once. The int8 block is widened to float32 in a buffer that stays in the CPU
+# cache, so the matrix-vector product never reads more than the codes from memory.
+INT8_SCAN_BLOCK_SIZE = 512
+PQ_SCAN_BLOCK_SIZE = 8192
+
+def kmeans(points: np.ndarray, count: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = points[rng.choice(len(points), count, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest_centroids(points, centroids)
+        counts = np.bincount(assignment, minlength=count)
+        sums = np.stack([np.bincount(assignment, weights=points[:, j], minlength=count) for j in range(points.shape[1])], axis=1)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Empty clusters are reseeded with random points instead of being wasted
+        centroids[~filled] = points[rng.choice(len(points), int(np.sum(~filled)))]
+    return centroids
+
+def nearest_centroids(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin of the squared distance; |point|^2 is the same for every centroid and dropped
+    return np.argmin(np.sum(centroids * centroids, axis=1) - 2 * points @ centroids.T, axis=1)
+
+class ScalarQuantizer:
+    """Symmetric int8 codes with one scale per dimension, 4x smaller than float32."""
+
+    kind = "int8"
+
+    def __init__(self, scale: np.ndarray) -> None:
+        self.scale = scale
+
+    @classmethod
+    def train(cls, vectors: np.ndarray) -> "ScalarQuantizer":
+        scale = np.max(np.abs(vectors), axis=0).astype(np.float32) / 127
+        scale[scale == 0] = 1.0
+        return cls(scale)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), ENCODE_BLOCK_SIZE):
+            block = np.asarray(vectors[start:start + ENCODE_BLOCK_SIZE], dtype=np.float32)
+            codes[start:start + ENCODE_BLOCK_SIZE] = np.clip(np.rint(block / self.scale), -127, 127)
+        return codes
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # Folding the scales into the query leaves one product of the raw codes per row
+        weighted_query = (query * self.scale).astype(np.float32)
+        scores = np.empty(len(codes), dtype=np.float32)
+        buffer = np.empty((INT8_SCAN_BLOCK_SIZE, codes.shape[1]), dtype=np.float32)
+        for start in range(0, len(codes), INT8_SCAN_BLOCK_SIZE):
+            block = codes[start:start + INT8_SCAN_BLOCK_SIZE]
+            widened = buffer[:len(block)]
+            np.copyto(widened, block, casting="unsafe")
+            np.matmul(widened, weighted_query, out=scores[start:start + len(block)])
+        return scores
+
+    def parameters(self) -> dict[str, np.ndarray]:
+        return {'scale': self.scale}
+
+class ProductQuantizer:
+    """Product quantization: the vector is split into subspaces and every subspace is stored as the
+    one-byte id of its nearest k-means centroid, 48 bytes for a 384-dimensional float32 vector (32x
+    smaller). Scores against a query are sums of a per-query table of subspace dot products."""
+
+    kind = "pq"
+
+    def __init__(self, centroids: np.ndarray) -> None:
+        # (subspaces, centroids, subspace dimension)
+        self.centroids = centroids
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, subspaces: int = PQ_SUBSPACES, iterations: int = PQ_TRAINING_ITERATIONS,
+              sample_size: int = PQ_TRAINING_SAMPLE, seed: int = 0) -> "ProductQuantizer":
+        if vectors.shape[1] % subspaces != 0:
+            raise ValueError(f"{vectors.shape[1]} dimensions cannot be split into {subspaces} subspaces")
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))
+        training = np.asarray(vectors[sample], dtype=np.float32).reshape(len(sample), subspaces, -1)
+        count = min(PQ_CENTROIDS, len(sample))
+        return cls(np.stack([kmeans(training[:, subspace], count, iterations, rng) for subspace in range(subspaces)]).astype(np.float32))
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        # Column-major, so the codes of one subspace are contiguous for the scan
+        subspaces = len(self.centroids)
+        codes = np.empty((len(vectors), subspaces), dtype=np.uint8, order="F")
+        for start in range(0, len(vectors), ENCODE_BLOCK_SIZE):
+            block = np.asarray(vectors[start:start + ENCODE_BLOCK_SIZE], dtype=np.float32).reshape(-1, subspaces, self.centroids.shape[2])
+            for subspace in range(subspaces):
+                codes[start:start + len(block), subspace] = nearest_centroids(block[:, subspace], self.centroids[subspace])
+        return codes
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        subspaces = len(self.centroids)
+        # table[s, c]: dot product of the query's subspace s with centroid c of that subspace
+        table = np.einsum("sd,scd->sc", query.reshape(subspaces, -1).astype(np.float32), self.centroids)
+        scores = np.zeros(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), PQ_SCAN_BLOCK_SIZE):
+            block_scores = scores[start:start + PQ_SCAN_BLOCK_SIZE]
+            for subspace in range(subspaces):
+                block_scores += table[subspace].take(codes[start:start + PQ_SCAN_BLOCK_SIZE, subspace])
+        return scores
+
+    def parameters(self) -> dict[str, np.ndarray]:
+        return {'centroids': self.centroids}
+
+QUANTIZERS = {quantizer.kind: quantizer for quantizer in [ScalarQuantizer, ProductQuantizer]}
+
+class QuantizedVectors:
+    """Compressed codes of a normalized embedding matrix for the coarse scan, together with the
+    full-precision matrix (memory-mapped when loaded) that only the shortlist is read from."""
+
+    def __init__(self, quantizer, codes: np.ndarray, vectors: np.ndarray) -> None:
+        self.quantizer = quantizer
+        self.codes = codes
+        self.vectors = vectors
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, kind: str) -> "QuantizedVectors":
+        if kind not in QUANTIZERS:
+            raise ValueError(f"unknown quantization '{kind}', expected one of {', '.join(QUANTIZATION_KINDS)}")
+        quantizer = QUANTIZERS[kind].train(vectors)
+        return cls(quantizer, quantizer.encode(vectors), vectors)
+
+    @property
+    def kind(self) -> str:
+        return self.quantizer.kind
+
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        return self.quantizer.scores(self.codes, query)
+
+    def search(self, query: np.ndarray, limit: int, rescore_factor: int = QUANTIZATION_RESCORE_FACTOR) -> tuple[np.ndarray, np.ndarray]:
+        """Return the (rows, exact similarities) of the `limit` best rows of a normalized query, best
+        first. The `limit * rescore_factor` best rows of the coarse scan are rescored exactly."""
+        shortlist_size = limit * max(rescore_factor, 1)
+        if limit <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if shortlist_size >= len(self.codes):
+            shortlist = np.arange(len(self.codes))
+        else:
+            # Sorted, so the full-precision rows are read in file order
+            shortlist = np.sort(np.argpartition(-self.approximate_scores(query), shortlist_size - 1)[:shortlist_size])
+        scores = np.asarray(self.vectors[shortlist] @ query, dtype=np.float32)
+        order = np.lexsort((shortlist, -scores))[:limit]
+        return shortlist[order], scores[order]
+
+    def save(self, path: str) -> None:
+        with open(f"{path}.tmp", "wb") as quantized_file:
+            np.savez(quantized_file, kind=np.array(self.kind), codes=self.codes, **self.quantizer.parameters())
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def open(cls, path: str, vectors: np.ndarray) -> "QuantizedVectors":
+        with np.load(path) as data:
+            kind = str(data['kind'])
+            if kind not in QUANTIZERS:
+                raise ValueError(f"unknown quantization '{kind}'")
+            quantizer = ScalarQuantizer(data['scale']) if kind == ScalarQuantizer.kind else ProductQuantizer(data['centroids'])
+            codes = data['codes']
+        if len(codes) != len(vectors):
+            raise ValueError("quantized embeddings were built for different embeddings, rebuild them")
+        return cls(quantizer, codes, vectors)
+
+def load_quantized_vectors(path: str, vectors: np.ndarray) -> QuantizedVectors | None:
+    if not os.path.exists(path):
+        return None
+    try:
+        return QuantizedVectors.open(path, vectors)
+    except Exception as e:
+        print(f"Error loading quantized embeddings: {e}")
+        return None
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
-from lib.semantic_search import verify_model, embed_text, verify_embeddings, embed_query_text, search_command, chunk_command, semantic_chunk_command
-from lib.chunked_semantic_search import embed_chunks_command, search_chunked_command
-from constants import DEFAULT_SEARCH_LIMIT, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP, DEFAULT_SEMANTIC_CHUNK_SIZE
+from lib.semantic_search import verify_model, embed_text, verify_embeddings, embed_query_text, search_command, chunk_command, semantic_chunk_command, export_models_command
+from lib.chunked_semantic_search import embed_chunks_command, search_chunked_command, build_hnsw_command, hnsw_report_command, quantize_command, quantization_report_command
+from lib.vector_quantization import QUANTIZATION_KINDS
+from lib.model_registry import INFERENCE_BACKENDS, download_models_command
+from constants import DEFAULT_SEARCH_LIMIT, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP, DEFAULT_SEMANTIC_CHUNK_SIZE, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH, BACKEND_PARITY_SAMPLE
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
@@ -11,6 +13,12 @@ def main():
 
     subparsers.add_parser("verify", help="Verify sentence transformer model")
 
+    subparsers.add_parser("download_models", help="Download the embedding and cross-encoder models into the local models directory, the only command that needs network access")
+
+    export_models_parser = subparsers.add_parser("export_models", help="Export the embedding and cross-encoder models to ONNX, kept only if they agree with torch. Select the backend with the INFERENCE_BACKEND environment variable")
+    export_models_parser.add_argument("--backend", type=str, choices=[backend for backend in INFERENCE_BACKENDS if backend != "torch"], default="onnx-int8", help="onnx, or onnx-int8 for dynamic int8 quantization")
+    export_models_parser.add_argument("--sample", type=int, nargs='?', default=BACKEND_PARITY_SAMPLE, help="Number of inputs of the parity check")
+
     embed_text_parser = subparsers.add_parser("embed_text", help="Generate embedding of passed text")
     embed_text_parser.add_argument("text", type=str, help="Text to embed")
 
@@ -33,17 +41,42 @@ def main():
     semantic_chunk_parser.add_argument("--max-chunk-size", type=int, nargs='?', default=DEFAULT_SEMANTIC_CHUNK_SIZE, help="Size of chunks")
     semantic_chunk_parser.add_argument("--overlap", type=int, nargs='?', default=DEFAULT_CHUNK_OVERLAP, help="Overlap while chunking")
 
-    subparsers.add_parser("embed_chunks", help="Build or load chunk embeddings")
+    embed_chunks_parser = subparsers.add_parser("embed_chunks", help="Build or load chunk embeddings")
+    embed_chunks_parser.add_argument("--workers", type=int, nargs='?', default=None, help="Encoding processes, one per core by default")
 
     search_chunked_parser = subparsers.add_parser("search_chunked", help="Search chunked documents")
     search_chunked_parser.add_argument("query", type=str, help="Query to search for")
     search_chunked_parser.add_argument("--limit", type=int, nargs='?', default=DEFAULT_SEARCH_LIMIT, help="Limit of returned results")
+    search_chunked_parser.add_argument("--exact", help="Score every chunk at full precision instead of using the HNSW index or the quantized codes", action="store_true")
+    search_chunked_parser.add_argument("--ef-search", type=int, nargs='?', default=HNSW_EF_SEARCH, help="HNSW candidate list size, higher is slower but more accurate")
+
+    build_hnsw_parser = subparsers.add_parser("build_hnsw", help="Build the HNSW approximate nearest neighbour index of the chunk embeddings")
+    build_hnsw_parser.add_argument("--m", type=int, nargs='?', default=HNSW_M, help="Links per node and layer")
+    build_hnsw_parser.add_argument("--ef-construction", type=int, nargs='?', default=HNSW_EF_CONSTRUCTION, help="Candidate list size while building")
+
+    hnsw_report_parser = subparsers.add_parser("hnsw_report", help="Report HNSW recall and latency against exact search")
+    hnsw_report_parser.add_argument("--ef-search", type=int, nargs='+', default=[16, 32, 64, 128, 256], help="efSearch values to measure")
+    hnsw_report_parser.add_argument("--queries", type=int, nargs='?', default=200, help="Number of queries")
+    hnsw_report_parser.add_argument("--limit", type=int, nargs='?', default=10, help="k of recall@k")
+
+    quantize_parser = subparsers.add_parser("quantize", help="Store the chunk embeddings as compressed codes for the coarse scan of search_chunked")
+    quantize_parser.add_argument("kind", type=str, choices=QUANTIZATION_KINDS + ["none"], help="int8 (4x smaller), pq (product quantization, 32x smaller) or none to remove the codes")
+
+    quantization_report_parser = subparsers.add_parser("quantization_report", help="Report memory, recall and latency of quantized search against float32 search")
+    quantization_report_parser.add_argument("--kinds", type=str, nargs='+', choices=QUANTIZATION_KINDS, default=QUANTIZATION_KINDS, help="Quantizations to measure")
+    quantization_report_parser.add_argument("--rescore", type=int, nargs='+', default=[0, 1, 2, 4, 8], help="Shortlist sizes as multiples of the limit, 0 for no rescoring")
+    quantization_report_parser.add_argument("--queries", type=int, nargs='?', default=200, help="Number of queries")
+    quantization_report_parser.add_argument("--limit", type=int, nargs='?', default=10, help="k of recall@k")
 
     args = parser.parse_args()
 
     match args.command:
         case "verify":
             verify_model()
+        case "download_models":
+            download_models_command()
+        case "export_models":
+            export_models_command(args.backend, args.sample)
         
         case "embed_text":
             embed_text(args.text)            
@@ -58,9 +91,17 @@ def main():
         case "semantic_chunk":
             semantic_chunk_command(args.text, args.max_chunk_size, args.overlap)
         case "embed_chunks":
-            embed_chunks_command()
+            embed_chunks_command(args.workers)
         case "search_chunked":
-            search_chunked_command(args.query, args.limit)
+            search_chunked_command(args.query, args.limit, args.exact, args.ef_search)
+        case "build_hnsw":
+            build_hnsw_command(args.m, args.ef_construction)
+        case "hnsw_report":
+            hnsw_report_command(args.ef_search, args.queries, args.limit)
+        case "quantize":
+            quantize_command(None if args.kind == "none" else args.kind)
+        case "quantization_report":
+            quantization_report_command(args.kinds, args.rescore, args.queries, args.limit)
         case _:
             parser.print_help()
 
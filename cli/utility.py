@@ -1,7 +1,6 @@
 import os
 import json
 import string
-from nltk.stem import PorterStemmer
 
 # load movie data and stopwords
 def load_movies() -> list[dict]:
@@ -31,18 +30,10 @@ def load_json(file_path) -> dict:
         return None
 
 
-# Tokenize passed text and remove tokens listed in stopwords list
-def tokenize(text: str, stopwords: list[str]) -> list[str]:
-    stemmer = PorterStemmer()
-    text_tokens = strip_punctuation(text).split()
-    final_tokens = []
-    for text_token in text_tokens:
-        if text_token not in stopwords:
-            final_tokens.append(stemmer.stem(text_token))
-    return final_tokens
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
 
 def strip_punctuation(text: str) -> str:
-    return text.translate(str.maketrans('', '', string.punctuation)).lower()
+    return text.translate(PUNCTUATION_TABLE).lower()
 
 def format_documents(documents: list[dict]):
 
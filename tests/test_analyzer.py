@@ -0,0 +1,23 @@
+from nltk.stem import PorterStemmer
+
+from lib.analyzer import Analyzer
+
+def test_analyze_matches_porter_stemming():
+    stemmer = PorterStemmer()
+    analyzer = Analyzer(["the", "a"])
+    assert analyzer.analyze("The Running dogs, a jumping CAT!") == [stemmer.stem(word) for word in ["running", "dogs", "jumping", "cat"]]
+
+def test_cache_evicts_least_recently_used_word():
+    analyzer = Analyzer([], cache_size=2)
+    analyzer.token_ids("alpha beta")
+    analyzer.token_ids("alpha")
+    analyzer.token_ids("gamma")
+    assert list(analyzer.cache) == ["alpha", "gamma"]
+
+def test_full_vocabulary_is_cleared_between_calls():
+    stemmer = PorterStemmer()
+    analyzer = Analyzer([], vocabulary_size=3)
+    assert analyzer.analyze("alpha beta gamma delta") == [stemmer.stem(word) for word in ["alpha", "beta", "gamma", "delta"]]
+    assert analyzer.analyze("epsilon alpha") == [stemmer.stem(word) for word in ["epsilon", "alpha"]]
+    assert analyzer.stats()["vocabulary_size"] == 2
+    assert analyzer.stats()["cached_words"] == 2
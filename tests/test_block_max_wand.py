@@ -0,0 +1,31 @@
+import pytest
+
+from inverted_index import InvertedIndex
+
+WORDS = ["space", "alien", "crew", "planet", "station", "ocean", "robot", "storm", "island", "river"]
+# Several hundred documents, so every frequent term has postings in many blocks with different
+# maximum impacts; term frequencies and lengths vary with the id
+MOVIES = [{'id': doc_id, 'title': f"Movie {doc_id}",
+           'description': " ".join(word for j, word in enumerate(WORDS) for _ in range((doc_id * (j + 7)) % (j + 4) // 2))}
+          for doc_id in range(1, 601)]
+QUERIES = ["space", "alien crew", "planet station ocean", "robot storm island river", "space alien crew planet station",
+           "river", "ocean ocean", "unknown", "island unknown"]
+
+@pytest.fixture(scope="module")
+def inverted_index(tmp_path_factory) -> InvertedIndex:
+    inverted_index = InvertedIndex(index_dir=str(tmp_path_factory.mktemp("index")))
+    inverted_index.build(MOVIES, deduplicate=False)
+    return inverted_index
+
+def scored(results: list[dict]) -> dict[int, float]:
+    return {result['doc_id']: round(result['score'], 4) for result in results}
+
+@pytest.mark.parametrize("query", QUERIES)
+@pytest.mark.parametrize("limit", [1, 10, 50])
+def test_block_max_wand_matches_exhaustive_search(inverted_index, query, limit):
+    results = scored(inverted_index.bm25_search(query, limit, with_documents=False))
+    everything = scored(inverted_index.bm25_search(query, len(MOVIES), exhaustive=True, with_documents=False))
+    expected = list(everything.values())[:limit]
+    # Same top scores; documents tied at the cut may come from either side of it
+    assert sorted(results.values(), reverse=True) == expected
+    assert all(everything[doc_id] == score for doc_id, score in results.items())
@@ -0,0 +1,49 @@
+import math
+
+import pytest
+
+from inverted_index import InvertedIndex
+
+MOVIES = [
+    {'id': 1, 'title': "Fox", 'description': "fox fox dog"},
+    {'id': 2, 'title': "Dog", 'description': "dog cat"},
+    {'id': 3, 'title': "Cat", 'description': "cat bird fish"},
+]
+
+def bm25(tf: int, doc_length: int, df: int, doc_count: int = 3, avg_doc_length: float = 11 / 3, k1: float = 1.5, b: float = 0.75) -> float:
+    idf = math.log((doc_count - df + 0.5) / (df + 0.5) + 1)
+    return idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_length / avg_doc_length))
+
+@pytest.fixture
+def inverted_index(tmp_path) -> InvertedIndex:
+    inverted_index = InvertedIndex(index_dir=str(tmp_path))
+    inverted_index.build(MOVIES, deduplicate=False)
+    return inverted_index
+
+def test_scores_follow_the_bm25_formula(inverted_index):
+    # "fox fox fox dog", "dog dog cat", "cat cat bird fish"
+    results = inverted_index.bm25_search("dog cat", 3, exhaustive=True, with_documents=False)
+    expected = {
+        1: bm25(1, 4, 2),
+        2: bm25(2, 3, 2) + bm25(1, 3, 2),
+        3: bm25(2, 4, 2),
+    }
+    assert [result['doc_id'] for result in results] == sorted(expected, key=expected.get, reverse=True)
+    assert {result['doc_id']: result['score'] for result in results} == pytest.approx(expected, rel=1e-4)
+    assert inverted_index.bm25(1, "fox") == pytest.approx(bm25(3, 4, 1))
+
+def test_empty_index_scores_nothing(tmp_path):
+    inverted_index = InvertedIndex(index_dir=str(tmp_path))
+    assert inverted_index.get_bm25_tf(1, "fox") == 0.0
+    assert inverted_index.bm25_search("fox") == []
+
+def test_vectorized_scores_follow_the_bm25_formula(inverted_index):
+    # Other k1 and b than the stored impacts were computed with are scored over the doc-term matrix
+    results = inverted_index.bm25_search("dog cat fox", 3, k1=1.2, b=0.5, with_documents=False)
+    expected = {
+        1: bm25(3, 4, 1, k1=1.2, b=0.5) + bm25(1, 4, 2, k1=1.2, b=0.5),
+        2: bm25(2, 3, 2, k1=1.2, b=0.5) + bm25(1, 3, 2, k1=1.2, b=0.5),
+        3: bm25(2, 4, 2, k1=1.2, b=0.5),
+    }
+    assert [result['doc_id'] for result in results] == sorted(expected, key=expected.get, reverse=True)
+    assert {result['doc_id']: result['score'] for result in results} == pytest.approx(expected, rel=1e-4)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from lib import semantic_search
+from lib.chunked_semantic_search import ChunkedSemanticSearch
+from lib.document_store import DocumentStore
+from lib.hnsw_index import HNSWIndex
+from lib.query_embedding_cache import QueryEmbeddingCache
+from lib.vector_quantization import QuantizedVectors
+
+QUERIES = ["space pirates", "haunted lighthouse", "desert heist", "robot detective", "space pirates"]
+
+class FakeModel:
+    def encode(self, texts: list[str]) -> np.ndarray:
+        return np.array([np.random.default_rng(sum(map(ord, text))).normal(size=16) for text in texts], dtype=np.float32)
+
+@pytest.fixture
+def chunked_search(tmp_path, monkeypatch) -> ChunkedSemanticSearch:
+    monkeypatch.setattr(semantic_search, "embedding_model", lambda model_name: FakeModel())
+    rng = np.random.default_rng(7)
+    embeddings = rng.normal(size=(600, 16)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    chunked_search = ChunkedSemanticSearch("fake")
+    chunked_search.query_embeddings = QueryEmbeddingCache("fake", directory=str(tmp_path))
+    chunked_search.documents = DocumentStore.from_documents([{'id': i + 1, 'title': f"Movie {i}", 'description': ""} for i in range(300)])
+    # Two chunks per movie
+    chunked_search.chunk_embeddings = embeddings
+    chunked_search.chunk_movie_indexes = np.repeat(np.arange(300), 2)
+    return chunked_search
+
+@pytest.mark.parametrize("index", ["hnsw", "quantized", "exact"])
+def test_batch_search_finds_the_single_query_results(chunked_search, index):
+    if index == "hnsw":
+        chunked_search.hnsw = HNSWIndex.build(chunked_search.chunk_embeddings, m=4, ef_construction=8)
+    elif index == "quantized":
+        chunked_search.quantized = QuantizedVectors.build(chunked_search.chunk_embeddings, "int8")
+    # A small efSearch makes the graph results differ from the exact ones
+    single = [chunked_search.search_chunks(query, 5, with_documents=False, ef_search=5) for query in QUERIES]
+    assert chunked_search.batch_search_chunks(QUERIES, 5, with_documents=False, ef_search=5) == single
+    exact = [chunked_search.search_chunks(query, 5, with_documents=False, exact=True) for query in QUERIES]
+    assert chunked_search.batch_search_chunks(QUERIES, 5, with_documents=False, exact=True) == exact
@@ -0,0 +1,59 @@
+import pytest
+
+from lib.document_store import DocumentStore, read_fingerprint, write_documents
+
+MOVIES = [
+    {'id': 42, 'title': "Heat", 'description': "Crime in Los Angeles."},
+    {'id': 7, 'title': "Amélie", 'description': "Une fille à Montmartre."},
+    {'id': 1000, 'title': "Alien", 'description': "Space horror.", 'popularity': 12.5},
+    {'id': 3, 'title': "Solaris", 'description': "An ocean that thinks."},
+]
+
+@pytest.fixture
+def documents(tmp_path) -> DocumentStore:
+    write_documents(str(tmp_path / "documents.bin"), MOVIES)
+    return DocumentStore.open(str(tmp_path / "documents.bin"), cache_size=2)
+
+def test_behaves_like_the_list_it_was_written_from(documents):
+    assert len(documents) == len(MOVIES)
+    assert list(documents) == MOVIES
+    assert [documents[i] for i in range(len(MOVIES))] == MOVIES
+    assert documents[-1] == MOVIES[-1]
+    assert [documents.doc_id_at(i) for i in range(len(MOVIES))] == [42, 7, 1000, 3]
+    with pytest.raises(IndexError):
+        documents[len(MOVIES)]
+
+def test_looks_records_up_by_doc_id(documents):
+    assert documents.get(1000) == MOVIES[2]
+    assert documents.position(3) == 3
+    assert documents.contains(7) and not documents.contains(8)
+    assert documents.get(8) is None
+    assert documents.get(8, {}) == {}
+
+def test_cache_keeps_only_the_most_recent_records(documents):
+    for position in [0, 1, 0, 2]:
+        documents[position]
+    assert list(documents.cache) == [0, 2]
+    # Sequential scans do not touch the cache
+    list(documents)
+    assert list(documents.cache) == [0, 2]
+
+def test_fingerprint_is_stored_when_written(tmp_path):
+    write_documents(str(tmp_path / "a.bin"), MOVIES)
+    write_documents(str(tmp_path / "b.bin"), MOVIES)
+    write_documents(str(tmp_path / "c.bin"), MOVIES[::-1])
+
+    fingerprints = [DocumentStore.open(str(tmp_path / name)).fingerprint() for name in ["a.bin", "b.bin", "c.bin"]]
+    assert fingerprints[0] == fingerprints[1] != fingerprints[2]
+    assert DocumentStore.from_documents(MOVIES).fingerprint() == fingerprints[0]
+    assert read_fingerprint(str(tmp_path / "a.bin")) == fingerprints[0]
+
+def test_rejects_files_that_are_not_a_store(tmp_path):
+    (tmp_path / "empty.bin").write_bytes(b"")
+    (tmp_path / "other.bin").write_bytes(b"RSEDOCS\0" + bytes(64))
+    with pytest.raises(ValueError):
+        DocumentStore.open(str(tmp_path / "empty.bin"))
+    with pytest.raises(ValueError):
+        DocumentStore.open(str(tmp_path / "other.bin"))
+    with pytest.raises(ValueError):
+        read_fingerprint(str(tmp_path / "other.bin"))
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from lib import embedding_build
+
+def embed(text: str) -> list[float]:
+    return [len(text.split()), sum(map(ord, text)) % 97]
+
+class FakeModel:
+    def __init__(self, fail_after: int | None = None) -> None:
+        self.fail_after = fail_after
+        self.encoded = []
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        if self.fail_after is not None and len(self.encoded) >= self.fail_after:
+            raise KeyboardInterrupt
+        self.encoded.append(len(texts))
+        return np.array([embed(text) for text in texts], dtype=np.float32)
+
+def use_model(monkeypatch, model) -> None:
+    monkeypatch.setattr(embedding_build, "embedding_model", lambda model_name: model)
+
+def test_interrupted_build_resumes_from_checkpoints(tmp_path, monkeypatch):
+    texts = [" ".join(["word"] * (i % 13 + 1)) + f" {i}" for i in range(100)]
+    expected = np.array([embed(text) for text in texts], dtype=np.float32)
+
+    use_model(monkeypatch, FakeModel(fail_after=3))
+    with pytest.raises(KeyboardInterrupt):
+        embedding_build.encode_resumable(texts, "fake", str(tmp_path), workers=1, batch_size=8)
+
+    model = FakeModel()
+    use_model(monkeypatch, model)
+    assert np.array_equal(embedding_build.encode_resumable(texts, "fake", str(tmp_path), workers=1, batch_size=8), expected)
+    # 13 batches of which 3 were checkpointed
+    assert len(model.encoded) == 10
+
+    def no_model(model_name):
+        raise AssertionError("model loaded although every batch is checkpointed")
+    monkeypatch.setattr(embedding_build, "embedding_model", no_model)
+    assert np.array_equal(embedding_build.encode_resumable(texts, "fake", str(tmp_path), workers=4, batch_size=8), expected)
+
+    embedding_build.clear_checkpoints(str(tmp_path))
+    assert not tmp_path.exists()
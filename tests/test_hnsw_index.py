@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from lib.hnsw_index import HNSWIndex
+from lib.semantic_search import top_k
+
+@pytest.fixture(scope="module")
+def vectors() -> np.ndarray:
+    vectors = np.random.default_rng(3).normal(size=(2000, 24)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.fixture(scope="module")
+def queries() -> np.ndarray:
+    queries = np.random.default_rng(4).normal(size=(50, 24)).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+@pytest.fixture(scope="module")
+def hnsw(vectors) -> HNSWIndex:
+    return HNSWIndex.build(vectors, m=8, ef_construction=64)
+
+def recall(hnsw: HNSWIndex, vectors: np.ndarray, queries: np.ndarray, ef_search: int, limit: int = 10) -> float:
+    hits = 0
+    for query in queries:
+        rows, scores = hnsw.search(query, limit, ef_search)
+        assert np.allclose(scores, vectors[rows] @ query, atol=1e-5)
+        hits += len(set(rows.tolist()) & set(top_k(vectors @ query, limit).tolist()))
+    return hits / (limit * len(queries))
+
+def test_recall_against_exact_search_grows_with_ef_search(hnsw, vectors, queries):
+    low, default, high = (recall(hnsw, vectors, queries, ef_search) for ef_search in (16, 64, 200))
+    assert low < default <= high
+    assert default >= 0.95 and high >= 0.98
+
+def test_saved_graph_returns_the_same_neighbours(hnsw, vectors, queries, tmp_path):
+    path = str(tmp_path / "hnsw.bin")
+    hnsw.save(path)
+    reopened = HNSWIndex.open(path, vectors)
+    for query in queries[:10]:
+        assert np.array_equal(reopened.search(query, 10)[0], hnsw.search(query, 10)[0])
+
+def test_build_reports_progress_only_through_the_callback(vectors, capsys):
+    reports = []
+    HNSWIndex.build(vectors[:1500], m=4, ef_construction=16, progress=lambda inserted, total: reports.append((inserted, total)))
+    assert reports == [(1000, 1500), (1500, 1500)]
+    assert capsys.readouterr().out == ""
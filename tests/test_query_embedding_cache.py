@@ -0,0 +1,25 @@
+import json
+
+import numpy as np
+
+from lib import model_registry
+from lib.query_embedding_cache import QueryEmbeddingCache
+
+def test_identity_follows_the_backend_that_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_registry, "EXPORTED_MODELS_DIR", str(tmp_path))
+    # Without an export the onnx backends fall back to torch
+    assert model_registry.model_identity("embedding", "org/model", "onnx") == model_registry.model_identity("embedding", "org/model", "torch")
+
+    export_dir = tmp_path / "org--model--onnx-int8"
+    export_dir.mkdir()
+    (export_dir / model_registry.EXPORT_MANIFEST).write_text(json.dumps({"file_name": "onnx/model_qint8_avx2.onnx"}))
+    identities = {model_registry.model_identity("embedding", "org/model", backend) for backend in model_registry.INFERENCE_BACKENDS}
+    assert len(identities) == 2
+
+def test_backends_do_not_share_cached_embeddings(tmp_path):
+    torch_cache = QueryEmbeddingCache("org/model@torch", directory=str(tmp_path))
+    onnx_cache = QueryEmbeddingCache("org/model@onnx-int8/onnx/model_qint8_avx2.onnx", directory=str(tmp_path))
+    torch_cache.put("space  adventure", np.ones(4, dtype=np.float32))
+
+    assert onnx_cache.get("space adventure") is None
+    assert QueryEmbeddingCache("org/model@torch", directory=str(tmp_path)).get("space adventure").tolist() == [1.0] * 4
@@ -0,0 +1,56 @@
+import pytest
+
+from inverted_index import InvertedIndex
+
+MOVIES = [
+    {'id': 1, 'title': "alpha", 'description': "quick brown fox jumps lazy dog"},
+    {'id': 2, 'title': "beta", 'description': "brown quick fox"},
+    {'id': 3, 'title': "gamma", 'description': "quick red fox brown"},
+    {'id': 4, 'title': "delta", 'description': "lazy dog sleeps"},
+    {'id': 5, 'title': "epsilon", 'description': "fox"},
+    {'id': 6, 'title': "zeta", 'description': "fox hunts fox"},
+]
+
+@pytest.fixture
+def inverted_index(tmp_path) -> InvertedIndex:
+    inverted_index = InvertedIndex(index_dir=str(tmp_path))
+    inverted_index.build(MOVIES, deduplicate=False)
+    return inverted_index
+
+def doc_ids(inverted_index: InvertedIndex, query: str) -> list[int]:
+    return [movie['id'] for movie in inverted_index.boolean_search(query, 10)]
+
+@pytest.mark.parametrize("query, expected", [
+    ('"quick brown fox"', [1]),
+    ('"brown fox"', [1]),
+    ('"fox brown"', [3]),
+    # With slop the terms may appear in any order within len(terms) - 1 + slop positions
+    ('"quick brown"~1', [1, 2]),
+    ('"quick brown"~2', [1, 2, 3]),
+    ('"lazy dog"', [1, 4]),
+    ('lazy OR red', [1, 3, 4]),
+    ('lazy red', [1, 3, 4]),
+    ('(quick OR lazy) AND dog', [1, 4]),
+    ('fox AND NOT quick', [5, 6]),
+    ('NOT fox', [4]),
+    ('"quick fox" OR sleeps', [2, 4]),
+])
+def test_boolean_and_phrase_queries(inverted_index, query, expected):
+    assert doc_ids(inverted_index, query) == expected
+
+@pytest.mark.parametrize("query, expected", [
+    ('"fox fox"', []),
+    ('"fox fox"~1', [6]),
+    ('"fox fox fox"~5', []),
+])
+def test_repeated_phrase_terms_need_distinct_positions(inverted_index, query, expected):
+    assert doc_ids(inverted_index, query) == expected
+
+def test_phrases_span_segments_and_skip_deleted_documents(inverted_index):
+    inverted_index.add_document({'id': 7, 'title': "eta", 'description': "quick brown fox"})
+    inverted_index.delete_document(1)
+    assert doc_ids(inverted_index, '"quick brown fox"') == [7]
+
+def test_malformed_query_is_rejected(inverted_index):
+    with pytest.raises(ValueError):
+        inverted_index.boolean_search("(quick AND", 10)
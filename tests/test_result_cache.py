@@ -0,0 +1,77 @@
+import pytest
+
+from inverted_index import InvertedIndex, saved_index_generation
+from lib import document_store
+
+MOVIES = [
+    {'id': 1, 'title': "Alien", 'description': "A crew in deep space meets a deadly alien."},
+    {'id': 2, 'title': "Aliens", 'description': "Marines return to the alien planet."},
+    {'id': 3, 'title': "Heat", 'description': "A detective hunts a crew of bank robbers."},
+    {'id': 4, 'title': "Solaris", 'description': "A psychologist visits a space station above an ocean planet."},
+    {'id': 5, 'title': "Jaws", 'description': "A shark terrorizes a beach town."},
+]
+QUERIES = ["alien", "space crew", "planet", "bank robbers", "shark beach", "ocean"]
+
+def saved_index(index_dir) -> InvertedIndex:
+    inverted_index = InvertedIndex(index_dir=str(index_dir))
+    inverted_index.build(MOVIES, deduplicate=False)
+    inverted_index.save()
+    inverted_index.wait_for_merges()
+    return inverted_index
+
+def load_index(index_dir) -> InvertedIndex:
+    inverted_index = InvertedIndex(index_dir=str(index_dir))
+    assert inverted_index.load()
+    return inverted_index
+
+def doc_ids(inverted_index: InvertedIndex, query: str) -> list[int]:
+    return [result['doc_id'] for result in inverted_index.bm25_search(query, 10, with_documents=False)]
+
+def test_generation_is_read_from_the_saved_index_without_hashing(tmp_path, monkeypatch):
+    inverted_index = saved_index(tmp_path)
+    other = InvertedIndex(index_dir=str(tmp_path))
+
+    def no_hashing(*args, **kwargs):
+        raise AssertionError("documents hashed")
+    monkeypatch.setattr(document_store.hashlib, "blake2b", no_hashing)
+    assert other.load()
+    assert other.cache_generation() == inverted_index.cache_generation() == saved_index_generation(str(tmp_path))
+
+def test_saved_results_are_hit_by_another_index(tmp_path):
+    inverted_index = saved_index(tmp_path)
+    expected = [doc_ids(inverted_index, query) for query in QUERIES]
+    inverted_index.save_result_cache()
+
+    other = load_index(tmp_path)
+    assert [doc_ids(other, query) for query in QUERIES] == expected
+    assert other.result_cache.stats()["hits"] == len(QUERIES)
+
+def test_index_saved_by_another_process_is_searched(tmp_path):
+    inverted_index = saved_index(tmp_path)
+    assert sorted(doc_ids(inverted_index, "alien")) == [1, 2]
+    inverted_index.save_result_cache()
+
+    other = load_index(tmp_path)
+    other.delete_document(1)
+    other.add_document({'id': 6, 'title': "Alien Resurrection", 'description': "Ripley is cloned."})
+    other.save()
+    other.wait_for_merges()
+
+    assert sorted(doc_ids(inverted_index, "alien")) == [2, 6]
+    assert inverted_index.cache_generation() == saved_index_generation(str(tmp_path))
+
+def test_results_of_unsaved_changes_are_not_saved(tmp_path):
+    inverted_index = saved_index(tmp_path)
+    inverted_index.delete_document(1)
+    assert doc_ids(inverted_index, "alien") == [2]
+    inverted_index.save_result_cache()
+    assert not (tmp_path / "result_cache.json").exists()
+
+@pytest.mark.parametrize("capacity", [0, 2])
+def test_cache_file_round_trip(tmp_path, capacity):
+    inverted_index = saved_index(tmp_path)
+    inverted_index.result_cache.capacity = capacity
+    for query in QUERIES:
+        doc_ids(inverted_index, query)
+    inverted_index.save_result_cache()
+    assert len(load_index(tmp_path).result_cache.entries) == capacity
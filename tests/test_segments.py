@@ -0,0 +1,93 @@
+from inverted_index import InvertedIndex, file_stamp
+
+MOVIES = [
+    {'id': 1, 'title': "Harbor Lights", 'description': "a lighthouse keeper waits for a ship in the storm"},
+    {'id': 2, 'title': "Desert Run", 'description': "smugglers race across the desert at night"},
+    {'id': 3, 'title': "Harbor Ghosts", 'description': "a ghost ship drifts into the harbor"},
+    {'id': 4, 'title': "Night Shift", 'description': "a nurse works the night shift in a storm"},
+    {'id': 5, 'title': "Iron Coast", 'description': "miners strike on the coast"},
+    {'id': 6, 'title': "Silver Desert", 'description': "a prospector finds silver in the desert"},
+]
+
+ADDED = [
+    {'id': 7, 'title': "Storm Front", 'description': "a storm chaser follows the storm across the coast"},
+    {'id': 8, 'title': "Harbor Night", 'description': "dock workers strike at night in the harbor"},
+]
+
+UPDATED = [
+    {'id': 2, 'title': "Desert Run", 'description': "smugglers race a storm across the desert"},
+    {'id': 5, 'title': "Iron Harbor", 'description': "miners strike in the harbor"},
+]
+
+DELETED = [3, 6]
+
+QUERIES = ["storm", "harbor ship", "desert night", "strike coast", "silver ghost"]
+
+def search_all(inverted_index: InvertedIndex) -> list:
+    return [[(result['doc_id'], round(result['score'], 6)) for result in inverted_index.bm25_search(query, 10, exhaustive=True, with_documents=False)]
+            for query in QUERIES]
+
+def final_movies() -> list[dict]:
+    final = {movie['id']: movie for movie in MOVIES + ADDED + UPDATED}
+    return [final[doc_id] for doc_id in sorted(final) if doc_id not in DELETED]
+
+def apply_changes(inverted_index: InvertedIndex) -> None:
+    # Each save seals a new segment
+    for movie in ADDED:
+        inverted_index.add_document(movie)
+    inverted_index.save()
+    for movie in UPDATED:
+        inverted_index.add_document(movie)
+    inverted_index.save()
+    for doc_id in DELETED:
+        assert inverted_index.delete_document(doc_id)
+    inverted_index.save()
+    inverted_index.wait_for_merges()
+
+def test_updates_and_merge_match_a_fresh_build(tmp_path):
+    inverted_index = InvertedIndex(index_dir=str(tmp_path / "segmented"))
+    inverted_index.build(MOVIES, deduplicate=False)
+    inverted_index.save()
+    apply_changes(inverted_index)
+    inverted_index.force_merge()
+    assert len(inverted_index.segments) == 1
+
+    fresh = InvertedIndex(index_dir=str(tmp_path / "fresh"))
+    fresh.build(final_movies(), deduplicate=False)
+    assert search_all(inverted_index) == search_all(fresh)
+
+    # The merged index round-trips through its on-disk format
+    reloaded = InvertedIndex(index_dir=str(tmp_path / "segmented"))
+    assert reloaded.load()
+    assert search_all(reloaded) == search_all(fresh)
+    assert reloaded.get_document(5) == UPDATED[1]
+
+def test_saves_append_document_changes_until_a_merge(tmp_path):
+    inverted_index = InvertedIndex(index_dir=str(tmp_path))
+    inverted_index.build(MOVIES, deduplicate=False)
+    inverted_index.save()
+    stored = [file_stamp(path) for path in (inverted_index.documents_path, inverted_index.spelling_path, inverted_index.completions_path)]
+    apply_changes(inverted_index)
+    assert [file_stamp(path) for path in (inverted_index.documents_path, inverted_index.spelling_path, inverted_index.completions_path)] == stored
+    assert inverted_index.document_log_size > 0
+
+    # Another process sees the logged changes; completions skip deleted and retitled movies until the merge
+    reloaded = InvertedIndex(index_dir=str(tmp_path))
+    assert reloaded.load()
+    assert [reloaded.get_document(doc_id) for doc_id in (2, 3, 7)] == [UPDATED[0], None, ADDED[0]]
+    assert reloaded.complete("harbor") == [{'id': 1, 'title': "Harbor Lights"}]
+
+    reloaded.force_merge()
+    assert file_stamp(reloaded.documents_path) != stored[0]
+    assert reloaded.document_log_size == 0
+    assert [document['id'] for document in reloaded.documents] == [1, 4, 2, 5, 7, 8]
+    assert sorted(result['id'] for result in reloaded.complete("harbor")) == [1, 5, 8]
+
+def test_deleted_documents_are_not_returned_before_a_merge(tmp_path):
+    inverted_index = InvertedIndex(index_dir=str(tmp_path))
+    inverted_index.build(MOVIES, deduplicate=False)
+    inverted_index.save()
+    for doc_id in (1, 4):
+        inverted_index.delete_document(doc_id)
+    assert [result['doc_id'] for result in inverted_index.bm25_search("storm", 5, with_documents=False)] == []
+    assert inverted_index.has_unsaved_changes()
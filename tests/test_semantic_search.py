@@ -0,0 +1,15 @@
+import numpy as np
+import pytest
+
+from lib.semantic_search import top_k
+
+@pytest.mark.parametrize("limit", [0, 1, 5, 17, 100, 250])
+def test_top_k_matches_a_stable_full_sort(limit):
+    # Few distinct values, so most boundaries fall inside a run of ties
+    scores = np.random.default_rng(0).integers(0, 8, size=200).astype(np.float32)
+    expected = np.lexsort((np.arange(len(scores)), -scores))[:limit]
+    assert top_k(scores, limit).tolist() == expected.tolist()
+
+def test_top_k_breaks_ties_at_the_boundary_by_index():
+    scores = np.array([0.5, 0.9, 0.5, 0.5, 0.1, 0.5], dtype=np.float32)
+    assert top_k(scores, 3).tolist() == [1, 0, 2]
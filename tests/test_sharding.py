@@ -0,0 +1,53 @@
+import pytest
+
+from inverted_index import InvertedIndex, near_duplicate_clusters
+
+SHARD_COUNT = 3
+
+MOVIES = [
+    {'id': 1, 'title': "Alien", 'description': "A crew in deep space meets a deadly alien on a derelict ship."},
+    {'id': 2, 'title': "Aliens", 'description': "Marines return to the alien planet to fight the hive."},
+    {'id': 3, 'title': "Heat", 'description': "A detective hunts a crew of bank robbers across Los Angeles."},
+    {'id': 4, 'title': "Solaris", 'description': "A psychologist visits a space station above an ocean planet."},
+    {'id': 5, 'title': "Jaws", 'description': "A shark terrorizes a beach town and its police chief."},
+    {'id': 6, 'title': "The Thing", 'description': "An alien shape shifter attacks a research station in Antarctica."},
+    # Re-releases of 1, 3 and 4 under other ids, each in another shard than its original
+    {'id': 10, 'title': "Alien", 'description': "A crew in deep space meets a deadly alien on a derelict ship."},
+    {'id': 11, 'title': "Heat", 'description': "A detective hunts a crew of bank robbers across Los Angeles."},
+    {'id': 14, 'title': "Solaris", 'description': "A psychologist visits a space station above an ocean planet."},
+    {'id': 20, 'title': "Alien", 'description': "A crew in deep space meets a deadly alien on a derelict ship."},
+]
+QUERIES = ["alien", "space crew", "planet station", "bank robbers", "shark beach", "deadly alien ship", "ocean"]
+
+def sum_statistics(shard_statistics):
+    doc_count = sum(statistics[0] for statistics in shard_statistics)
+    total_length = sum(statistics[1] for statistics in shard_statistics)
+    document_frequencies = {}
+    for _, _, frequencies in shard_statistics:
+        for token, frequency in frequencies.items():
+            document_frequencies[token] = document_frequencies.get(token, 0) + frequency
+    return doc_count, total_length, document_frequencies
+
+def test_shards_built_from_global_clusters_match_the_deduplicated_index(tmp_path):
+    full = InvertedIndex(index_dir=str(tmp_path / "full"))
+    full.build(MOVIES)
+
+    duplicates = near_duplicate_clusters(MOVIES)
+    assert duplicates == {1: [10, 20], 3: [11], 4: [14]}
+    shards = []
+    for shard in range(SHARD_COUNT):
+        shard_duplicates = {representative: members for representative, members in duplicates.items()
+                            if any(doc_id % SHARD_COUNT == shard for doc_id in [representative] + members)}
+        inverted_index = InvertedIndex(index_dir=str(tmp_path / f"shard_{shard}"))
+        inverted_index.build([movie for movie in MOVIES if movie['id'] % SHARD_COUNT == shard], deduplicate=False, duplicates=shard_duplicates)
+        shards.append(inverted_index)
+
+    for query in QUERIES:
+        statistics = sum_statistics([inverted_index.term_statistics(query) for inverted_index in shards])
+        merged = [(result['doc_id'], result['score']) for inverted_index in shards
+                  for result in inverted_index.bm25_search(query, 20, with_documents=False, statistics=statistics)]
+        expected = {result['doc_id']: result['score'] for result in full.bm25_search(query, 20, exhaustive=True, with_documents=False)}
+        # Every copy is returned once, by the shard of its representative
+        assert len(merged) == len(expected), query
+        # The shards score with the vectorized scorer, which rounds differently from the stored impacts
+        assert dict(merged) == pytest.approx(expected, abs=1e-3), query
@@ -0,0 +1,46 @@
+import pytest
+
+from lib.spell_corrector import SpellIndex, count_document_words, edit_distance, encode_spell_index
+
+MOVIES = [
+    {'id': 1, 'title': "The Matrix", 'description': "a hacker learns the world is a simulation"},
+    {'id': 2, 'title': "The Terminator", 'description': "a cyborg assassin is sent back in time"},
+    {'id': 3, 'title': "Alien", 'description': "the crew of a spaceship meets an alien"},
+    {'id': 4, 'title': "Aliens", 'description': "marines return to the alien planet"},
+    {'id': 5, 'title': "Matrix Reloaded", 'description': "the hacker returns to the matrix"},
+]
+
+@pytest.fixture
+def spell_index() -> SpellIndex:
+    return SpellIndex(encode_spell_index(count_document_words(MOVIES)))
+
+def test_counts_document_frequency_of_surface_words():
+    words = count_document_words(MOVIES)
+    assert words['the'] == 5
+    assert words['matrix'] == 2
+    assert words['alien'] == 2 and words['aliens'] == 1
+
+@pytest.mark.parametrize("source, target, distance", [
+    ("matrix", "matrix", 0),
+    ("matrx", "matrix", 1),
+    ("mtarix", "matrix", 1),
+    ("hackr", "hacker", 1),
+    ("allien", "alien", 1),
+    ("cyborg", "marines", 3),
+])
+def test_edit_distance_counts_transpositions_as_one_edit(source, target, distance):
+    assert edit_distance(source, target, 2) == min(distance, 3)
+
+@pytest.mark.parametrize("word", ["matrx", "mtarix", "aliense", "alein", "spacehsip", "terminatr", "hakcer", "zzzzzz"])
+def test_suggestions_are_every_word_within_the_edit_distance(spell_index, word):
+    dictionary = count_document_words(MOVIES)
+    expected = sorted(((candidate, edit_distance(word, candidate, 2), frequency) for candidate, frequency in dictionary.items()
+                       if edit_distance(word, candidate, 2) <= 2), key=lambda suggestion: (suggestion[1], -suggestion[2], suggestion[0]))
+    assert spell_index.suggestions(word) == expected
+
+def test_corrects_queries_keeping_case_and_punctuation(spell_index):
+    assert spell_index.correct_query("Teh Matrx, relaoded!") == ("The Matrix, reloaded!", 1.0)
+    # "alien" and "aliens" are both one edit from "alienz", "alien" is in more documents
+    corrected, confidence = spell_index.correct_query("alienz")
+    assert corrected == "alien" and confidence == pytest.approx(2 / 3)
+    assert spell_index.correct_query("xyzzyq") == ("xyzzyq", 0.0)
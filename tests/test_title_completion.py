@@ -0,0 +1,38 @@
+import pytest
+
+from lib.title_completion import TitleCompletions, normalize_title
+
+MOVIES = [
+    {'id': 1, 'title': "The Lord of the Rings", 'popularity': 90.0},
+    {'id': 2, 'title': "The Thing", 'popularity': 40.0},
+    {'id': 3, 'title': "Thelma & Louise", 'popularity': 30.0},
+    {'id': 4, 'title': "Lord of War", 'popularity': 50.0},
+    {'id': 5, 'title': "Rings", 'popularity': 10.0},
+    {'id': 6, 'title': "The Ring", 'popularity': 60.0},
+    {'id': 7, 'title': "Star Wars", 'popularity': 95.0},
+    {'id': 8, 'title': "Stardust", 'popularity': 20.0},
+    {'id': 9, 'title': "A Star Is Born", 'popularity': 70.0},
+    {'id': 10, 'title': "Thor", 'popularity': 55.0},
+]
+
+def expected_completions(prefix: str, limit: int) -> list[int]:
+    # Whole-title matches first, then by popularity and shorter titles
+    key = normalize_title(prefix)
+    ranked = []
+    for movie in MOVIES:
+        words = normalize_title(movie['title']).split()
+        starts = [start for start in range(len(words)) if " ".join(words[start:]).startswith(key)]
+        if starts:
+            ranked.append(((starts[0] > 0, -movie['popularity'], len(movie['title'])), movie['id']))
+    return [doc_id for _, doc_id in sorted(ranked)][:limit]
+
+@pytest.mark.parametrize("prefix", ["t", "th", "the", "the ", "thel", "lord", "r", "rin", "star ", "st", "x", "zz"])
+@pytest.mark.parametrize("limit", [1, 3, 10])
+def test_completions_follow_the_static_ranking(prefix, limit):
+    # Prefixes of up to three characters are answered from the precomputed lists, longer ones from the key range
+    completions = TitleCompletions.from_documents(MOVIES)
+    assert [completion['id'] for completion in completions.complete(prefix, limit)] == expected_completions(prefix, limit)
+
+def test_limits_beyond_the_precomputed_lists_scan_the_key_range():
+    completions = TitleCompletions.from_documents(MOVIES)
+    assert [completion['id'] for completion in completions.complete("t", 100)] == expected_completions("t", 100)
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from lib.semantic_search import top_k
+from lib.vector_quantization import QuantizedVectors
+
+@pytest.fixture(scope="module")
+def vectors() -> np.ndarray:
+    # Clustered like real embeddings, so the coarse scan has near ties to get wrong
+    rng = np.random.default_rng(5)
+    centres = rng.normal(size=(20, 96))
+    vectors = (centres[rng.integers(0, 20, 2000)] + 0.5 * rng.normal(size=(2000, 96))).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.fixture(scope="module")
+def queries(vectors) -> np.ndarray:
+    queries = vectors[::40] + 0.1 * np.random.default_rng(6).normal(size=(50, 96)).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+@pytest.fixture(scope="module", params=["int8", "pq"])
+def quantized(request, vectors) -> QuantizedVectors:
+    return QuantizedVectors.build(vectors, request.param)
+
+def recall(quantized: QuantizedVectors, vectors: np.ndarray, queries: np.ndarray, rescore_factor: int, limit: int = 10) -> float:
+    hits = 0
+    for query in queries:
+        rows, scores = quantized.search(query, limit, rescore_factor)
+        # Every returned score is the exact similarity, best first
+        assert np.allclose(scores, vectors[rows] @ query, atol=1e-6)
+        assert np.all(np.diff(scores) <= 0)
+        hits += len(set(rows.tolist()) & set(top_k(vectors @ query, limit).tolist()))
+    return hits / (limit * len(queries))
+
+def test_rescoring_recovers_the_exact_neighbours(quantized, vectors, queries):
+    without, rescored = recall(quantized, vectors, queries, 1), recall(quantized, vectors, queries, 4)
+    assert without <= rescored
+    assert rescored >= 0.99
+    # A shortlist as large as the matrix is exact search
+    assert recall(quantized, vectors, queries, len(vectors)) == 1.0
+
+def test_int8_scores_approximate_the_dot_product(vectors, queries):
+    quantized = QuantizedVectors.build(vectors, "int8")
+    assert quantized.codes.nbytes * 4 == vectors.nbytes
+    assert np.max(np.abs(quantized.approximate_scores(queries[0]) - vectors @ queries[0])) < 0.02
+
+def test_saved_codes_give_the_same_results(quantized, vectors, queries, tmp_path):
+    path = str(tmp_path / "quantized.npz")
+    quantized.save(path)
+    reopened = QuantizedVectors.open(path, vectors)
+    assert reopened.kind == quantized.kind
+    for query in queries[:5]:
+        assert np.array_equal(reopened.search(query, 10)[0], quantized.search(query, 10)[0])
+    with pytest.raises(ValueError):
+        QuantizedVectors.open(path, vectors[:10])